@@ -0,0 +1,101 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Logging that stays off the migration's path.
+
+BackgroundHandler queues records and a thread hands them to the real
+(file, console) handlers, so formatting and disk writes happen there.
+Sampler lets a per-row loop log one row in N.
+"""
+import logging
+import Queue
+import threading
+import time
+
+
+class BackgroundHandler(logging.Handler):
+    """Passes records to `handlers` from a thread of its own.
+
+    The message is merged with its arguments before queueing, so objects
+    changed later are logged as they were. A full queue blocks the
+    logging thread rather than dropping records.
+    """
+    def __init__(self, handlers, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.queue = Queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self._run,
+                                       name='obligate-logging')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # tracebacks don't survive the trip, their text does
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+class Sampler(object):
+    """
+    True for one call in `every`, and after `seconds` without one.
+
+    >>> sample = Sampler(every=3)
+    >>> [sample() for i in range(7)]
+    [True, False, False, True, False, False, True]
+    """
+    def __init__(self, every=1000, seconds=None):
+        self.every = max(1, int(every))
+        self.seconds = seconds
+        self.calls = 0
+        self.last = time.time()
+
+    def __call__(self):
+        self.calls += 1
+        if (self.calls - 1) % self.every == 0:
+            self.last = time.time()
+            return True
+        if self.seconds is not None and \
+                time.time() - self.last >= self.seconds:
+            self.last = time.time()
+            return True
+        return False
@@ -0,0 +1,107 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import os
+import resource
+
+blog = logging.getLogger('obligate.batching')
+
+
+def current_rss_mb():
+    """Resident set size of this process right now, in MB.
+
+    Falls back to the peak RSS where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as fh:
+            pages = int(fh.read().split()[1])
+        return pages * resource.getpagesize() / (1024.0 * 1024.0)
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class CommitController(object):
+    """Decides when buffered rows are committed and how many go together.
+
+    The batch size is resized after every commit so one commit takes about
+    `target_seconds`: it follows the observed rows/s, but never moves by
+    more than a factor of two at once. Crossing `rss_budget_mb` commits
+    straight away and halves the batch, since the buffered rows are what
+    holds the memory.
+
+    >>> c = CommitController(target_seconds=2.0, rss_budget_mb=None,
+    ...                      batch_size=100, min_batch=10, max_batch=1000)
+    >>> [c.tick() for i in range(100)].count(True)
+    1
+    >>> c.committed(100, 0.5)
+    200
+    >>> c.committed(200, 8.0)
+    100
+    >>> c.committed(100, 0.0)
+    200
+    >>> c.committed(0, 0.0)
+    200
+    """
+    def __init__(self, target_seconds=10.0, rss_budget_mb=None,
+                 batch_size=10000, min_batch=1000, max_batch=200000,
+                 rss=current_rss_mb):
+        self.target_seconds = float(target_seconds)
+        self.rss_budget_mb = rss_budget_mb
+        self.min_batch = int(min_batch)
+        self.max_batch = int(max_batch)
+        self.batch_size = self._clamp(int(batch_size))
+        self.rss = rss
+        self.pending = 0
+        self.batches = 0
+
+    def _clamp(self, size):
+        return max(self.min_batch, min(self.max_batch, size))
+
+    def tick(self):
+        """Count one buffered row, True when it is time to commit."""
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            return True
+        # checking RSS costs a read of /proc, do it every min_batch rows
+        if self.rss_budget_mb and self.pending % self.min_batch == 0:
+            rss = self.rss()
+            if rss >= self.rss_budget_mb:
+                blog.warning("RSS {0:.0f}M over budget of {1}M with {2} "
+                             "rows pending, committing early."
+                             .format(rss, self.rss_budget_mb, self.pending))
+                self.batch_size = self._clamp(self.pending // 2)
+                return True
+        return False
+
+    def committed(self, rows, seconds):
+        """Record a finished commit, returns the next batch size."""
+        self.pending = 0
+        if not rows:
+            return self.batch_size
+        self.batches += 1
+        if seconds > 0:
+            rate = rows / seconds
+            wanted = int(rate * self.target_seconds)
+            wanted = max(self.batch_size // 2,
+                         min(self.batch_size * 2, wanted))
+        else:
+            rate = float('inf')
+            wanted = self.batch_size * 2
+        self.batch_size = self._clamp(wanted)
+        blog.info("commit batch {0}: {1} rows in {2:.2f} seconds "
+                  "({3:.0f} rows/s), next batch size {4}"
+                  .format(self.batches, rows, seconds, rate,
+                          self.batch_size))
+        return self.batch_size
@@ -0,0 +1,132 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Migrate synthetic melanges of growing size and report how obligate
+scales:
+
+    python obligate/benchmark.py --ips 10000,100000,1000000
+
+Both databases are sqlite files in a temporary directory unless
+--melange-url and --quark-url point somewhere else (a local mysql is
+closer to production). Per-stage seconds, rows per second and peak RSS
+are printed for every size and saved to logs/benchmark/.
+"""
+import argparse
+import datetime
+import json
+import logging
+import shutil
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from obligate import Obligator
+from synthetic import DatasetSpec
+from synthetic import Generator
+from synthetic import SyntheticBridges
+from utils import get_log_dir
+
+environment = 'benchmark'
+
+
+def run_scale(spec, melange_url, quark_url):
+    """Generate `spec`, migrate it, returns the metrics report."""
+    melange_engine = create_engine(melange_url)
+    neutron_engine = create_engine(quark_url)
+    started = time.time()
+    counts = Generator(spec, melange_engine).generate()
+    generated = time.time() - started
+    melange_session = sessionmaker(bind=melange_engine)()
+    neutron_session = sessionmaker(bind=neutron_engine)()
+    bridges = SyntheticBridges(melange_session, seed=spec.seed)
+    migration = Obligator(melange_session, neutron_session,
+                          environment=environment,
+                          bridges=(bridges, bridges),
+                          dataset=spec.fingerprint())
+    if neutron_engine.name == 'sqlite':
+        # sqlite locks the whole file, more writers only wait on each other
+        migration.writer.writers = 1
+    migration.migrate()
+    report = migration.metrics.report()
+    report.update({'dataset': spec.as_dict(),
+                   'fingerprint': spec.fingerprint(),
+                   'generated_rows': counts,
+                   'generate_seconds': round(generated, 3),
+                   'error_free': migration.error_free})
+    melange_session.close()
+    neutron_session.close()
+    return report
+
+
+def stage_table(report):
+    lines = ["{0:<40} {1:>10} {2:>12} {3:>10}".format(
+        'stage', 'seconds', 'rows/s', 'peak MB')]
+    for stage in report['stages']:
+        lines.append("{0:<40} {1:>10.2f} {2:>12.1f} {3:>10.1f}".format(
+            stage['stage'][:40], stage['wall_seconds'],
+            stage['rows_per_second'], stage['peak_rss_mb']))
+    lines.append("{0:<40} {1:>10.2f} {2:>12} {3:>10.1f}".format(
+        'total', report['wall_seconds'], '', report['peak_rss_mb']))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark a migration of synthetic melange data.')
+    parser.add_argument('--ips', default='10000,100000,1000000',
+                        help='Comma separated dataset sizes, in ips.')
+    parser.add_argument('--ips-per-block', type=int, default=200,
+                        dest='ips_per_block')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--melange-url', dest='melange_url',
+                        help='Database to generate melange into, it is '
+                             'emptied first. Defaults to sqlite.')
+    parser.add_argument('--quark-url', dest='quark_url',
+                        help='Database to migrate into, it is emptied '
+                             'first. Defaults to sqlite.')
+    arguments = parser.parse_args()
+    logdir = get_log_dir(environment)
+    logging.basicConfig(filename='{0}/benchmark.log'.format(logdir),
+                        level=logging.INFO)
+    workdir = tempfile.mkdtemp(prefix='obligate-benchmark-')
+    results = list()
+    try:
+        for ips in [int(n) for n in arguments.ips.split(',') if n]:
+            spec = DatasetSpec(ips=ips, ips_per_block=arguments.ips_per_block,
+                               seed=arguments.seed)
+            melange_url = arguments.melange_url or \
+                'sqlite:///{0}/melange.{1}.db'.format(workdir, ips)
+            quark_url = arguments.quark_url or \
+                'sqlite:///{0}/quark.{1}.db'.format(workdir, ips)
+            report = run_scale(spec, melange_url, quark_url)
+            results.append(report)
+            print "{0} ips (dataset {1}), generated in {2:.1f}s:".format(
+                ips, report['fingerprint'], report['generate_seconds'])
+            print stage_table(report)
+            print
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    path = '{0}/benchmark.{1}.json'.format(
+        logdir, datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S'))
+    with open(path, 'w') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+    print "Results written to {0}".format(path)
+    return 0 if all(r['error_free'] for r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import array
+import itertools
+import uuid
+
+from governor import SpillDict
+from governor import SpillList
+
+NO_HANDLE = -1
+
+
+def compact_id(value):
+    """
+    The 128 bit integer of a canonical uuid string, anything else as is.
+
+    >>> compact_id('a6d0c1f4-2d44-4e2c-9d6b-2f4e8c7c6a10') >> 96
+    2798698996L
+    >>> compact_id('A6D0C1F4-2D44-4E2C-9D6B-2F4E8C7C6A10')
+    'A6D0C1F4-2D44-4E2C-9D6B-2F4E8C7C6A10'
+    >>> compact_id('public')
+    'public'
+    """
+    if value is not None and len(value) == 36:
+        try:
+            packed = uuid.UUID(value)
+        except ValueError:
+            return value
+        if str(packed) == value:
+            return packed.int
+    return value
+
+
+def expand_id(value):
+    """
+    Undo compact_id.
+
+    >>> expand_id(compact_id('a6d0c1f4-2d44-4e2c-9d6b-2f4e8c7c6a10'))
+    'a6d0c1f4-2d44-4e2c-9d6b-2f4e8c7c6a10'
+    >>> expand_id('public')
+    'public'
+    """
+    if isinstance(value, (int, long)):
+        return str(uuid.UUID(int=value))
+    return value
+
+
+class Interner(object):
+    """
+    Hands out one small integer per distinct id.
+
+    >>> i = Interner()
+    >>> i.intern('a6d0c1f4-2d44-4e2c-9d6b-2f4e8c7c6a10'), i.intern('x')
+    (0, 1)
+    >>> i.intern('a6d0c1f4-2d44-4e2c-9d6b-2f4e8c7c6a10')
+    0
+    >>> i.handle('y') is None, i.value(0), len(i)
+    (True, 'a6d0c1f4-2d44-4e2c-9d6b-2f4e8c7c6a10', 2)
+    """
+    def __init__(self):
+        self.handles = SpillDict()
+        self.values = list()
+
+    def __len__(self):
+        return len(self.values)
+
+    def intern(self, value):
+        key = compact_id(value)
+        handle = self.handles.get(key)
+        if handle is None:
+            handle = len(self.values)
+            self.handles[key] = handle
+            self.values.append(key)
+        return handle
+
+    def handle(self, value):
+        return self.handles.get(compact_id(value))
+
+    def value(self, handle):
+        if handle == NO_HANDLE:
+            return None
+        return expand_id(self.values[handle])
+
+
+class InterfaceCache(object):
+    """
+    What later stages need to know about each melange interface.
+
+    Interfaces, networks and tenants are interned, so per interface only a
+    network handle, a tenant handle and a port flag are stored in arrays.
+    Addresses are kept as (interface handle, compact ip id) pairs. The id
+    lookups and the ip ids can be spilled to disk.
+
+    >>> c = InterfaceCache()
+    >>> c.add_network('if-1', 'net-1'), c.add_network('if-1', 'net-2')
+    ('net-1', 'net-1')
+    >>> c.add_ip('if-1', 'ip-1'); c.add_ip('if-2', 'ip-2')
+    >>> 'if-1' in c, 'if-2' in c, c.network_of('if-1'), c.network_of('if-2')
+    (True, False, 'net-1', None)
+    >>> c.add_port('if-1', 'tenant-1')
+    >>> c.has_port('if-1'), c.tenant_of('if-1'), c.tenant_of('if-2')
+    (True, 'tenant-1', None)
+    >>> list(c.port_ips())
+    [('if-1', 'ip-1')]
+    """
+    def __init__(self):
+        self.interfaces = Interner()
+        self.networks = Interner()
+        self.tenants = Interner()
+        self.network = array.array('i')
+        self.tenant = array.array('i')
+        self.port = bytearray()
+        self.ip_owner = array.array('i')
+        self.ip_ids = SpillList()
+        self.spilled = False
+
+    def __contains__(self, interface_id):
+        return self.network_of(interface_id) is not None
+
+    def __len__(self):
+        return len(self.interfaces) + len(self.ip_ids)
+
+    def spill(self, path):
+        self.interfaces.handles.spill(path + '.interfaces')
+        self.networks.handles.spill(path + '.networks')
+        self.tenants.handles.spill(path + '.tenants')
+        self.ip_ids.spill(path + '.ips')
+        self.spilled = True
+
+    def close(self):
+        for interner in (self.interfaces, self.networks, self.tenants):
+            interner.handles.close()
+        self.ip_ids.close()
+
+    def _handle(self, interface_id):
+        handle = self.interfaces.intern(interface_id)
+        if handle == len(self.network):
+            self.network.append(NO_HANDLE)
+            self.tenant.append(NO_HANDLE)
+            self.port.append(0)
+        return handle
+
+    def add_network(self, interface_id, network_id):
+        """Remember the interface's network, returns the one kept."""
+        handle = self._handle(interface_id)
+        if self.network[handle] == NO_HANDLE:
+            self.network[handle] = self.networks.intern(network_id)
+        return self.networks.value(self.network[handle])
+
+    def network_of(self, interface_id):
+        handle = self.interfaces.handle(interface_id)
+        if handle is None:
+            return None
+        return self.networks.value(self.network[handle])
+
+    def add_ip(self, interface_id, ip_id):
+        self.ip_owner.append(self._handle(interface_id))
+        self.ip_ids.append(compact_id(ip_id))
+
+    def add_port(self, interface_id, tenant_id):
+        handle = self._handle(interface_id)
+        self.port[handle] = 1
+        self.tenant[handle] = self.tenants.intern(tenant_id)
+
+    def has_port(self, interface_id):
+        handle = self.interfaces.handle(interface_id)
+        return handle is not None and self.port[handle] == 1
+
+    def tenant_of(self, interface_id):
+        handle = self.interfaces.handle(interface_id)
+        if handle is None:
+            return None
+        return self.tenants.value(self.tenant[handle])
+
+    def port_ips(self):
+        """(port id, ip id) for every address whose interface became a port.
+        """
+        for owner, ip_id in itertools.izip(self.ip_owner, self.ip_ids):
+            if self.port[owner]:
+                yield self.interfaces.value(owner), expand_id(ip_id)
@@ -0,0 +1,167 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Migrate several environments (regions) at once.
+
+Every environment runs main.py in its own process, so its engines,
+caches, logs and ledgers never mix with another region's:
+
+    python obligate/fleet.py --max-parallel 4 -- --dedupe-policies
+
+Environments are the sections of ~/.mysql_json_bridges, each one needs
+[source_db:ENV] and [destination_db:ENV] in .config. Arguments after --
+are passed to every main.py.
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from utils import get_config
+from utils import get_config_from_file
+from utils import get_log_dir
+from utils import get_option
+
+
+class RegionRun(object):
+    def __init__(self, environment):
+        self.environment = environment
+        self.returncode = None
+        self.error = None
+        self.started = None
+        self.seconds = 0.0
+        self.migrated = 0
+        self.not_migrated = 0
+
+    @property
+    def status(self):
+        if self.error:
+            return self.error
+        if self.returncode is None:
+            return "not run"
+        if self.returncode == 0:
+            return "ok"
+        return "exit {0}".format(self.returncode)
+
+
+def missing_sections(environment):
+    return [s.format(environment)
+            for s in ('source_db:{0}', 'destination_db:{0}')
+            if not get_config().has_section(s.format(environment))]
+
+
+def fleet_environments(requested=None):
+    """The requested environments, or every one in ~/.mysql_json_bridges."""
+    bridges = get_config_from_file()
+    known = bridges.sections() if bridges else []
+    return requested or known, known
+
+
+def count_ledgers(logdir, since):
+    """(migrated, not migrated) summed over the ledgers written since."""
+    migrated = not_migrated = 0
+    for path in glob.glob('{0}/obligate.*.json'.format(logdir)):
+        if os.path.getmtime(path) < since:
+            continue
+        with open(path) as fh:
+            table = json.load(fh)
+        migrated += table['num migrated']
+        not_migrated += sum(1 for entry in table['ids'].itervalues()
+                            if not entry.get('migrated'))
+    return migrated, not_migrated
+
+
+def run_region(run, passthrough, slots):
+    with slots:
+        logdir = get_log_dir(run.environment)
+        command = [sys.executable,
+                   os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'main.py'),
+                   '--environment', run.environment] + passthrough
+        run.started = time.time()
+        with open('{0}/fleet.out'.format(logdir), 'w') as out:
+            run.returncode = subprocess.call(command, stdout=out,
+                                             stderr=subprocess.STDOUT)
+        run.seconds = time.time() - run.started
+        run.migrated, run.not_migrated = count_ledgers(logdir, run.started)
+
+
+def summary(runs):
+    """
+    The end of run table.
+
+    >>> a, b = RegionRun('ord'), RegionRun('dfw')
+    >>> a.returncode, a.seconds, a.migrated = 0, 3725.2, 120000
+    >>> b.error = 'no [source_db:dfw]'
+    >>> print summary([a, b])
+    environment  status              duration    migrated  not migrated
+    ord          ok                  01:02:05      120000             0
+    dfw          no [source_db:dfw]  00:00:00           0             0
+    """
+    lines = ["{0:<12} {1:<18} {2:>9} {3:>11} {4:>13}".format(
+        'environment', 'status', 'duration', 'migrated', 'not migrated')]
+    for run in runs:
+        minutes, seconds = divmod(int(run.seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        lines.append("{0:<12} {1:<18} {2:>9} {3:>11} {4:>13}".format(
+            run.environment, run.status,
+            "{0:02d}:{1:02d}:{2:02d}".format(hours, minutes, seconds),
+            run.migrated, run.not_migrated))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Migrate several environments from Melange to Quark.')
+    parser.add_argument('environments', nargs='*', metavar='ENV',
+                        help='Environments to migrate, defaults to every '
+                             'section of ~/.mysql_json_bridges.')
+    parser.add_argument('--max-parallel', type=int, dest='max_parallel',
+                        default=int(get_option('fleet', 'max_parallel', 4)),
+                        help='Regions migrated at the same time.')
+    parser.add_argument('passthrough', nargs=argparse.REMAINDER,
+                        help='-- then arguments for every main.py run.')
+    arguments = parser.parse_args()
+    passthrough = [a for a in arguments.passthrough if a != '--']
+    environments, known = fleet_environments(arguments.environments)
+    if not environments:
+        parser.error('no environments in ~/.mysql_json_bridges')
+    runs = list()
+    threads = list()
+    slots = threading.BoundedSemaphore(max(1, arguments.max_parallel))
+    for environment in environments:
+        run = RegionRun(environment)
+        runs.append(run)
+        missing = missing_sections(environment)
+        if environment not in known:
+            run.error = 'no bridge section'
+        elif missing:
+            run.error = 'no [{0}]'.format(missing[0])
+        else:
+            thread = threading.Thread(target=run_region,
+                                      args=(run, passthrough, slots))
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+    print summary(runs)
+    return 0 if all(run.status == 'ok' for run in runs) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
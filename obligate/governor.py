@@ -0,0 +1,251 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import marshal
+import os
+import shelve
+import shutil
+import tempfile
+import UserDict
+
+from batching import current_rss_mb
+
+glog = logging.getLogger('obligate.governor')
+
+
+class SpillDict(UserDict.DictMixin):
+    """
+    A dict that can move itself into an on-disk shelf.
+
+    Once spilled every key is stored as str(key). Values are copies on
+    disk, so update nested values by assigning them back.
+
+    >>> import os, tempfile
+    >>> d = SpillDict()
+    >>> d['a'] = {'migrated': False}
+    >>> d[1] = 2
+    >>> d.spilled
+    False
+    >>> path = os.path.join(tempfile.mkdtemp(), 'ledger')
+    >>> d.spill(path)
+    >>> d.spilled, len(d), d['a'], d[1], 'b' in d, d.get('b', 3)
+    (True, 2, {'migrated': False}, 2, False, 3)
+    >>> d['b'] = 4
+    >>> sorted(d.iteritems())
+    [('1', 2), ('a', {'migrated': False}), ('b', 4)]
+    >>> d.close()
+    """
+    def __init__(self):
+        self.data = dict()
+        self.spilled = False
+
+    def _key(self, key):
+        if self.spilled:
+            return str(key)
+        return key
+
+    def __getitem__(self, key):
+        return self.data[self._key(key)]
+
+    def __setitem__(self, key, value):
+        self.data[self._key(key)] = value
+
+    def __delitem__(self, key):
+        del self.data[self._key(key)]
+
+    def __contains__(self, key):
+        return self._key(key) in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data.keys())
+
+    def keys(self):
+        return list(self.data.keys())
+
+    def iteritems(self):
+        for key in self:
+            yield key, self.data[key]
+
+    def get(self, key, default=None):
+        key = self._key(key)
+        if key in self.data:
+            return self.data[key]
+        return default
+
+    def spill(self, path):
+        if self.spilled:
+            return
+        shelf = shelve.open(path, flag='n', protocol=2)
+        for key, value in self.data.iteritems():
+            shelf[str(key)] = value
+        self.data = shelf
+        self.spilled = True
+
+    def close(self):
+        if self.spilled:
+            self.data.close()
+
+
+class SpillList(object):
+    """
+    An append-only list that can move itself into a file.
+
+    >>> import os, tempfile
+    >>> l = SpillList()
+    >>> l.append(1); l.append(2L)
+    >>> l.spill(os.path.join(tempfile.mkdtemp(), 'ips'))
+    >>> l.append('three')
+    >>> len(l), list(l)
+    (3, [1, 2L, 'three'])
+    >>> l.close()
+    """
+    def __init__(self):
+        self.items = list()
+        self.fh = None
+        self.count = 0
+        self.spilled = False
+
+    def __len__(self):
+        return self.count
+
+    def append(self, item):
+        self.count += 1
+        if self.spilled:
+            marshal.dump(item, self.fh)
+        else:
+            self.items.append(item)
+
+    def __iter__(self):
+        if not self.spilled:
+            return iter(self.items)
+        return self._read()
+
+    def _read(self):
+        self.fh.flush()
+        with open(self.fh.name, 'rb') as fh:
+            for i in xrange(self.count):
+                yield marshal.load(fh)
+
+    def spill(self, path):
+        if self.spilled:
+            return
+        self.fh = open(path, 'wb')
+        for item in self.items:
+            marshal.dump(item, self.fh)
+        self.items = list()
+        self.spilled = True
+
+    def close(self):
+        if self.fh:
+            self.fh.close()
+
+
+class MemoryGovernor(object):
+    """Samples RSS while the migration runs and spills maps when needed.
+
+    Maps are registered by name and need __len__, spill(path), close()
+    and a `spilled` flag. When a sample is at or over `budget_mb` the
+    largest map still in memory is moved into `spill_dir`. Lookups become
+    slower afterwards, but the run keeps going instead of swapping until
+    it hangs.
+
+    Freed memory seldom goes back to the OS, so after a spill the next one
+    waits for RSS to grow by `step_mb` (a tenth of the budget) over the
+    level of the last, or for a commit to rearm() the budget.
+
+    >>> levels = [90, 101, 103, 105, 112, 113, 101]
+    >>> g = MemoryGovernor(100, None, rss=lambda: levels.pop(0))
+    >>> spills = []
+    >>> g.spill_largest = spills.append
+    >>> for i in range(6):
+    ...     rss = g.sample()
+    >>> spills, g.threshold_mb
+    ([101, 112], 122.0)
+    >>> g.rearm(); rss = g.sample(); spills
+    [101, 112, 101]
+    """
+    def __init__(self, budget_mb, spill_dir, interval=5000,
+                 rss=current_rss_mb):
+        self.budget_mb = budget_mb
+        self.spill_dir = spill_dir
+        self.interval = interval
+        self.rss = rss
+        self.maps = list()
+        self.ticks = 0
+        self.peak_mb = 0.0
+        self.window_peak_mb = 0.0
+        self.tmpdir = None
+        self.step_mb = budget_mb / 10.0 if budget_mb else None
+        self.threshold_mb = budget_mb
+        self.exhausted = False
+
+    def register(self, name, spillable):
+        self.maps.append((name, spillable))
+
+    def check(self):
+        """Cheap per-row hook, samples every `interval` calls."""
+        self.ticks += 1
+        if self.ticks % self.interval == 0:
+            self.sample()
+
+    def start_window(self):
+        """Track the peak from here on in window_peak_mb as well."""
+        self.window_peak_mb = 0.0
+
+    def sample(self):
+        rss = self.rss()
+        self.peak_mb = max(self.peak_mb, rss)
+        self.window_peak_mb = max(self.window_peak_mb, rss)
+        if self.budget_mb and rss >= self.threshold_mb:
+            self.threshold_mb = rss + self.step_mb
+            self.spill_largest(rss)
+        return rss
+
+    def rearm(self):
+        """Spill again as soon as RSS is over budget, after a commit has
+        freed the rows it held."""
+        self.threshold_mb = self.budget_mb
+
+    def spill_largest(self, rss):
+        in_memory = [(len(spillable), name, spillable)
+                     for name, spillable in self.maps
+                     if not spillable.spilled]
+        if not in_memory:
+            if not self.exhausted:
+                glog.warning("RSS {0:.0f}M over budget of {1}M, nothing "
+                             "left to spill.".format(rss, self.budget_mb))
+                self.exhausted = True
+            return None
+        size, name, spillable = max(in_memory)
+        if self.tmpdir is None:
+            if not os.path.exists(self.spill_dir):
+                os.makedirs(self.spill_dir)
+            self.tmpdir = tempfile.mkdtemp(prefix='spill.',
+                                           dir=self.spill_dir)
+        glog.warning("RSS {0:.0f}M over budget of {1}M, spilling {2} "
+                     "({3} entries) to disk.".format(rss, self.budget_mb,
+                                                     name, size))
+        spillable.spill(os.path.join(self.tmpdir, name.replace(' ', '_')))
+        return name
+
+    def close(self):
+        for name, spillable in self.maps:
+            spillable.close()
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
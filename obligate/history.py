@@ -0,0 +1,285 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Every migration's metrics, kept in a sqlite database.
+
+Runs are keyed by the code that ran (obligate's git revision and quark's
+version) and by the data they ran on (a fingerprint of the dataset), so
+two builds can be compared on the same data:
+
+    python obligate/history.py list
+    python obligate/history.py compare --threshold 0.1
+
+compare exits 1 when a stage of the candidate build is slower (or
+writes fewer rows per second, or peaks higher) than the baseline build
+by more than the threshold.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+from utils import get_basepath
+from utils import get_settings
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    recorded TEXT,
+    revision TEXT,
+    quark_version TEXT,
+    dataset TEXT,
+    environment TEXT,
+    wall_seconds REAL,
+    peak_rss_mb REAL,
+    report TEXT
+);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id INTEGER REFERENCES runs (id),
+    stage TEXT,
+    wall_seconds REAL,
+    rows_per_second REAL,
+    peak_rss_mb REAL,
+    sql_statements INTEGER,
+    commits INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_by_dataset ON runs (dataset, revision);
+"""
+
+
+def code_revision():
+    """obligate's git revision, with +dirty for uncommitted changes."""
+    try:
+        git = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                               cwd=get_basepath(), stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+        revision = git.communicate()[0].strip()
+        if git.returncode:
+            return 'unknown'
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'],
+                                cwd=get_basepath())
+    except OSError:
+        return 'unknown'
+    return revision + ('+dirty' if dirty else '')
+
+
+def quark_version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('quark').version
+    except Exception:
+        return 'unknown'
+
+
+def dataset_fingerprint(rows_read):
+    """
+    Identifies the melange a run read by the rows it read from each table.
+
+    >>> dataset_fingerprint({'ip_blocks': 2, 'ip_addresses': 400})
+    'rows:dac0c12662f8'
+    """
+    counts = json.dumps(sorted(rows_read.items()))
+    return 'rows:' + hashlib.sha1(counts).hexdigest()[:12]
+
+
+def connect(path=None):
+    path = path or get_settings().history_path
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    db = sqlite3.connect(path)
+    db.executescript(schema)
+    return db
+
+
+def record(report, dataset, revision=None, path=None):
+    """Append a RunMetrics report to the history, returns the run id."""
+    db = connect(path)
+    try:
+        with db:
+            cursor = db.execute(
+                "INSERT INTO runs (recorded, revision, quark_version, "
+                "dataset, environment, wall_seconds, peak_rss_mb, report) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (datetime.datetime.utcnow().isoformat(),
+                 revision or code_revision(), quark_version(), dataset,
+                 report.get('environment'), report['wall_seconds'],
+                 report['peak_rss_mb'], json.dumps(report, sort_keys=True)))
+            run_id = cursor.lastrowid
+            db.executemany(
+                "INSERT INTO stages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, s['stage'], s['wall_seconds'],
+                  s['rows_per_second'], s['peak_rss_mb'],
+                  s['sql_statements'], s['commits'])
+                 for s in report['stages']])
+    finally:
+        db.close()
+    return run_id
+
+
+def build_of(row):
+    return '{0} quark {1}'.format(row[0], row[1])
+
+
+def stage_medians(db, dataset, revision, quark):
+    """stage: (seconds, rows/s, peak MB), medians over the build's runs."""
+    rows = db.execute(
+        "SELECT s.stage, s.wall_seconds, s.rows_per_second, s.peak_rss_mb "
+        "FROM stages s JOIN runs r ON s.run_id = r.id "
+        "WHERE r.dataset = ? AND r.revision = ? AND r.quark_version = ?",
+        (dataset, revision, quark)).fetchall()
+    samples = dict()
+    for stage, seconds, rate, peak in rows:
+        samples.setdefault(stage, []).append((seconds, rate, peak))
+    return dict((stage, tuple(median([v[i] for v in values])
+                              for i in range(3)))
+                for stage, values in samples.iteritems())
+
+
+def median(values):
+    """
+    >>> median([3, 1, 2]), median([4, 1, 2, 3])
+    (2, 2.5)
+    """
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+def regressions(baseline, candidate, threshold, min_seconds=1.0):
+    """
+    (stage, what, baseline, candidate) for every stage of the candidate
+    worse than the baseline by more than threshold. Stages shorter than
+    min_seconds in both are noise and only checked for memory.
+
+    >>> regressions({'ips': (10.0, 100.0, 500.0)},
+    ...             {'ips': (12.0, 80.0, 505.0)}, 0.1)
+    [('ips', 'seconds', 10.0, 12.0), ('ips', 'rows/s', 100.0, 80.0)]
+    """
+    found = list()
+    for stage in sorted(candidate):
+        if stage not in baseline:
+            continue
+        (b_seconds, b_rate, b_peak) = baseline[stage]
+        (c_seconds, c_rate, c_peak) = candidate[stage]
+        if max(b_seconds, c_seconds) >= min_seconds:
+            if c_seconds > b_seconds * (1 + threshold):
+                found.append((stage, 'seconds', b_seconds, c_seconds))
+            if c_rate < b_rate * (1 - threshold):
+                found.append((stage, 'rows/s', b_rate, c_rate))
+        if c_peak > b_peak * (1 + threshold):
+            found.append((stage, 'peak MB', b_peak, c_peak))
+    return found
+
+
+def latest_builds(db, dataset):
+    """(revision, quark version) that ran on dataset, newest first."""
+    builds = list()
+    for row in db.execute("SELECT revision, quark_version FROM runs "
+                          "WHERE dataset = ? ORDER BY id DESC", (dataset,)):
+        if row not in builds:
+            builds.append(row)
+    return builds
+
+
+def compare(db, arguments):
+    dataset = arguments.dataset
+    if dataset is None:
+        row = db.execute("SELECT dataset FROM runs ORDER BY id DESC "
+                         "LIMIT 1").fetchone()
+        if row is None:
+            print "No runs recorded."
+            return 1
+        dataset = row[0]
+    builds = latest_builds(db, dataset)
+
+    def pick(revision, default):
+        if revision is None:
+            return default
+        for build in builds:
+            if build[0].startswith(revision):
+                return build
+        return None
+    candidate = pick(arguments.candidate, builds[0] if builds else None)
+    others = [b for b in builds if b != candidate]
+    baseline = pick(arguments.baseline, others[0] if others else None)
+    if candidate is None or baseline is None:
+        print "Need runs of two builds on dataset {0}, have: {1}".format(
+            dataset, ', '.join(build_of(b) for b in builds) or 'none')
+        return 1
+    found = regressions(stage_medians(db, dataset, *baseline),
+                        stage_medians(db, dataset, *candidate),
+                        arguments.threshold)
+    print "dataset {0}: {1} (baseline) vs {2}".format(
+        dataset, build_of(baseline), build_of(candidate))
+    for stage, what, before, after in found:
+        print "REGRESSED {0:<40} {1:<8} {2:>12.2f} -> {3:>12.2f}".format(
+            stage, what, before, after)
+    if not found:
+        print "No stage regressed more than {0:.0%}.".format(
+            arguments.threshold)
+    return 1 if found else 0
+
+
+def list_runs(db, arguments):
+    print "{0:>5} {1:<20} {2:<16} {3:<12} {4:<18} {5:>10} {6:>9}".format(
+        'run', 'recorded', 'revision', 'quark', 'dataset', 'seconds',
+        'peak MB')
+    for row in db.execute("SELECT id, recorded, revision, quark_version, "
+                          "dataset, wall_seconds, peak_rss_mb FROM runs "
+                          "ORDER BY id DESC LIMIT ?", (arguments.limit,)):
+        print ("{0:>5} {1:<20} {2:<16} {3:<12} {4:<18} {5:>10.1f} "
+               "{6:>9.1f}".format(row[0], row[1][:19], *row[2:]))
+    return 0
+
+
+def main():
+    settings = get_settings()
+    parser = argparse.ArgumentParser(
+        description='Migration performance history.')
+    parser.add_argument('--history', default=settings.history_path,
+                        help='History database (default: {0}).'.format(
+                            settings.history_path))
+    commands = parser.add_subparsers()
+    runs = commands.add_parser('list', help='Show the latest runs.')
+    runs.add_argument('--limit', type=int, default=20)
+    runs.set_defaults(command=list_runs)
+    gate = commands.add_parser(
+        'compare', help='Exit 1 if a build regressed against another.')
+    gate.add_argument('--dataset', help='Dataset fingerprint, defaults to '
+                                        'the one of the latest run.')
+    gate.add_argument('--baseline', help='Revision to compare against, '
+                                         'defaults to the build before.')
+    gate.add_argument('--candidate', help='Revision to check, defaults to '
+                                          'the latest build.')
+    gate.add_argument('--threshold', type=float,
+                      default=settings.regression_threshold,
+                      help='Allowed slowdown, 0.1 is 10%%.')
+    gate.set_defaults(command=compare)
+    arguments = parser.parse_args()
+    db = connect(arguments.history)
+    try:
+        return arguments.command(db, arguments)
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
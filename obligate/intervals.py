@@ -0,0 +1,212 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import bisect
+import heapq
+
+
+def merge_ranges(ranges):
+    """
+    Sort and merge (start, end) ranges, end exclusive. Overlapping and
+    touching ranges are joined, empty ones dropped.
+
+    >>> merge_ranges([(6, 9), (3, 6), (12, 12), (20, 15)])
+    [(3, 9)]
+
+    >>> merge_ranges([(1, 12), (1, 9), (16, 25), (12, 13)])
+    [(1, 13), (16, 25)]
+
+    >>> merge_ranges([(2 ** 127, 2 ** 128), (0, 2 ** 127)]) == [(0, 2 ** 128)]
+    True
+    """
+    merged = list()
+    for start, end in sorted(r for r in ranges if r[1] > r[0]):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class IntervalSet(object):
+    """
+    A set of integers stored as sorted, disjoint (start, end) ranges.
+
+    Every operation works on the ranges, never on their members, so it
+    costs O(n log n) in the number of ranges whatever their length. Python
+    integers make IPv6 sized offsets safe.
+
+    >>> s = IntervalSet([(5, 15), (11, 31)]) | IntervalSet.from_points([4])
+    >>> s
+    IntervalSet([(4, 31)])
+    >>> s - IntervalSet([(10, 12), (30, 40)])
+    IntervalSet([(4, 10), (12, 30)])
+    >>> 4 in s, 31 in s, s.covers(5, 31), s.covers(3, 6)
+    (True, False, True, False)
+    >>> s.size(), len(s)
+    (27, 1)
+    >>> IntervalSet.from_offset_lengths([(255, 1), (-1, 2)]).offset_lengths()
+    [(-1, 2), (255, 1)]
+    """
+    def __init__(self, ranges=()):
+        self._ranges = merge_ranges(ranges)
+        self._starts = [r[0] for r in self._ranges]
+
+    @classmethod
+    def from_points(cls, points):
+        return cls((p, p + 1) for p in points)
+
+    @classmethod
+    def from_offset_lengths(cls, offset_lengths):
+        return cls((o, o + l) for o, l in offset_lengths)
+
+    def __repr__(self):
+        return "IntervalSet({0!r})".format(self._ranges)
+
+    def __len__(self):
+        """The number of ranges, see size() for the number of members."""
+        return len(self._ranges)
+
+    def __iter__(self):
+        return iter(self._ranges)
+
+    def __eq__(self, other):
+        return isinstance(other, IntervalSet) and \
+            self._ranges == other._ranges
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __contains__(self, value):
+        i = bisect.bisect_right(self._starts, value) - 1
+        return i >= 0 and value < self._ranges[i][1]
+
+    def covers(self, start, end):
+        """True if all of [start, end) is in the set."""
+        i = bisect.bisect_right(self._starts, start) - 1
+        return i >= 0 and end <= self._ranges[i][1]
+
+    def size(self):
+        return sum(end - start for start, end in self._ranges)
+
+    def ranges(self):
+        return list(self._ranges)
+
+    def offset_lengths(self):
+        return [(start, end - start) for start, end in self._ranges]
+
+    def union(self, other):
+        return IntervalSet(self._ranges + list(other))
+
+    __or__ = union
+
+    def difference(self, other):
+        others = list(IntervalSet(other))
+        result = list()
+        i = 0
+        for start, end in self._ranges:
+            while i < len(others) and others[i][1] <= start:
+                i += 1
+            j = i
+            while j < len(others) and others[j][0] < end:
+                if others[j][0] > start:
+                    result.append((start, others[j][0]))
+                start = max(start, others[j][1])
+                j += 1
+            if start < end:
+                result.append((start, end))
+        return IntervalSet(result)
+
+    __sub__ = difference
+
+
+class IntervalIndex(object):
+    """
+    Labelled (start, end, label) ranges, end exclusive, looked up by
+    binary search.
+
+    Ranges may nest and overlap: they are cut once into disjoint
+    segments, each labelled with the innermost range covering it (the
+    one starting last, and of those the one ending first).
+
+    >>> idx = IntervalIndex([(10, 20, 'a'), (0, 5, 'b'), (18, 30, 'c')])
+    >>> idx.find(12), idx.find(4), idx.find(7), idx.find(30)
+    ('a', 'b', None, None)
+    >>> idx.overlaps()
+    [((10, 20, 'a'), (18, 30, 'c'))]
+    >>> nested = IntervalIndex([(0, 100, 'a'), (10, 20, 'b')])
+    >>> nested.find(5), nested.find(15), nested.find(50), nested.find(100)
+    ('a', 'b', 'a', None)
+    """
+    def __init__(self, ranges=()):
+        self._ranges = sorted(r for r in ranges if r[1] > r[0])
+        self._segments = self._cut(self._ranges)
+        self._starts = [s[0] for s in self._segments]
+
+    @staticmethod
+    def _cut(ranges):
+        points = sorted(set(p for r in ranges for p in r[:2]))
+        segments = list()
+        # covering ranges, latest start on top; ended ones are dropped
+        # when they surface
+        covering = list()
+        i = 0
+        for start, end in zip(points, points[1:]):
+            while i < len(ranges) and ranges[i][0] <= start:
+                heapq.heappush(covering, (-ranges[i][0], i))
+                i += 1
+            while covering and ranges[covering[0][1]][1] <= start:
+                heapq.heappop(covering)
+            if not covering:
+                continue
+            label = ranges[covering[0][1]][2]
+            if segments and segments[-1][1] == start and \
+                    segments[-1][2] == label:
+                segments[-1] = (segments[-1][0], end, label)
+            else:
+                segments.append((start, end, label))
+        return segments
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def __iter__(self):
+        return iter(self._ranges)
+
+    def find(self, value):
+        """The label of the innermost range holding `value`, None if there
+        is none."""
+        i = bisect.bisect_right(self._starts, value) - 1
+        if i >= 0 and value < self._segments[i][1]:
+            return self._segments[i][2]
+        return None
+
+    def overlaps(self):
+        """
+        Every range overlapping an earlier one, paired with the earlier
+        range reaching furthest.
+
+        >>> IntervalIndex([(0, 100, 'A'), (10, 20, 'B'),
+        ...                (30, 40, 'C')]).overlaps()
+        [((0, 100, 'A'), (10, 20, 'B')), ((0, 100, 'A'), (30, 40, 'C'))]
+        """
+        found = list()
+        furthest = None
+        for r in self._ranges:
+            if furthest is not None and r[0] < furthest[1]:
+                found.append((furthest, r))
+            if furthest is None or r[1] > furthest[1]:
+                furthest = r
+        return found
@@ -1,23 +1,135 @@
 import argparse
+import sys
 from obligate import Obligator
-from utils import clear_logs, loadSession, start_logging
+from scope import MigrationScope, parse_ids
+from planner import make_plan
+from stages import select_stages
+from throttle import Throttle
+from utils import clear_logs, done, get_settings, loadSession, start_logging
+from utils import connect_bridges, total_ram_mb
 from models import melange, neutron
 
 
+def plan(arguments, melange_session, scope, settings):
+    stages = select_stages(parse_ids(arguments.tables) or
+                           settings.migrate_tables)
+    # counting a live melange is paced like a migration's reads
+    throttle = Throttle.from_config(arguments.environment)
+    nova_throttle = bridge_throttle = None
+    if throttle.enabled:
+        throttle.watch(melange_session.bind)
+        nova_throttle = Throttle.from_config(arguments.environment)
+        bridge_throttle = Throttle.from_config(arguments.environment)
+    bridges = None
+    try:
+        bridges = connect_bridges(arguments.environment,
+                                  nova_throttle=nova_throttle,
+                                  melange_throttle=bridge_throttle)
+    except Exception as e:
+        print "Planning without the bridges: {0}".format(e)
+    try:
+        ram_mb = total_ram_mb()
+    except Exception:
+        ram_mb = None
+    print make_plan(melange_session, stages, scope, settings,
+                    bridges=bridges, ram_mb=ram_mb,
+                    environment=arguments.environment).report()
+
+
 def main():
+    settings = get_settings()
     parser = argparse.ArgumentParser(description='Migrate from Melange to Quark.')  # noqa
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
-                        help='Log to stdout and to file.', dest='verbose')
+                        help='Log to stdout and to file, and show the '
+                             'progress of the running stage.',
+                        dest='verbose')
     parser.add_argument('-c', '--clear', action='store_true', default=False,
                         help='Clear logs before running.', dest='clearlogs')
+    parser.add_argument('--dedupe-policies', action='store_true',
+                        default=settings.dedupe_policies,
+                        dest='dedupe_policies',
+                        help='Create one quark policy per melange policy '
+                             'and tenant, shared by all its subnets.')
+    parser.add_argument('--tenant', action='append', dest='tenants',
+                        metavar='TENANT_ID',
+                        help='Only migrate these tenants (repeat or comma '
+                             'separate). Rows are appended to quark, it is '
+                             'not flushed.')
+    parser.add_argument('--network', action='append', dest='networks',
+                        metavar='NETWORK_ID',
+                        help='Only migrate these networks (repeat or comma '
+                             'separate). With --tenant, only the networks '
+                             'of those tenants. Rows are appended to quark, '
+                             'it is not flushed.')
+    parser.add_argument('--tables', action='append', dest='tables',
+                        metavar='NAME',
+                        help='Only run the stages writing these tables or '
+                             'stages (repeat or comma separate), plus the '
+                             'stages depending on them. Defaults to '
+                             '[migration] tables in .config.')
+    parser.add_argument('--upsert', action='store_const', const='upsert',
+                        default=settings.write_mode, dest='write_mode',
+                        help='Write over what quark already has instead of '
+                             'emptying it first. Reruns only change the '
+                             'rows that differ.')
+    parser.add_argument('--prometheus-textfile', dest='metrics_textfile',
+                        metavar='PATH',
+                        help='Also write the per-stage metrics as a '
+                             'Prometheus textfile. The JSON report is '
+                             'always written next to the logs.')
+    parser.add_argument('--profile-sql', dest='sql_profile', type=int,
+                        nargs='?', const=20, metavar='N',
+                        help='Time every SQL statement and print the N '
+                             '(default 20) most expensive statement shapes '
+                             'per stage at the end.')
+    parser.add_argument('--profile-stage', action='append',
+                        dest='profile_stages', metavar='NAME',
+                        help='Run this stage under cProfile and write its '
+                             'pstats next to the logs (repeat or comma '
+                             'separate). Only the thread running the stage '
+                             'is profiled, not the writer threads.')
+    parser.add_argument('--trace-alloc', action='append',
+                        dest='trace_stages', metavar='NAME',
+                        help='Trace the allocations of this stage and write '
+                             'its top allocators next to the logs (needs '
+                             'tracemalloc).')
+    parser.add_argument('--plan', action='store_true', default=False,
+                        help='Only count melange and the bridges and print '
+                             'the quark rows, stage durations and peak '
+                             'memory a migration would take. Nothing is '
+                             'written.')
+    parser.add_argument('--environment', dest='environment',
+                        help='Migrate this environment: bridges from '
+                             '~/.mysql_json_bridges, databases from '
+                             '[source_db:ENV] and [destination_db:ENV] in '
+                             '.config, logs under logs/ENV.')
     arguments = parser.parse_args()
-    start_logging(verbose=arguments.verbose)
+    start_logging(verbose=arguments.verbose,
+                  environment=arguments.environment)
     if arguments.clearlogs:
         clear_logs()
-    melange_session = loadSession(melange.engine)
-    neutron_session = loadSession(neutron.engine)
-    migration = Obligator(melange_session, neutron_session)
+    melange_session = loadSession(melange.get_engine(arguments.environment))
+    neutron_session = loadSession(neutron.get_engine(arguments.environment))
+    scope = MigrationScope(tenant_ids=parse_ids(arguments.tenants),
+                           network_ids=parse_ids(arguments.networks))
+    if arguments.plan:
+        plan(arguments, melange_session, scope, settings)
+        done()
+        return 0
+    migration = Obligator(melange_session, neutron_session,
+                          dedupe_policies=arguments.dedupe_policies,
+                          scope=scope,
+                          tables=parse_ids(arguments.tables) or None,
+                          environment=arguments.environment,
+                          write_mode=arguments.write_mode,
+                          metrics_textfile=arguments.metrics_textfile,
+                          sql_profile=arguments.sql_profile,
+                          profile_stages=parse_ids(arguments.profile_stages),
+                          trace_stages=parse_ids(arguments.trace_stages),
+                          progress_console=arguments.verbose)
     migration.migrate()
+    done()
+    return 0 if migration.error_free else 1
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,220 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Per-stage numbers of a migration run.
+
+Every step do_and_time runs becomes a StageMetrics: wall and cpu time,
+melange rows read per table, quark rows written per table, commits, SQL
+statements and peak RSS. The run is saved as a JSON report next to the
+logs and, if asked for, as a Prometheus textfile (node_exporter's
+textfile collector picks those up).
+"""
+import datetime
+import json
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+# the run rows read from melange are counted against, see count_read
+_active = None
+
+
+def count_read(table, rows):
+    """Called by readers with the rows they got from a melange table."""
+    if _active is not None:
+        _active.count_read(table, rows)
+
+
+def cpu_seconds():
+    # user + system time of every thread of the process
+    times = os.times()
+    return times[0] + times[1]
+
+
+def diff_counts(after, before):
+    """
+    >>> diff_counts({'a': 5, 'b': 2, 'c': 1}, {'a': 3, 'c': 1})
+    {'a': 2, 'b': 2}
+    """
+    return dict((key, value - before.get(key, 0))
+                for key, value in after.iteritems()
+                if value - before.get(key, 0))
+
+
+class StageMetrics(object):
+    def __init__(self, name):
+        self.name = name
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.rows_read = dict()
+        self.rows_written = dict()
+        self.commits = 0
+        self.statements = 0
+        self.peak_rss_mb = 0.0
+        self.error = None
+        self._before = None
+
+    def rows_per_second(self):
+        """Rows written per second, rows read for stages writing none."""
+        rows = sum(self.rows_written.values()) or \
+            sum(self.rows_read.values())
+        if not self.wall_seconds:
+            return 0.0
+        return rows / self.wall_seconds
+
+    def as_dict(self):
+        return {'stage': self.name,
+                'wall_seconds': round(self.wall_seconds, 3),
+                'cpu_seconds': round(self.cpu_seconds, 3),
+                'rows_read': self.rows_read,
+                'rows_written': self.rows_written,
+                'rows_per_second': round(self.rows_per_second(), 1),
+                'commits': self.commits,
+                'sql_statements': self.statements,
+                'peak_rss_mb': round(self.peak_rss_mb, 1),
+                'error': self.error}
+
+
+class RunMetrics(object):
+    """Collects StageMetrics for one run.
+
+    start() and stop() bracket a stage. Rows written and commits are
+    snapshots of the caller's running totals, rows read come through
+    count_read() and SQL statements from the engines passed to watch().
+    """
+    def __init__(self, environment=None):
+        self.environment = environment
+        self.started = datetime.datetime.utcnow()
+        self.stages = list()
+        self.rows_read = dict()
+        self.statements = 0
+        self.lock = threading.Lock()
+
+    def activate(self):
+        global _active
+        _active = self
+
+    def watch(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._statement)
+
+    def _statement(self, *args):
+        # writer threads share the neutron engine
+        with self.lock:
+            self.statements += 1
+
+    def count_read(self, table, rows):
+        with self.lock:
+            self.rows_read[table] = self.rows_read.get(table, 0) + rows
+
+    def start(self, name, written=None, commits=0):
+        stage = StageMetrics(name)
+        stage._before = (time.time(), cpu_seconds(), dict(self.rows_read),
+                         dict(written or {}), commits, self.statements)
+        return stage
+
+    def stop(self, stage, written=None, commits=0, peak_rss_mb=0.0,
+             error=None):
+        wall, cpu, read, before_written, before_commits, statements = \
+            stage._before
+        stage.wall_seconds = time.time() - wall
+        stage.cpu_seconds = cpu_seconds() - cpu
+        stage.rows_read = diff_counts(self.rows_read, read)
+        stage.rows_written = diff_counts(written or {}, before_written)
+        stage.commits = commits - before_commits
+        stage.statements = self.statements - statements
+        stage.peak_rss_mb = peak_rss_mb
+        stage.error = error
+        self.stages.append(stage)
+        return stage
+
+    def wall_seconds(self):
+        return sum(stage.wall_seconds for stage in self.stages)
+
+    def report(self):
+        return {'environment': self.environment,
+                'started': self.started.isoformat(),
+                'wall_seconds': round(self.wall_seconds(), 3),
+                'peak_rss_mb': max([s.peak_rss_mb for s in self.stages] or
+                                   [0.0]),
+                'stages': [stage.as_dict() for stage in self.stages]}
+
+    def dump(self, logdir):
+        """Write the JSON report into logdir, returns its path."""
+        path = '{0}/metrics.{1}.json'.format(
+            logdir, self.started.strftime('%Y%m%dT%H%M%S'))
+        with open(path, 'w') as fh:
+            json.dump(self.report(), fh, indent=2, sort_keys=True)
+        return path
+
+    def textfile(self):
+        """
+        The run in Prometheus' text format.
+
+        >>> run = RunMetrics('ord')
+        >>> stage = StageMetrics('macs')
+        >>> stage.wall_seconds, stage.rows_written = 2.0, {'quark_macs': 10}
+        >>> run.stages.append(stage)
+        >>> print run.textfile()  # doctest: +ELLIPSIS
+        # HELP obligate_stage_wall_seconds Wall clock time of the stage.
+        # TYPE obligate_stage_wall_seconds gauge
+        obligate_stage_wall_seconds{environment="ord",stage="macs"} 2.0
+        ...
+        obligate_stage_rows_written{environment="ord",stage="macs",\
+table="quark_macs"} 10
+        ...
+        """
+        gauges = [
+            ('wall_seconds', 'Wall clock time of the stage.',
+             lambda s: [({}, s.wall_seconds)]),
+            ('cpu_seconds', 'CPU time of the stage, all threads.',
+             lambda s: [({}, s.cpu_seconds)]),
+            ('rows_read', 'Melange rows read.',
+             lambda s: [({'table': t}, n)
+                        for t, n in sorted(s.rows_read.items())]),
+            ('rows_written', 'Quark rows written.',
+             lambda s: [({'table': t}, n)
+                        for t, n in sorted(s.rows_written.items())]),
+            ('rows_per_second', 'Rows written (or read) per second.',
+             lambda s: [({}, s.rows_per_second())]),
+            ('commits', 'Transactions committed.',
+             lambda s: [({}, s.commits)]),
+            ('sql_statements', 'SQL statements executed.',
+             lambda s: [({}, s.statements)]),
+            ('peak_rss_mb', 'Peak sampled RSS in megabytes.',
+             lambda s: [({}, s.peak_rss_mb)]),
+        ]
+        lines = list()
+        for name, help, samples in gauges:
+            metric = 'obligate_stage_{0}'.format(name)
+            lines.append('# HELP {0} {1}'.format(metric, help))
+            lines.append('# TYPE {0} gauge'.format(metric))
+            for stage in self.stages:
+                for extra, value in samples(stage):
+                    labels = [('environment', self.environment or ''),
+                              ('stage', stage.name)] + sorted(extra.items())
+                    lines.append('{0}{{{1}}} {2}'.format(
+                        metric,
+                        ','.join('{0}="{1}"'.format(k, v.replace('"', "'"))
+                                 for k, v in labels),
+                        value))
+        return '\n'.join(lines)
+
+    def write_textfile(self, path):
+        # renamed into place so a collector never reads half a file
+        with open(path + '.tmp', 'w') as fh:
+            fh.write(self.textfile() + '\n')
+        os.rename(path + '.tmp', path)
@@ -0,0 +1,239 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Microbenchmarks of the utils functions obligate calls per row or per
+policy.
+
+Every case runs at a few input sizes. Two things are checked:
+
+  * how the time grows with the size. Each case knows the growth it
+    should have (1: linear in the rows, 0: independent of a range's
+    width); a case growing faster is an algorithmic regression, on any
+    machine.
+  * the time per call against the baselines saved with --save, within
+    --tolerance. Baselines are only comparable on the machine that made
+    them.
+
+    python obligate/microbench.py                # compare
+    python obligate/microbench.py --save         # store new baselines
+    python obligate/microbench.py --case consolidate_ranges
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import timeit
+
+import utils
+
+baselines_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'microbench_baselines.json')
+
+# how much faster than expected a case may grow before it is a regression
+growth_slack = 0.35
+
+
+def growth(sizes, seconds):
+    """
+    The exponent k of seconds ~ size ** k between the smallest and largest
+    size.
+
+    >>> round(growth([10, 1000], [0.001, 0.1]), 2)
+    1.0
+    >>> round(growth([10, 1000], [0.001, 0.001]), 2)
+    0.0
+    """
+    if seconds[0] <= 0 or seconds[-1] <= 0:
+        return 0.0
+    return math.log(seconds[-1] / seconds[0]) / \
+        math.log(float(sizes[-1]) / sizes[0])
+
+
+def random_ranges(rand, count, width):
+    ranges = list()
+    start = 0
+    for i in xrange(count):
+        start += rand.randrange(1, 3 * width)
+        ranges.append((start, start + rand.randrange(1, width + 1)))
+    rand.shuffle(ranges)
+    return ranges
+
+
+def policy_octets(n):
+    rand = random.Random(n)
+    octets = [rand.randrange(256) for i in xrange(n)]
+    offsets = [(rand.randrange(-2, 250), rand.randrange(1, 8))
+               for i in xrange(n)]
+    return lambda: utils.make_offset_lengths(octets, offsets)
+
+
+def policy_width(width):
+    # one policy, the cost must not depend on how much it covers
+    offsets = [(0, width), (width + 1, width), (3 * width, width)]
+    return lambda: utils.make_offset_lengths([255, 3], offsets)
+
+
+def consolidate_count(n):
+    ranges = random_ranges(random.Random(n), n, 16)
+    return lambda: utils.consolidate_ranges(ranges)
+
+
+def consolidate_width(width):
+    ranges = random_ranges(random.Random(1), 50, width)
+    return lambda: utils.consolidate_ranges(ranges)
+
+
+def list_to_ranges(n):
+    rand = random.Random(n)
+    points = [rand.randrange(4 * n) for i in xrange(n)]
+    return lambda: utils.list_to_ranges(points)
+
+
+def per_row(fx, make_args):
+    """A case calling fx once per row, like the migrate_ methods do."""
+    def case(n):
+        rows = [make_args(i) for i in xrange(n)]
+
+        def run():
+            for args in rows:
+                fx(*args)
+        return run
+    return case
+
+
+def ledger(n):
+    ids = [str(i) for i in xrange(n)]
+
+    def run():
+        json_data = utils.build_json_structure(['ips'])
+        for id in ids:
+            utils.init_id(json_data, 'ips', id)
+        for id in ids:
+            utils.migrate_id(json_data, 'ips', id)
+    return run
+
+
+# name: (make a callable for a size, sizes, expected growth)
+cases = {
+    'make_offset_lengths': (policy_octets, [10, 100, 1000, 10000], 1.0),
+    'make_offset_lengths_wide': (policy_width, [2 ** 8, 2 ** 24, 2 ** 64],
+                                 0.0),
+    'consolidate_ranges': (consolidate_count, [10, 100, 1000, 10000], 1.0),
+    'consolidate_ranges_wide': (consolidate_width, [2 ** 8, 2 ** 24,
+                                                    2 ** 64], 0.0),
+    'list_to_ranges': (list_to_ranges, [10, 100, 1000, 10000], 1.0),
+    'to_mac_range': (per_row(utils.to_mac_range,
+                             lambda i: ('AA:BB:{0:02X}/24'.format(i % 256),)),
+                     [100, 1000, 10000], 1.0),
+    'translate_netmask': (per_row(utils.translate_netmask,
+                                  lambda i: ('255.255.{0}.0'.format(
+                                      (0xff << (i % 8)) & 0xff),
+                                      '10.0.0.0')),
+                          [100, 1000, 10000], 1.0),
+    'trim_br': (per_row(utils.trim_br,
+                        lambda i: ('br-{0}'.format(i) if i % 2
+                                   else str(i),)),
+                [1000, 10000, 100000], 1.0),
+    'init_id+migrate_id': (ledger, [1000, 10000, 100000], 1.0),
+}
+
+
+def time_case(make, size, budget=0.2):
+    """Best seconds per call of make(size)(), repeated within ~budget."""
+    fx = make(size)
+    timer = timeit.Timer(fx)
+    number = 1
+    while True:
+        seconds = timer.timeit(number)
+        if seconds >= budget / 5 or number >= 10 ** 6:
+            break
+        number *= 10
+    return min([seconds] + timer.repeat(4, number)) / number
+
+
+def run_cases(names):
+    results = dict()
+    for name in names:
+        make, sizes, expected = cases[name]
+        seconds = [time_case(make, size) for size in sizes]
+        results[name] = {'sizes': sizes,
+                         'seconds': seconds,
+                         'growth': round(growth(sizes, seconds), 3),
+                         'expected_growth': expected}
+    return results
+
+
+def compare(results, baselines, tolerance):
+    """Lines describing every case, and whether any of them regressed."""
+    lines = ["{0:<28} {1:>20} {2:>10} {3:>10}  {4}".format(
+        'case', 'size', 'us/call', 'baseline', 'growth')]
+    regressed = False
+    for name in sorted(results):
+        result = results[name]
+        base = baselines.get(name, {})
+        base_seconds = dict(zip(base.get('sizes', []),
+                                base.get('seconds', [])))
+        for size, seconds in zip(result['sizes'], result['seconds']):
+            flag = ''
+            base_us = ''
+            if size in base_seconds:
+                base_us = '{0:.2f}'.format(base_seconds[size] * 1e6)
+                if seconds > base_seconds[size] * tolerance:
+                    flag = '  SLOWER x{0:.1f}'.format(
+                        seconds / base_seconds[size])
+                    regressed = True
+            lines.append("{0:<28} {1:>20} {2:>10.2f} {3:>10}{4}".format(
+                name, size, seconds * 1e6, base_us, flag))
+        flag = ''
+        if result['growth'] > result['expected_growth'] + growth_slack:
+            flag = '  GROWS FASTER THAN {0}'.format(result['expected_growth'])
+            regressed = True
+        lines.append("{0:<28} {1:>20} {2:>10} {3:>10}  {4:.2f}{5}".format(
+            name, '', '', '', result['growth'], flag))
+    return lines, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Microbenchmarks of the per-row utils functions.')
+    parser.add_argument('--case', action='append', dest='cases',
+                        choices=sorted(cases),
+                        help='Run only this case, can be repeated.')
+    parser.add_argument('--save', action='store_true',
+                        help='Store the results as the new baselines.')
+    parser.add_argument('--tolerance', type=float, default=2.0,
+                        help='Times slower than the baseline that is '
+                             'still fine (default 2).')
+    parser.add_argument('--baselines', default=baselines_path)
+    arguments = parser.parse_args()
+    results = run_cases(arguments.cases or sorted(cases))
+    baselines = dict()
+    if os.path.exists(arguments.baselines):
+        with open(arguments.baselines) as fh:
+            baselines = json.load(fh)
+    lines, regressed = compare(results, baselines, arguments.tolerance)
+    print '\n'.join(lines)
+    if arguments.save:
+        baselines.update(results)
+        with open(arguments.baselines, 'w') as fh:
+            json.dump(baselines, fh, indent=2, sort_keys=True)
+        print "Baselines written to {0}".format(arguments.baselines)
+        return 0
+    return 1 if regressed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,100 +12,136 @@
 # implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+"""
+The melange tables obligate reads.
+
+Only the columns obligate reads are declared, as in melange's schema at
+migrate_version 6 ([system_reqs] dbversion in .config). Nothing is
+reflected, so importing this module never touches a database, and
+engines are only made by get_engine().
+"""
 import ConfigParser as cfgp
 import os
+from sqlalchemy import BigInteger
+from sqlalchemy import Boolean
+from sqlalchemy import Column
 from sqlalchemy import create_engine
+from sqlalchemy import DateTime
+from sqlalchemy import ForeignKey
+from sqlalchemy import Integer
+from sqlalchemy import String
 from sqlalchemy.ext.declarative import declarative_base
 
 basepath = os.path.dirname(os.path.realpath(__file__))
 basepath = os.path.abspath(os.path.join(basepath, os.pardir))
-
-config = cfgp.ConfigParser()
 config_file_path = "{0}/../.config".format(basepath)
-config.read(config_file_path)
 
-username = config.get('source_db', 'user', 'changeuserinconfig')
-password = config.get('source_db', 'password', 'changepasswordinconfig')
-location = config.get('source_db', 'location', 'changelocationinconfig')
-dbname = config.get('source_db', 'dbname', 'changedatabasenameinconfig')
 
-engine = create_engine("mysql://{0}:{1}@{2}/{3}".
-                       format(username, password, location, dbname),
-                       echo=False)
+def get_engine(environment=None):
+    """The source_db engine, from [source_db:<environment>] when .config
+    has that section."""
+    config = cfgp.ConfigParser()
+    config.read(config_file_path)
+    section = 'source_db'
+    if environment and config.has_section(
+            'source_db:{0}'.format(environment)):
+        section = 'source_db:{0}'.format(environment)
+    username = config.get(section, 'user', 'changeuserinconfig')
+    password = config.get(section, 'password', 'changepasswordinconfig')
+    location = config.get(section, 'location', 'changelocationinconfig')
+    dbname = config.get(section, 'dbname', 'changedatabasenameinconfig')
+    return create_engine("mysql://{0}:{1}@{2}/{3}".
+                         format(username, password, location, dbname),
+                         echo=False)
 
-Base = declarative_base(engine)
+Base = declarative_base()
 
 
 class MelangeMixin(object):
-    """"""
-    __table_args__ = {'autoload': True}
+    """Columns every melange table has."""
+    id = Column(String(36), primary_key=True)
+    created_at = Column(DateTime)
 
 
 class Interfaces(MelangeMixin, Base):
     """"""
     __tablename__ = "interfaces"
-
-
-class AllocatableIPs(MelangeMixin, Base):
-    """"""
-    __tablename__ = "allocatable_ips"
-
-
-class AllocatableMacs(MelangeMixin, Base):
-    """"""
-    __tablename__ = "allocatable_macs"
-
-
-class AllowedIps(MelangeMixin, Base):
-    """"""
-    __tablename__ = "allowed_ips"
+    vif_id_on_device = Column(String(255))
+    device_id = Column(String(255))
+    tenant_id = Column(String(255))
 
 
 class IpAddresses(MelangeMixin, Base):
     """"""
     __tablename__ = "ip_addresses"
+    address = Column(String(255))
+    interface_id = Column(String(36), ForeignKey('interfaces.id'))
+    ip_block_id = Column(String(36), ForeignKey('ip_blocks.id'))
+    used_by_tenant_id = Column(String(255))
+    marked_for_deallocation = Column(Boolean)
+    deallocated_at = Column(DateTime)
 
 
 class IpBlocks(MelangeMixin, Base):
     """"""
     __tablename__ = "ip_blocks"
-
-
-class IpNats(MelangeMixin, Base):
-    """"""
-    __tablename__ = "ip_nats"
+    network_id = Column(String(255))
+    network_name = Column(String(255))
+    cidr = Column(String(255))
+    tenant_id = Column(String(255))
+    gateway = Column(String(255))
+    dns1 = Column(String(255))
+    dns2 = Column(String(255))
+    policy_id = Column(String(36), ForeignKey('policies.id'))
+    max_allocation = Column(Integer)
+    omg_do_not_use = Column(Boolean)
 
 
 class IpOctets(MelangeMixin, Base):
     """"""
     __tablename__ = "ip_octets"
+    octet = Column(Integer)
+    policy_id = Column(String(36), ForeignKey('policies.id'))
 
 
 class IpRanges(MelangeMixin, Base):
     """"""
     __tablename__ = "ip_ranges"
+    offset = Column(Integer)
+    length = Column(Integer)
+    policy_id = Column(String(36), ForeignKey('policies.id'))
 
 
 class IpRoutes(MelangeMixin, Base):
     """"""
     __tablename__ = "ip_routes"
+    destination = Column(String(255))
+    netmask = Column(String(255))
+    gateway = Column(String(255))
+    source_block_id = Column(String(36), ForeignKey('ip_blocks.id'))
 
 
 class MacAddressRanges(MelangeMixin, Base):
     """"""
     __tablename__ = "mac_address_ranges"
+    cidr = Column(String(255))
 
 
 class MacAddresses(MelangeMixin, Base):
     """"""
     __tablename__ = "mac_addresses"
+    address = Column(BigInteger)
+    interface_id = Column(String(36), ForeignKey('interfaces.id'))
 
 
-class MigrationVersion(MelangeMixin, Base):
+class MigrationVersion(Base):
     """"""
     __tablename__ = "migrate_version"
+    repository_id = Column(String(250), primary_key=True)
+    version = Column(Integer)
 
 
 class Policies(MelangeMixin, Base):
     """"""
     __tablename__ = "policies"
+    description = Column(String(255))
@@ -19,15 +19,22 @@ from sqlalchemy import create_engine
 basepath = os.path.dirname(os.path.realpath(__file__))
 basepath = os.path.abspath(os.path.join(basepath, os.pardir))
 
-config = cfgp.ConfigParser()
 config_file_path = "{0}/../.config".format(basepath)
-config.read(config_file_path)
 
-username = config.get('destination_db', 'user', 'changeuserinconfig')
-password = config.get('destination_db', 'password', 'changepasswordinconfig')
-location = config.get('destination_db', 'location', 'changelocationinconfig')
-dbname = config.get('destination_db', 'dbname', 'changetablenameinconfig')
 
-engine = create_engine("mysql://{0}:{1}@{2}/{3}".
-                       format(username, password, location, dbname),
-                       echo=False)
+def get_engine(environment=None):
+    """The destination_db engine, from [destination_db:<environment>]
+    when .config has that section."""
+    config = cfgp.ConfigParser()
+    config.read(config_file_path)
+    section = 'destination_db'
+    if environment and config.has_section(
+            'destination_db:{0}'.format(environment)):
+        section = 'destination_db:{0}'.format(environment)
+    username = config.get(section, 'user', 'changeuserinconfig')
+    password = config.get(section, 'password', 'changepasswordinconfig')
+    location = config.get(section, 'location', 'changelocationinconfig')
+    dbname = config.get(section, 'dbname', 'changetablenameinconfig')
+    return create_engine("mysql://{0}:{1}@{2}/{3}".
+                         format(username, password, location, dbname),
+                         echo=False)
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from datetime import datetime as dt
+import functools
 import logging
 from models import melange
 import netaddr
@@ -21,82 +22,275 @@ from quark.drivers import optimized_nvp_driver as optdriver
 import resource
 import time
 import traceback
-from uuid import uuid4
 
+from asynclog import Sampler
+from batching import CommitController
+from caches import InterfaceCache
+from governor import MemoryGovernor
+from governor import SpillDict
+import history
+from history import dataset_fingerprint
+from intervals import IntervalIndex
+from metrics import RunMetrics
+from profiler import profile_call
+from profiler import SqlProfiler
+from profiler import trace_call
+from progress import expected_rows
+from progress import melange_counts
+from progress import ProgressReporter
 from utils import build_json_structure
+from utils import cidr_to_range
+from utils import connect_bridges
+from utils import deterministic_id
 from utils import dump_json
 from utils import flush_db
 from utils import init_id
+from utils import mac_to_int
 from utils import make_offset_lengths
 from utils import migrate_id
+from utils import reject_id
 from utils import set_reason
 from utils import to_mac_range
 from utils import translate_netmask
 from utils import trim_br
-from utils import get_connection_creds
+from utils import get_log_dir
+from utils import get_option
+from utils import get_settings
+from writer import network_policies
+from writer import port_ip_associations
+from writer import port_macs
+from writer import subnet_policies
+from writer import table_name
+from writer import WriteScheduler
 
-import query
+import records
+from scope import MigrationScope
+from stages import caches_to_rebuild
+from stages import select_stages
+from stages import STAGES
+from throttle import Throttle
+from validate import IpIntegrity
 
-#logging.basicConfig(level=logging.DEBUG,
-#                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-#                    datefmt='%m-%d %H:%M',
-#                    filename='sqlalchemy.log',
-#                    filemode='w')
-#logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
+# quark rows each stage writes, children first
+STAGE_MODELS = {
+    'networks': (quarkmodels.DNSNameserver, quarkmodels.Route,
+                 quarkmodels.IPAddress, quarkmodels.Subnet,
+                 quarkmodels.Network),
+    'interfaces': (optdriver.LSwitchPort, optdriver.LSwitch,
+                   quarkmodels.Port),
+    'associations': (quarkmodels.port_ip_association,),
+    'macs': (quarkmodels.MacAddress, quarkmodels.MacAddressRange),
+    'policies': (quarkmodels.IPPolicyRange, quarkmodels.IPPolicy),
+}
+
+# ledger table of each quark model written with a melange id
+LEDGER_TABLES = {
+    quarkmodels.Network: 'networks',
+    quarkmodels.Subnet: 'subnets',
+    quarkmodels.Route: 'routes',
+    quarkmodels.IPAddress: 'ips',
+    quarkmodels.Port: 'interfaces',
+    quarkmodels.MacAddressRange: 'mac_ranges',
+    quarkmodels.MacAddress: 'macs',
+    quarkmodels.IPPolicy: 'policies',
+    quarkmodels.IPPolicyRange: 'policy_rules',
+}
 
 
 class Obligator(object):
-    def __init__(self, melange_sess=None, neutron_sess=None):
-        self.commit_tick = 0
-        self.max_records = 75000
-        self.interface_tenant = dict()
-        self.interfaces = dict()
-        self.interface_network = dict()
-        self.interface_ip = dict()
-        self.port_cache = dict()
-        self.policy_ids = dict()
+    def __init__(self, melange_sess=None, neutron_sess=None,
+                 dedupe_policies=None, scope=None, tables=None,
+                 environment=None, write_mode=None, metrics_textfile=None,
+                 sql_profile=None, profile_stages=None, trace_stages=None,
+                 bridges=None, dataset=None, progress_console=False):
+        # environment picks the nova/melange bridges and, when given,
+        # keeps logs, ledgers and spill files under logs/<environment>
+        self.environment = environment
+        # (nova, melange) to use instead of the mysql json bridges
+        self.bridges = bridges
+        # fingerprint the run is recorded under in the history, defaults
+        # to one of the rows read
+        self.dataset = dataset
+        settings = get_settings()
+        if dedupe_policies is None:
+            dedupe_policies = settings.dedupe_policies
+        self.dedupe_policies = dedupe_policies
+        # upsert keeps what quark has and writes over it, ids obligate
+        # makes up are deterministic so a rerun hits the same rows
+        self.upsert = (write_mode or settings.write_mode) == 'upsert'
+        self.error_free = True
+        self.scope = scope or MigrationScope()
+        self.stages = select_stages(tables or settings.migrate_tables)
+        self.batcher = CommitController(
+            target_seconds=settings.commit_target_seconds,
+            rss_budget_mb=settings.rss_budget_mb)
+        self.interface_cache = InterfaceCache()
+        self.policy_ids = SpillDict()
         self.melange_session = melange_sess
         self.neutron_session = neutron_sess
-        self.json_data = build_json_structure()
+        # melange (and the bridges) may be live, reads are paced when
+        # [throttle] says so
+        self.throttle = Throttle.from_config(environment)
+        # the bridges are other servers, each is paced on its own
+        self.nova_throttle = Throttle.from_config(environment)
+        self.bridge_throttle = Throttle.from_config(environment)
+        self.throttle.activate()
+        if self.throttle.enabled and melange_sess is not None:
+            self.throttle.watch(melange_sess.bind)
+        self.metrics = RunMetrics(environment)
+        self.metrics.activate()
+        self.metrics_textfile = metrics_textfile or \
+            settings.prometheus_textfile
+        # sql_profile: how many statement shapes to report, None is off
+        self.sql_profile = sql_profile
+        self.profiler = SqlProfiler() if sql_profile else None
+        # steps to run under cProfile / tracemalloc, by stage name, method
+        # or label
+        self.profile_stages = set(profile_stages or [])
+        self.trace_stages = set(trace_stages or [])
+        for session in (melange_sess, neutron_sess):
+            if session is not None:
+                self.metrics.watch(session.bind)
+                if self.profiler:
+                    self.profiler.watch(session.bind)
+        self.json_data = build_json_structure(
+            [t for stage in self.stages for t in stage.tables])
+        # rows handed to the writer so far, progress reads it
+        self.rows_buffered = 0
+        self.expected_rows = dict()
+        self.progress = ProgressReporter(settings.progress_interval_seconds,
+                                         console=progress_console)
+        self.governor = MemoryGovernor(settings.memory_budget_mb,
+                                       get_log_dir(environment))
+        self.governor.register('interface cache', self.interface_cache)
+        self.governor.register('policy index', self.policy_ids)
+        for tablename, table in self.json_data.iteritems():
+            self.governor.register('ledger {0}'.format(tablename),
+                                   table['ids'])
+        self.writer = None
+        if neutron_sess is not None:
+            writers = get_option('migration', 'writers',
+                                 settings.writer_count, environment)
+            self.writer = WriteScheduler(neutron_sess.bind, writers=writers,
+                                         upsert=self.upsert,
+                                         retries=settings.write_retries,
+                                         backoff=
+                                         settings.retry_backoff_seconds)
         res = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # ram check
         self.log = logging.getLogger('obligate.obligator')
         self.log.debug("Ram used: {0:0.2f}M".format(res / 1024.0))
         
 
     def do_and_time(self, label, fx, **kwargs):
-        start_time = time.time()
         self.log.info("start: {0}".format(label))
+        self.governor.start_window()
+        self.governor.sample()
+        stage = self.metrics.start(label, *self.write_totals())
+        if self.profiler:
+            self.profiler.stage = label
+        self.start_progress(label, fx)
+        error = None
         try:
-            fx(**kwargs)
+            self.capture(label, fx, **kwargs)
         except Exception as e:
             self.error_free = False
+            error = str(e)
             self.log.critical("Error during"
                               " {0}:{1}\n{2}".format(label,
                                                      e.message,
                                                      traceback.format_exc()))
-        end_time = time.time()
+        self.progress.stop()
+        rss = self.governor.sample()
+        stage = self.metrics.stop(stage, *self.write_totals(),
+                                  peak_rss_mb=self.governor.window_peak_mb,
+                                  error=error)
         self.log.info("end  : {0}".format(label))
         self.log.info("delta: {0} = {1:.2f} seconds".format(label,
-                                                            end_time - start_time))  # noqa
+                                                            stage.wall_seconds))  # noqa
+        self.log.info("{0}: {1:.2f} cpu seconds, {2} rows read, {3} rows "
+                      "written ({4:.0f}/s), {5} commits, {6} statements."
+                      .format(label, stage.cpu_seconds,
+                              sum(stage.rows_read.values()),
+                              sum(stage.rows_written.values()),
+                              stage.rows_per_second(), stage.commits,
+                              stage.statements))
         res = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
         self.log.debug("Ram used: {0:0.2f}M".format(res / 1000.0))
-        return end_time - start_time
+        self.log.debug("RSS now: {0:0.2f}M, sampled peak: {1:0.2f}M"
+                       .format(rss, self.governor.peak_mb))
+        return stage.wall_seconds
+
+    def start_progress(self, label, fx):
+        if fx.__name__ == 'migrate_commit' and self.writer is not None:
+            self.progress.start(label, self.rows_written,
+                                self.writer.pending_count)
+            return
+        total = sum(self.expected_rows.get(s.name, 0) for s in STAGES
+                    if s.method == fx.__name__)
+        self.progress.start(label, lambda: self.rows_buffered, total)
+
+    def rows_written(self):
+        return sum(self.writer.written.values())
+
+    def count_expected_rows(self):
+        try:
+            self.expected_rows = expected_rows(
+                melange_counts(self.melange_session, self.scope))
+        except Exception:
+            # progress lines just go without totals
+            self.log.warning("Could not count melange rows.", exc_info=True)
+            return
+        self.log.info("Rows expected per stage: {0}".format(
+            ", ".join("{0} {1}".format(s.name, self.expected_rows[s.name])
+                      for s in self.stages if s.name in self.expected_rows)))
+
+    def capture(self, label, fx, **kwargs):
+        """Run a step, under cProfile and/or tracemalloc if asked to."""
+        names = set([label, fx.__name__])
+        names.update(s.name for s in STAGES if s.method == fx.__name__)
+        logdir = get_log_dir(self.environment)
+        stamp = dt.now().strftime('%Y%m%dT%H%M%S')
+        slug = label.replace(' ', '_').replace(',', '')
+        if names & self.trace_stages:
+            fx = functools.partial(
+                trace_call, '{0}/tracealloc.{1}.{2}.txt'.format(
+                    logdir, slug, stamp), fx)
+        if names & self.profile_stages:
+            fx = functools.partial(
+                profile_call, '{0}/profile.{1}.{2}.pstats'.format(
+                    logdir, slug, stamp), fx)
+        return fx(**kwargs)
+
+    def write_totals(self):
+        # rows written per quark table and commits so far
+        if self.writer is None:
+            return {}, 0
+        return self.writer.written, self.writer.commits
+
+    def row_buffered(self):
+        # every buffered row goes through here
+        self.rows_buffered += 1
+        self.governor.check()
+        if self.batcher.tick():
+            self.migrate_commit()
 
     def add_to_session(self, item, tablename, id):
-        self.commit_tick += 1
         self.json_data = migrate_id(self.json_data, tablename, id)
-        self.neutron_session.add(item)
-        if ((self.commit_tick + 1) % self.max_records == 0):
-            self.commit_tick = 0
-            self.migrate_commit()
+        self.writer.add(item)
+        self.row_buffered()
 
     def new_to_session(self, item, tablename=None):
         # add something brand new to the database
-        self.commit_tick += 1
         if tablename:
             self.json_data[tablename]['num migrated'] += 1
             self.json_data[tablename]['new'] += 1
-        self.neutron_session.add(item)
+        self.writer.add(item)
+        self.row_buffered()
+
+    def execute_in_session(self, statement, params):
+        # buffer a row written by a core statement instead of a model
+        self.writer.execute(statement, params)
+        self.row_buffered()
 
     def migrate_networks(self):
         """1. Migrate the m.ip_blocks -> q.quark_networks
@@ -109,30 +303,28 @@ class Obligator(object):
         An ip_block has a cidr which maps to a corresponding subnet
         in quark.
         """
-        blocks = self.melange_session.query(melange.IpBlocks).all()
+        blocks = records.Block.all(self.melange_session, *self.scope.blocks())
         networks = dict()
         """Create the networks using the network_id. It is assumed that
         a network can only belong to one tenant"""
         for block in blocks:
-            init_id(self.json_data, 'networks', trim_br(block.network_id))
-            if trim_br(block.network_id) not in networks:
-                networks[trim_br(block.network_id)] = {
+            init_id(self.json_data, 'networks', block.network_id)
+            if block.network_id not in networks:
+                networks[block.network_id] = {
                     "tenant_id": block.tenant_id,
                     "name": block.network_name,
                     "max_allocation": block.max_allocation,
                     "created_at": block.created_at}
-            elif trim_br(block.network_id) in networks:
-                if networks[trim_br(block.network_id)]["created_at"] > block.created_at:  # noqa
-                    networks[trim_br(block.network_id)]["created_at"] = block.created_at  # noqa
-            elif networks[trim_br(
-                    block.network_id)]["tenant_id"] != block.tenant_id:
+            elif block.network_id in networks:
+                if networks[block.network_id]["created_at"] > block.created_at:  # noqa
+                    networks[block.network_id]["created_at"] = block.created_at  # noqa
+            elif networks[block.network_id]["tenant_id"] != block.tenant_id:
                 r = "Found different tenant on network:{0} != {1}"\
-                    .format(networks[trim_br(
-                        block.network_id)]["tenant_id"],
+                    .format(networks[block.network_id]["tenant_id"],
                         block.tenant_id)
                 self.log.critical(r)
                 set_reason(self.json_data, 'networks',
-                           trim_br(block.network_id), r)
+                           block.network_id, r)
                 raise Exception
         for net in networks:
             cache_net = networks[net]
@@ -143,40 +335,42 @@ class Obligator(object):
                                             cache_net["max_allocation"])
             self.add_to_session(q_network, 'networks', net)
         blocks_without_policy = 0
+        policy_blocks = dict()
         for block in blocks:
             init_id(self.json_data, 'subnets', block.id)
             q_subnet = quarkmodels.Subnet(id=block.id,
-                                          network_id=
-                                          trim_br(block.network_id),
+                                          network_id=block.network_id,
                                           tenant_id=block.tenant_id,
                                           cidr=block.cidr,
                                           do_not_use=block.omg_do_not_use,
                                           created_at=block.created_at)
             self.add_to_session(q_subnet, 'subnets', q_subnet.id)
-            q_dns1 = quarkmodels.DNSNameserver(tenant_id=block.tenant_id,
-                                               created_at=block.created_at,
-                                               ip=
-                                               int(netaddr.IPAddress(block.dns1)),  # noqa
-                                               subnet_id=q_subnet.id)
-            q_dns2 = quarkmodels.DNSNameserver(tenant_id=block.tenant_id,
-                                               created_at=block.created_at,
-                                               ip=
-                                               int(netaddr.IPAddress(block.dns2)),  # noqa
-                                               subnet_id=q_subnet.id)
-            self.new_to_session(q_dns1)
-            self.new_to_session(q_dns2)
+            for n, dns in ((1, block.dns1), (2, block.dns2)):
+                try:
+                    dns_ip = int(netaddr.IPAddress(dns))
+                except (netaddr.AddrFormatError, TypeError, ValueError):
+                    r = "dns{0} {1!r} is not an address".format(n, dns)
+                    self.log.error("Subnet {0}: {1}".format(block.id, r))
+                    set_reason(self.json_data, 'subnets', block.id, r)
+                    continue
+                dns_id = deterministic_id('dns', block.id, n)
+                q_dns = quarkmodels.DNSNameserver(id=dns_id,
+                                                  tenant_id=block.tenant_id,
+                                                  created_at=block.created_at,
+                                                  ip=dns_ip,
+                                                  subnet_id=q_subnet.id)
+                self.new_to_session(q_dns)
             self.migrate_ips(block=block)
             self.migrate_routes(block=block)
             # caching policy_ids for use in migrate_policies
             if block.policy_id:
-                if block.policy_id not in self.policy_ids.keys():
-                    self.policy_ids[block.policy_id] = {}
-                self.policy_ids[block.policy_id][block.id] =\
-                    trim_br(block.network_id)
+                policy_blocks.setdefault(block.policy_id, {})[block.id] = \
+                    block.network_id
             else:
                 self.log.warning("Found block without a policy: {0}"
                                  .format(block.id))
                 blocks_without_policy += 1
+        self.index_policy_blocks(policy_blocks)
         # have to add new routes as well:
         new_gates = 0
         for block in blocks:
@@ -188,14 +382,19 @@ class Obligator(object):
         self.log.info("{0} brand new gateways created.".format(new_gates))
 
     def migrate_routes(self, block=None):
-        routes = self.melange_session.query(melange.IpRoutes)\
-            .filter_by(source_block_id=block.id).all()
+        routes = records.Route.all(self.melange_session,
+                                   melange.IpRoutes.source_block_id ==
+                                   block.id)
         for route in routes:
             init_id(self.json_data, 'routes', route.id)
+            cidr = translate_netmask(route.netmask, route.destination)
+            if cidr is None:
+                set_reason(self.json_data, 'routes', route.id,
+                           "no cidr for netmask {0} destination {1}"
+                           .format(route.netmask, route.destination))
+                continue
             q_route = quarkmodels.Route(id=route.id,
-                                        cidr=
-                                        translate_netmask(route.netmask,
-                                                          route.destination),
+                                        cidr=cidr,
                                         tenant_id=block.tenant_id,
                                         gateway=route.gateway,
                                         created_at=block.created_at,
@@ -209,7 +408,9 @@ class Obligator(object):
             destination = '0.0.0.0/0'  # 3
         else:
             destination = '0:0:0:0:0:0:0:0/0'  # 4
-        q_route = quarkmodels.Route(cidr=destination,
+        q_route = quarkmodels.Route(id=deterministic_id('default route',
+                                                        block.id),
+                                    cidr=destination,
                                     tenant_id=block.tenant_id,
                                     gateway=block.gateway,
                                     subnet_id=block.id,
@@ -228,23 +429,26 @@ class Obligator(object):
         then be possible to create a q.subnet connected to the network.
 
         """
-        addresses = self.melange_session.query(melange.IpAddresses)\
-            .filter_by(ip_block_id=block.id).all()
+        addresses = records.Address.all(self.melange_session,
+                                        melange.IpAddresses.ip_block_id ==
+                                        block.id)
         for address in addresses:
             init_id(self.json_data, 'ips', address.id)
-            """Populate interface_network cache"""
+            try:
+                ip_address = netaddr.IPAddress(address.address)
+            except (netaddr.AddrFormatError, TypeError, ValueError) as e:
+                set_reason(self.json_data, 'ips', address.id, str(e))
+                continue
+            """Populate interface cache"""
             interface = address.interface_id
-            if interface is not None and\
-                    interface not in self.interface_network:
-                self.interface_network[interface] = \
-                    trim_br(block.network_id)
-            if interface in self.interface_network and\
-                    self.interface_network[interface] != \
-                    trim_br(block.network_id):
-                self.log.error("Found interface with different "
-                               "network id: {0} != {1}"
-                               .format(self.interface_network[interface],
-                                       trim_br(block.network_id)))
+            if interface is not None:
+                network_id = self.interface_cache.add_network(
+                    interface, block.network_id)
+                if network_id != block.network_id:
+                    self.log.error("Found interface with different "
+                                   "network id: {0} != {1}"
+                                   .format(network_id, block.network_id))
+                self.interface_cache.add_ip(interface, address.id)
             deallocated = False
             deallocated_at = None
             # If marked for deallocation
@@ -253,55 +457,57 @@ class Obligator(object):
                 deallocated = True
                 deallocated_at = address.deallocated_at
 
-            ip_address = netaddr.IPAddress(address.address)
             q_ip = quarkmodels.IPAddress(id=address.id,
                                          created_at=address.created_at,
                                          used_by_tenant_id=
                                          address.used_by_tenant_id,
-                                         network_id=
-                                         trim_br(block.network_id),
+                                         network_id=block.network_id,
                                          subnet_id=block.id,
                                          version=ip_address.version,
                                          address_readable=address.address,
                                          deallocated_at=deallocated_at,
                                          _deallocated=deallocated,
                                          address=int(ip_address.ipv6()))
-            # Populate interface_ip cache
-            if interface not in self.interface_ip:
-                self.interface_ip[interface] = set()
-            self.interface_ip[interface].add(q_ip)
             self.add_to_session(q_ip, 'ips', q_ip.id)
 
     def migrate_interfaces(self):
-        env = 'ordpreprod'
-        creds = get_connection_creds(env)
-        nova = query.Nova(creds['nova_url'], creds['nova_username'],
-                          creds['nova_password'])
-        melanged = query.Melange(creds['melange_url'], creds['melange_username'],
-                                creds['melange_password'])
-        # grab all instances from nova
-        instances = nova.get_instances_hashed_by_id()
-        # grab all interfaces from melange
-        interfaces_good = melanged.get_interfaces_hashed_by_device_id()
-        interfaces_all = self.melange_session.query(melange.Interfaces).all()
+        if self.bridges:
+            nova, melanged = self.bridges
+        else:
+            nova, melanged = self.connect_bridges()
+        device_ids = self.scope.device_ids(self.melange_session)
+        if device_ids is None:
+            # grab all instances from nova
+            instances = nova.get_instances_hashed_by_id()
+            # grab all interfaces from melange
+            interfaces_good = melanged.get_interfaces_hashed_by_device_id()
+        else:
+            # only the devices of the interfaces in scope
+            instances = nova.get_instances_by_ids(device_ids)
+            interfaces_good = melanged.get_interfaces_by_device_ids(
+                device_ids)
+        interfaces_all = records.Interface.iterate(
+            records.Interface.query(self.melange_session).
+            filter(*self.scope.interfaces(self.melange_session)))
         no_network_count = 0
-        good_device_ids = []
+        good_device_ids = set()
         for k, v in interfaces_good.iteritems():
             if k not in instances:
                 # this is not a garbage interface
                 # print 'interface device_id |%s| found in nova!!' % k
                 # self.log.critical("NVP_TEMP_KEY needs to be updated.")
-                good_device_ids.append(k)
+                good_device_ids.add(k)
         for interface in interfaces_all:
             if interface.device_id in good_device_ids:
                 init_id(self.json_data, "interfaces", interface.id)
-                if interface.id not in self.interface_network:
+                network_id = self.interface_cache.network_of(interface.id)
+                if network_id is None:
                     set_reason(self.json_data, "interfaces",
                                interface.id, "no network")
                     no_network_count += 1
                     continue
-                network_id = self.interface_network[interface.id]
-                self.interface_tenant[interface.id] = interface.tenant_id
+                self.interface_cache.add_port(interface.id,
+                                              interface.tenant_id)
                 q_port = quarkmodels.Port(id=interface.id,
                                           device_id=interface.device_id,
                                           tenant_id=interface.tenant_id,
@@ -309,7 +515,7 @@ class Obligator(object):
                                           backend_key=
                                           interface.vif_id_on_device,
                                           network_id=network_id)
-                lswitch_id = str(uuid4())
+                lswitch_id = deterministic_id('lswitch', interface.id)
                 q_nvp_switch = optdriver.LSwitch(id=lswitch_id,
                                                  nvp_id=network_id,
                                                  network_id=network_id,
@@ -317,9 +523,11 @@ class Obligator(object):
                 port_id = interface.vif_id_on_device
                 if not port_id:
                     port_id = "NVP_TEMP_KEY"
-                q_nvp_port = optdriver.LSwitchPort(port_id=port_id,
+                q_nvp_port = optdriver.LSwitchPort(id=deterministic_id(
+                                                   'lswitch port',
+                                                   interface.id),
+                                                   port_id=port_id,
                                                    switch_id=lswitch_id)
-                self.port_cache[interface.id] = q_port
                 self.add_to_session(q_port, "interfaces", q_port.id)
                 self.add_to_session(q_nvp_switch, "switch",
                                     q_nvp_switch.id)
@@ -327,66 +535,112 @@ class Obligator(object):
         self.log.info("Found {0} interfaces without a network."
                       .format(str(no_network_count)))
 
-    def associate_ips_with_ports(self):
-        """This is a time-consuming little function and begs to be optimized
-        111,600+ iterations @ 1,000 seconds in DFW
-        """ 
-        for id, q_port in self.port_cache.iteritems():
-            self.log.debug("ID: {}".format(id))
-            self.log.debug("q_port: {}".format(q_port))
-            for ip in self.interface_ip[id]:
-                self.log.debug("\tip: {}".format(ip))
-                q_port.ip_addresses.append(ip)
+    def connect_bridges(self):
+        if not self.throttle.enabled:
+            return connect_bridges(self.environment)
+        return connect_bridges(self.environment,
+                               nova_throttle=self.nova_throttle,
+                               melange_throttle=self.bridge_throttle)
 
+    def associate_ips_with_ports(self):
+        """Write the port <-> ip association rows straight from the cache,
+        no port or ip objects are needed.
+        """
+        sample = Sampler(get_settings().log_sample_every)
+        debug = self.log.isEnabledFor(logging.DEBUG)
+        for port_id, ip_id in self.interface_cache.port_ips():
+            if debug and sample():
+                self.log.debug("port: %s ip: %s (association %d)",
+                               port_id, ip_id, sample.calls)
+            self.execute_in_session(port_ip_associations,
+                                    {"port_id": port_id,
+                                     "ip_address_id": ip_id})
 
     def migrate_macs(self):
         """2. Migrate the m.mac_address -> q.quark_mac_addresses
         This is the next simplest but the relationship between quark_networks
         and quark_mac_addresses may be complicated to set up (if it exists)
         """
-        """Only migrating the first mac_address_range from melange."""
-        import netaddr
-        mac_range = self.melange_session.query(
-            melange.MacAddressRanges).first()
-        cidr = mac_range.cidr
-        init_id(self.json_data, 'mac_ranges', mac_range.id)
-        try:
-            cidr, first_address, last_address = to_mac_range(cidr)
-        except ValueError as e:
-            set_reason(self.json_data, mac_range.id, "mac_ranges", e.message)
-            self.log.critical(e.message)
-            return None
-        except netaddr.AddrFormatError as afe:
-            set_reason(self.json_data, mac_range.id, "mac_ranges", afe.message)
-            self.log.critical(afe.message)
+        """Every mac_address_range is migrated and kept in an interval
+        index, each mac is assigned to the range holding its value."""
+        mac_ranges = list()
+        existing_ranges = set()
+        if self.scope:
+            # ranges are shared by the whole region, a partial run only
+            # writes the ones quark does not have yet
+            existing_ranges = set(
+                r[0] for r in self.neutron_session.query(
+                    quarkmodels.MacAddressRange.id))
+            self.neutron_session.rollback()
+        for mac_range in records.MacRange.iterate(
+                records.MacRange.query(self.melange_session)):
+            init_id(self.json_data, 'mac_ranges', mac_range.id)
+            try:
+                cidr, first_address, last_address = \
+                    to_mac_range(mac_range.cidr)
+            except (ValueError, netaddr.AddrFormatError) as e:
+                set_reason(self.json_data, 'mac_ranges', mac_range.id,
+                           e.message)
+                self.log.critical(e.message)
+                continue
+            q_range = quarkmodels.MacAddressRange(id=mac_range.id,
+                                                  cidr=cidr,
+                                                  created_at=
+                                                  mac_range.created_at,
+                                                  first_address=first_address,
+                                                  next_auto_assign_mac=
+                                                  first_address,
+                                                  last_address=last_address)
+            if mac_range.id in existing_ranges:
+                set_reason(self.json_data, 'mac_ranges', mac_range.id,
+                           "already in quark")
+            else:
+                self.add_to_session(q_range, 'mac_ranges', q_range.id)
+            mac_ranges.append((first_address, last_address, mac_range.id))
+        range_index = IntervalIndex(mac_ranges)
+        for first, second in range_index.overlaps():
+            self.log.warning("mac ranges {0} and {1} overlap, macs in both "
+                             "go to {1}".format(first[2], second[2]))
+        if not len(range_index):
+            self.log.critical("No usable mac ranges, skipping macs.")
             return None
-        q_range = quarkmodels.MacAddressRange(id=mac_range.id,
-                                              cidr=cidr,
-                                              created_at=mac_range.created_at,
-                                              first_address=first_address,
-                                              next_auto_assign_mac=
-                                              first_address,
-                                              last_address=last_address)
-        self.add_to_session(q_range, 'mac_ranges', q_range.id)
-        res = self.melange_session.query(melange.MacAddresses).all()
+        res = records.Mac.iterate(
+            records.Mac.query(self.melange_session).
+            filter(*self.scope.macs(self.melange_session)))
         no_network_count = 0
+        no_range_count = 0
         for mac in res:
             init_id(self.json_data, 'macs', mac.address)
-            if mac.interface_id not in self.interface_network:
+            if mac.interface_id not in self.interface_cache:
                 no_network_count += 1
-                r = "mac.interface_id {0} not in self.interface_network"\
+                r = "mac.interface_id {0} not in self.interface_cache"\
                     .format(mac.interface_id)
                 set_reason(self.json_data, 'macs', mac.address, r)
                 continue
-            tenant_id = self.interface_tenant[mac.interface_id]
+            if not self.interface_cache.has_port(mac.interface_id):
+                no_network_count += 1
+                r = "mac.interface_id {0} was not migrated to a port"\
+                    .format(mac.interface_id)
+                set_reason(self.json_data, 'macs', mac.address, r)
+                continue
+            mac_range_id = range_index.find(mac_to_int(mac.address))
+            if mac_range_id is None:
+                no_range_count += 1
+                r = "mac {0} is outside every mac range".format(mac.address)
+                set_reason(self.json_data, 'macs', mac.address, r)
+                continue
+            tenant_id = self.interface_cache.tenant_of(mac.interface_id)
             q_mac = quarkmodels.MacAddress(tenant_id=tenant_id,
                                            created_at=mac.created_at,
-                                           mac_address_range_id=mac_range.id,
+                                           mac_address_range_id=mac_range_id,
                                            address=mac.address)
-            q_port = self.port_cache[mac.interface_id]
-            q_port.mac_address = q_mac.address
             self.add_to_session(q_mac, 'macs', q_mac.address)
+            self.execute_in_session(port_macs,
+                                    {"b_port_id": mac.interface_id,
+                                     "b_mac_address": q_mac.address})
         self.log.info("skipped {0} mac addresses".format(str(no_network_count)))  # noqa
+        self.log.info("{0} mac addresses outside every mac range"
+                      .format(no_range_count))
 
     def migrate_policies(self):
         """
@@ -401,9 +655,18 @@ class Obligator(object):
         There is a minute or two of lag while this spins up, may be a way
         to negate this.
         """
-        octets = self.melange_session.query(melange.IpOctets).all()
-        offsets = self.melange_session.query(melange.IpRanges).all()
-        for policy, policy_block_ids in self.policy_ids.items():
+        # networks are read back from quark below
+        self.migrate_commit()
+        q_networks = dict()
+        octets = records.Octet.all(
+            self.melange_session, *self.scope.octets(self.melange_session))
+        offsets = records.IpRange.all(
+            self.melange_session, *self.scope.ranges(self.melange_session))
+        descriptions = dict(
+            (p.id, p.description) for p in records.Policy.all(
+                self.melange_session,
+                *self.scope.policies(self.melange_session)))
+        for policy, policy_block_ids in self.policy_ids.iteritems():
             policy_octets = [o.octet for o in octets if o.policy_id == policy]
             policy_rules = [(off.offset, off.length) for off in offsets
                             if off.policy_id == policy]
@@ -420,18 +683,20 @@ class Obligator(object):
             except Exception:
                 ran_created_at = dt.utcnow()
             min_created_at = min([oct_created_at, ran_created_at])
-            try:
-                policy_description = self.melange_session.query(
-                    melange.Policies.description).\
-                    filter(melange.Policies.id == policy).first()[0]
-            except Exception:
-                policy_description = None
-            for block_id in policy_block_ids.keys():
-                policy_uuid = str(uuid4())
+            policy_description = descriptions.get(policy)
+            policy_block_ids = self.blocks_in_quark(q_networks, policy,
+                                                    policy_block_ids)
+            for block_ids in self.group_policy_blocks(q_networks,
+                                                      policy_block_ids):
+                q_network = self.get_quark_network(
+                    q_networks, policy_block_ids[block_ids[0]])
+                if self.dedupe_policies:
+                    policy_uuid = deterministic_id('policy', policy,
+                                                   q_network.tenant_id)
+                else:
+                    policy_uuid = deterministic_id('policy', policy,
+                                                   block_ids[0])
                 init_id(self.json_data, 'policies', policy_uuid)
-                q_network = self.neutron_session.query(quarkmodels.Network).\
-                    filter(quarkmodels.Network.id ==
-                           policy_block_ids[block_id]).first()
                 q_ip_policy = quarkmodels.IPPolicy(id=policy_uuid,
                                                    tenant_id=
                                                    q_network.tenant_id,
@@ -439,13 +704,22 @@ class Obligator(object):
                                                    policy_description,
                                                    created_at=
                                                    min_created_at)
-                q_ip_policy.networks.append(q_network)
-                q_subnet = self.neutron_session.query(quarkmodels.Subnet).\
-                    filter(quarkmodels.Subnet.id == block_id).first()
-                q_ip_policy.subnets.append(q_subnet)
                 self.add_to_session(q_ip_policy, 'policies', policy_uuid)
+                attached_networks = set()
+                for block_id in block_ids:
+                    network_id = policy_block_ids[block_id]
+                    if network_id not in attached_networks:
+                        attached_networks.add(network_id)
+                        self.execute_in_session(network_policies,
+                                                {"b_id": network_id,
+                                                 "b_ip_policy_id":
+                                                 policy_uuid})
+                    self.execute_in_session(subnet_policies,
+                                            {"b_id": block_id,
+                                             "b_ip_policy_id": policy_uuid})
                 for rule in policy_rules:
-                    offset_uuid = str(uuid4())
+                    offset_uuid = deterministic_id('policy rule',
+                                                   policy_uuid, *rule)
                     init_id(self.json_data, 'policy_rules', offset_uuid)
                     q_ip_policy_rule = quarkmodels.\
                         IPPolicyRange(id=offset_uuid,
@@ -456,30 +730,236 @@ class Obligator(object):
                     self.add_to_session(q_ip_policy_rule, 'policy_rules',
                                         offset_uuid)
 
+        self.neutron_session.rollback()
+
+    def blocks_in_quark(self, q_networks, policy, policy_block_ids):
+        """The blocks of a policy whose network made it into quark. The
+        others (their network was rejected) are marked as not migrated
+        under the policy id they would have had without dedupe."""
+        found = dict()
+        for block_id, network_id in policy_block_ids.iteritems():
+            if self.get_quark_network(q_networks, network_id) is not None:
+                found[block_id] = network_id
+                continue
+            policy_uuid = deterministic_id('policy', policy, block_id)
+            r = "network {0} of block {1} is not in quark".format(
+                network_id, block_id)
+            self.log.error("Skipping policy {0}: {1}".format(policy, r))
+            init_id(self.json_data, 'policies', policy_uuid)
+            set_reason(self.json_data, 'policies', policy_uuid, r)
+        return found
+
+    def group_policy_blocks(self, q_networks, policy_block_ids):
+        """Lists of block ids that share one quark IPPolicy.
+
+        Normally every block gets its own copy of the policy. With
+        dedupe_policies all blocks of one tenant share it.
+        """
+        if not self.dedupe_policies:
+            return [[block_id] for block_id in policy_block_ids]
+        by_tenant = dict()
+        for block_id, network_id in policy_block_ids.iteritems():
+            tenant_id = self.get_quark_network(q_networks,
+                                               network_id).tenant_id
+            by_tenant.setdefault(tenant_id, list()).append(block_id)
+        return by_tenant.values()
+
+    def get_quark_network(self, q_networks, network_id):
+        """Read a written network back from quark, once per network."""
+        if network_id not in q_networks:
+            q_network = self.neutron_session.query(quarkmodels.Network).\
+                filter(quarkmodels.Network.id == network_id).first()
+            q_networks[network_id] = q_network
+        return q_networks[network_id]
+
     def migrate_commit(self):
         """4. Commit the changes to the database"""
+        start_time = time.time()
+        written = 0
+        try:
+            written = self.writer.flush()
+        finally:
+            self.record_rejected()
+            # a failed flush drops what was pending too, count afresh
+            self.batcher.committed(written, time.time() - start_time)
+            self.governor.rearm()
+        self.log.debug("writer.flush() complete, {0} rows written."
+                       .format(written))
+
+    def record_rejected(self):
+        """Mark the rows the writer had to leave out as not migrated."""
+        while self.writer.rejected:
+            self.error_free = False
+            model, item, error = self.writer.rejected.pop()
+            tablename = LEDGER_TABLES.get(model)
+            if tablename is None:
+                self.log.error("Rejected {0} row {1}: {2}"
+                               .format(table_name(model), item, error))
+                continue
+            if model is quarkmodels.MacAddress:
+                id = item.address
+            else:
+                id = item.id
+            reject_id(self.json_data, tablename, id,
+                      "write failed: {0}".format(error))
+
+    def validate_ips(self):
+        """Check every migrated address against its subnet's cidr, and
+        look for duplicate addresses and overlapping subnets per network.
+        """
+        checker = IpIntegrity()
+        subnets = self.neutron_session.query(quarkmodels.Subnet.id,
+                                             quarkmodels.Subnet.network_id,
+                                             quarkmodels.Subnet._cidr).\
+            filter(*self.scope.quark_subnets())
+        for subnet_id, network_id, cidr in subnets.yield_per(10000):
+            checker.add_subnet(subnet_id, network_id, cidr_to_range(cidr))
+        overlaps = checker.overlapping_subnets()
+        for network_id, first_id, second_id in overlaps:
+            r = "overlaps subnet {0} in network {1}".format(first_id,
+                                                            network_id)
+            self.log.error("Subnet {0} {1}".format(second_id, r))
+            set_reason(self.json_data, 'subnets', second_id, r)
+        ips = self.neutron_session.query(quarkmodels.IPAddress.id,
+                                         quarkmodels.IPAddress.network_id,
+                                         quarkmodels.IPAddress.subnet_id,
+                                         quarkmodels.IPAddress.address).\
+            filter(*self.scope.quark_ips(self.neutron_session)).\
+            order_by(quarkmodels.IPAddress.network_id,
+                     quarkmodels.IPAddress.address)
+        bad_ips = 0
+        for ip_id, problem in checker.check(ips.yield_per(10000)):
+            bad_ips += 1
+            self.log.error("IP {0}: {1}".format(ip_id, problem))
+            set_reason(self.json_data, 'ips', ip_id, problem)
+        self.neutron_session.rollback()
+        self.log.info("Validated {0} ips against {1} subnets: {2} bad ips, "
+                      "{3} overlapping subnets.".format(checker.checked,
+                                                        len(checker.subnets),
+                                                        bad_ips,
+                                                        len(overlaps)))
+
+    def truncate_stages(self):
+        """Delete only the quark rows the selected stages write again."""
+        names = [stage.name for stage in self.stages]
+        if 'policies' in names and 'networks' not in names:
+            for model in (quarkmodels.Network, quarkmodels.Subnet):
+                self.neutron_session.execute(
+                    model.__table__.update().values(ip_policy_id=None))
+        for name in reversed(names):
+            for model in STAGE_MODELS.get(name, ()):
+                table = getattr(model, '__table__', model)
+                result = self.neutron_session.execute(table.delete())
+                self.log.info("Deleted {0} rows from {1}."
+                              .format(result.rowcount, table.name))
         self.neutron_session.commit()
-        self.log.debug("neutron_session.commit() complete.")
+
+    def rebuild_cache(self, cache):
+        """Fill a cache a skipped stage would have provided, from columns
+        only: nothing is migrated again."""
+        if cache == 'interface networks':
+            # melange, since quark has no interface for unmigrated ports
+            rows = self.melange_session.query(
+                melange.IpAddresses.interface_id,
+                melange.IpAddresses.id,
+                melange.IpBlocks.network_id).\
+                join(melange.IpBlocks,
+                     melange.IpBlocks.id == melange.IpAddresses.ip_block_id).\
+                filter(melange.IpAddresses.interface_id != None).\
+                filter(*self.scope.blocks())
+            for interface_id, ip_id, network_id in rows.yield_per(10000):
+                self.interface_cache.add_network(interface_id,
+                                                 trim_br(network_id))
+                self.interface_cache.add_ip(interface_id, ip_id)
+        elif cache == 'ports':
+            rows = self.neutron_session.query(quarkmodels.Port.id,
+                                              quarkmodels.Port.network_id,
+                                              quarkmodels.Port.tenant_id)
+            for port_id, network_id, tenant_id in rows.yield_per(10000):
+                self.interface_cache.add_network(port_id, network_id)
+                self.interface_cache.add_port(port_id, tenant_id)
+            self.neutron_session.rollback()
+        elif cache == 'policy index':
+            policy_blocks = dict()
+            for block in records.Block.all(self.melange_session,
+                                           melange.IpBlocks.policy_id != None,
+                                           *self.scope.blocks()):
+                policy_blocks.setdefault(block.policy_id, {})[block.id] = \
+                    block.network_id
+            self.index_policy_blocks(policy_blocks)
+        else:
+            raise Exception("Don't know how to rebuild {0}".format(cache))
+        self.log.info("Rebuilt {0}: {1} interfaces, {2} policies cached."
+                      .format(cache, len(self.interface_cache.interfaces),
+                              len(self.policy_ids)))
+
+    def index_policy_blocks(self, policy_blocks):
+        """Add {policy id: {block id: network id}} to policy_ids, one
+        write per policy since the index may be on disk."""
+        for policy_id, block_ids in policy_blocks.iteritems():
+            known = self.policy_ids.get(policy_id)
+            if known:
+                known.update(block_ids)
+                block_ids = known
+            self.policy_ids[policy_id] = block_ids
+
+    def record_history(self):
+        dataset = self.dataset or \
+            dataset_fingerprint(self.metrics.rows_read)
+        report = self.metrics.report()
+        # only complete runs calibrate --plan, see planner.recorded_reports
+        report['scope'] = str(self.scope) if self.scope else None
+        report['stages_run'] = [stage.name for stage in self.stages]
+        report['complete'] = (self.error_free and not self.scope and
+                              len(self.stages) == len(STAGES))
+        try:
+            run_id = history.record(report, dataset)
+        except Exception:
+            # the history is nice to have, the migration is done anyway
+            self.log.warning("Could not record the run in the history.",
+                             exc_info=True)
+        else:
+            self.log.info("Recorded as run {0} of dataset {1}.".format(
+                run_id, dataset))
 
     def migrate(self):
         """
         This will migrate an existing melange database to a new quark
         database. Below melange is referred to as m and quark as q.
         """
-        totes = 0.0
-        flush_db()
-        totes += self.do_and_time("migrate networks, "
-                                  "subnets, routes, and ips",
-                                  self.migrate_networks)
-        totes += self.do_and_time("migrate ports",
-                                  self.migrate_interfaces)
-        totes += self.do_and_time("associating ips with ports",
-                                  self.associate_ips_with_ports)
-        totes += self.do_and_time("migrate macs and ranges",
-                                  self.migrate_macs)
-        totes += self.do_and_time("migrate policies",
-                                  self.migrate_policies)
-        totes += self.do_and_time("commit changes",
-                                  self.migrate_commit)
-        self.log.info("TOTAL: {0:.2f} seconds.".format(totes))
-        dump_json(self.json_data)
+        self.log.info("Running stages: {0}".format(
+            ", ".join(stage.name for stage in self.stages)))
+        if self.upsert:
+            self.log.info("Upserting {0} into quark.".format(self.scope))
+        elif self.scope:
+            self.log.info("Partial migration of {0}, appending to quark."
+                          .format(self.scope))
+        elif len(self.stages) == len(STAGES):
+            flush_db(self.neutron_session.bind)
+        else:
+            self.do_and_time("truncate rerun tables", self.truncate_stages)
+        self.count_expected_rows()
+        for cache in caches_to_rebuild(self.stages):
+            self.do_and_time("rebuild {0}".format(cache),
+                             self.rebuild_cache, cache=cache)
+        for stage in self.stages:
+            self.do_and_time(stage.label, getattr(self, stage.method))
+        self.log.info("TOTAL: {0:.2f} seconds.".format(
+            self.metrics.wall_seconds()))
+        if self.throttle.enabled:
+            self.log.info("Melange throttle: {0}; nova bridge: {1}; "
+                          "melange bridge: {2}.".format(
+                              self.throttle.summary(),
+                              self.nova_throttle.summary(),
+                              self.bridge_throttle.summary()))
+        dump_json(self.json_data, self.environment)
+        self.log.info("Metrics written to {0}".format(
+            self.metrics.dump(get_log_dir(self.environment))))
+        if self.metrics_textfile:
+            self.metrics.write_textfile(self.metrics_textfile)
+        self.record_history()
+        if self.profiler:
+            report = self.profiler.report(self.sql_profile)
+            self.log.info("Most expensive statements:\n{0}".format(report))
+            print report
+        self.governor.close()
@@ -0,0 +1,323 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+What a migration would do, without doing it (main.py --plan).
+
+Melange is only counted (COUNT queries) and the bridges only asked for
+ids. Quark rows are projected from those counts, stage durations and
+peak memory from the runs in the history (history.py): seconds per
+quark row for each stage and a line through (quark rows, peak RSS).
+Without history, rough defaults are used and the plan says so.
+"""
+import json
+import logging
+import os
+
+import history
+from progress import format_seconds
+from progress import melange_counts
+from stages import STAGES
+from utils import get_settings
+
+plog = logging.getLogger('obligate.planner')
+
+# seconds per quark row of the whole run, per stage, until runs are
+# recorded
+default_seconds_per_row = {
+    'networks': 2e-4,
+    'interfaces': 5e-5,
+    'associations': 2e-5,
+    'macs': 5e-5,
+    'policies': 5e-5,
+    'commit': 2e-4,
+    'validate': 5e-5,
+}
+# megabytes: interpreter and models, then per quark row
+default_memory = (150.0, 0.002)
+calibration_runs = 20
+# the quark_rows each stage writes, commit writes them all
+stage_rows = {
+    'networks': ('networks', 'subnets', 'nameservers', 'routes', 'ips'),
+    'interfaces': ('ports', 'lswitches', 'lswitch ports'),
+    'associations': ('port ip associations',),
+    'macs': ('mac ranges', 'macs', 'port mac associations'),
+    'policies': ('policies', 'policy links', 'policy rules'),
+}
+
+
+def quark_rows(counts, port_fraction=1.0):
+    """
+    Quark rows a migration of `counts` writes. port_fraction is the part
+    of the interfaces that become ports (nova does not know them).
+
+    >>> counts = dict.fromkeys(['networks', 'subnets', 'subnets with '
+    ...     'gateway', 'subnets with policy', 'policies', 'ips', 'owned ips',
+    ...     'routes', 'interfaces', 'mac ranges', 'macs', 'octets',
+    ...     'ranges'], 10)
+    >>> rows = quark_rows(counts, 0.5)
+    >>> rows['ports'], rows['nameservers'], rows['routes']
+    (5, 20, 20)
+    """
+    ports = int(counts['interfaces'] * port_fraction)
+    rules_per_policy = (counts['octets'] + counts['ranges']) / \
+        float(max(counts['policies'], 1))
+    return {
+        'networks': counts['networks'],
+        'subnets': counts['subnets'],
+        'nameservers': 2 * counts['subnets'],
+        'routes': counts['routes'] + counts['subnets with gateway'],
+        'ips': counts['ips'],
+        'ports': ports,
+        'lswitches': ports,
+        'lswitch ports': ports,
+        'port ip associations': int(counts['owned ips'] * port_fraction),
+        'mac ranges': counts['mac ranges'],
+        'macs': int(counts['macs'] * port_fraction),
+        'port mac associations': int(counts['macs'] * port_fraction),
+        'policies': counts['subnets with policy'],
+        'policy links': counts['subnets with policy'] + counts['networks'],
+        'policy rules': int(rules_per_policy *
+                            counts['subnets with policy']),
+    }
+
+
+def written_by(rows, stages):
+    """
+    The part of quark_rows the stages write.
+
+    >>> rows = {'ports': 5, 'macs': 4, 'port mac associations': 4,
+    ...         'policies': 3}
+    >>> sorted(written_by(rows, [STAGES[3]]).items())
+    [('macs', 4), ('port mac associations', 4)]
+    """
+    names = set(n for stage in stages for n in stage_rows.get(stage.name,
+                                                              ()))
+    return dict((name, count) for name, count in rows.iteritems()
+                if name in names)
+
+
+def fit_line(points):
+    """
+    Least squares (intercept, slope) through (x, y) points, None when the
+    x's don't vary.
+
+    >>> fit_line([(100, 210.0), (200, 220.0), (400, 240.0)])
+    (200.0, 0.1)
+    >>> fit_line([(100, 210.0)]) is None
+    True
+    """
+    n = float(len(points))
+    if n < 2:
+        return None
+    mean_x = sum(x for x, y in points) / n
+    mean_y = sum(y for x, y in points) / n
+    spread = sum((x - mean_x) ** 2 for x, y in points)
+    if not spread:
+        return None
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / spread
+    return (round(mean_y - slope * mean_x, 6), round(slope, 6))
+
+
+class CostModel(object):
+    """Seconds per quark row of the run per stage, and peak MB for a
+    number of rows, calibrated on the reports of complete runs in the
+    history."""
+    def __init__(self, reports=()):
+        labels = dict((stage.label, stage.name) for stage in STAGES)
+        seconds = dict()
+        rows = dict()
+        memory = list()
+        for report in reports:
+            total = sum(sum(s['rows_written'].values())
+                        for s in report['stages'])
+            if not total:
+                continue
+            memory.append((total, report['peak_rss_mb']))
+            for stage in report['stages']:
+                name = labels.get(stage['stage'])
+                if name:
+                    seconds[name] = seconds.get(name, 0.0) + \
+                        stage['wall_seconds']
+                    rows[name] = rows.get(name, 0) + total
+        self.calibrated = sorted(seconds)
+        self.runs = len(memory)
+        self.seconds_per_row = dict(default_seconds_per_row)
+        for name in seconds:
+            self.seconds_per_row[name] = seconds[name] / rows[name]
+        self.memory = fit_line(memory)
+        if self.memory is None or self.memory[1] < 0:
+            if memory:
+                # one size only: scale the per-row part of the default
+                total, peak = max(memory)
+                self.memory = (default_memory[0],
+                               max(peak - default_memory[0], 0) / total)
+            else:
+                self.memory = default_memory
+
+    def seconds(self, stage, rows):
+        return self.seconds_per_row[stage] * rows
+
+    def peak_mb(self, rows):
+        return self.memory[0] + self.memory[1] * rows
+
+
+def recorded_reports(path=None, limit=calibration_runs, environment=None):
+    """The latest reports of complete runs of `environment` (every stage,
+    no scope, no errors) in the history."""
+    path = path or get_settings().history_path
+    if not os.path.exists(path):
+        return []
+    try:
+        db = history.connect(path)
+    except Exception:
+        plog.warning("No history to calibrate on.", exc_info=True)
+        return []
+    reports = list()
+    try:
+        rows = db.execute("SELECT report FROM runs WHERE environment IS ? "
+                          "ORDER BY id DESC", (environment,))
+        for row in rows:
+            report = json.loads(row[0])
+            # runs recorded before 'complete' was are left out too
+            if report.get('complete'):
+                reports.append(report)
+                if len(reports) >= limit:
+                    break
+    finally:
+        db.close()
+    return reports
+
+
+class Plan(object):
+    """`rows` are the quark rows the stages write, `size` those of a
+    complete run of the same melange."""
+    def __init__(self, counts, rows, stages, model, bridges, settings,
+                 ram_mb=None, size=None):
+        self.counts = counts
+        self.rows = rows
+        self.stages = stages
+        self.model = model
+        self.bridges = bridges
+        self.total_rows = sum(rows.values())
+        size = size or self.total_rows
+        # a stage reads and caches as much whatever else runs, commit
+        # only writes what the stages buffered
+        self.durations = [(stage, model.seconds(
+            stage.name, self.total_rows if stage.name == 'commit' else size))
+            for stage in stages]
+        # caches the stages need are rebuilt in full
+        self.peak_mb = model.peak_mb(size)
+        self.settings = settings
+        self.ram_mb = ram_mb
+
+    def recommendations(self):
+        settings = self.settings
+        advice = list()
+        if self.peak_mb <= settings.memory_budget_mb:
+            advice.append("In memory: the projected peak ({0:.0f} MB) fits "
+                          "memory_budget_mb ({1} MB), nothing should spill "
+                          "to disk.".format(self.peak_mb,
+                                            settings.memory_budget_mb))
+        else:
+            advice.append("Streaming: the projected peak ({0:.0f} MB) is "
+                          "over memory_budget_mb ({1} MB), caches and "
+                          "ledgers will spill to logs/ and the run slows "
+                          "down.".format(self.peak_mb,
+                                         settings.memory_budget_mb))
+        if self.ram_mb is not None:
+            if self.ram_mb < settings.min_ram_mb:
+                advice.append("This flavor has {0} MB of ram, under "
+                              "min_ram_mb ({1} MB).".format(
+                                  self.ram_mb, settings.min_ram_mb))
+            elif self.peak_mb > self.ram_mb:
+                advice.append("The projected peak is over this flavor's "
+                              "{0} MB of ram, keep memory_budget_mb below "
+                              "it or use a bigger flavor.".format(
+                                  self.ram_mb))
+        if settings.rss_budget_mb > settings.memory_budget_mb:
+            advice.append("rss_budget_mb ({0}) is over memory_budget_mb "
+                          "({1}), commits will not keep memory down."
+                          .format(settings.rss_budget_mb,
+                                  settings.memory_budget_mb))
+        return advice
+
+    def report(self):
+        lines = ["Melange:"]
+        for name in sorted(self.counts):
+            lines.append("  {0:<24} {1:>12}".format(name, self.counts[name]))
+        if self.bridges:
+            lines.append("  {0:<24} {1:>12}".format(
+                'devices nova knows', self.bridges['known devices']))
+            lines.append("  {0:<24} {1:>12}".format(
+                'devices to migrate', self.bridges['devices to migrate']))
+        else:
+            lines.append("  bridges not asked, every interface counted "
+                         "as a port")
+        lines.append("Quark rows:")
+        for name in sorted(self.rows):
+            lines.append("  {0:<24} {1:>12}".format(name, self.rows[name]))
+        lines.append("  {0:<24} {1:>12}".format('total', self.total_rows))
+        if self.model.runs:
+            lines.append("Stages (calibrated on {0} recorded runs{1}):"
+                         .format(self.model.runs, '' if len(
+                             self.model.calibrated) == len(STAGES) else
+                             ', defaults for stages never recorded'))
+        else:
+            lines.append("Stages (no recorded runs, rough defaults):")
+        for stage, seconds in self.durations:
+            lines.append("  {0:<44} {1:>10}".format(
+                stage.label, format_seconds(seconds)))
+        lines.append("  {0:<44} {1:>10}".format(
+            'total', format_seconds(sum(s for _, s in self.durations))))
+        lines.append("Projected peak RSS: {0:.0f} MB".format(self.peak_mb))
+        lines.extend(self.recommendations())
+        return '\n'.join(lines)
+
+
+def bridge_counts(nova, melanged, device_ids=None):
+    """Devices nova knows and devices to migrate, of `device_ids` only
+    when given (a scoped plan)."""
+    if device_ids is None:
+        instances = nova.get_instance_ids()
+        devices = melanged.get_interface_device_ids()
+    else:
+        instances = set(nova.get_instances_by_ids(device_ids))
+        devices = set(melanged.get_interfaces_by_device_ids(device_ids))
+    return {'known devices': len(devices & instances),
+            'devices': len(devices),
+            'devices to migrate': len(devices - instances)}
+
+
+def make_plan(melange_session, stages, scope, settings, bridges=None,
+              history_path=None, ram_mb=None, environment=None):
+    """Count, project and estimate; nothing is written."""
+    counts = melange_counts(melange_session, scope)
+    bridge_rows = None
+    port_fraction = 1.0
+    if bridges is not None:
+        device_ids = scope.device_ids(melange_session)
+        try:
+            bridge_rows = bridge_counts(*bridges, device_ids=device_ids)
+        except Exception:
+            plog.warning("Could not ask the bridges.", exc_info=True)
+    if bridge_rows:
+        if bridge_rows['devices']:
+            port_fraction = bridge_rows['devices to migrate'] / \
+                float(bridge_rows['devices'])
+    rows = quark_rows(counts, port_fraction)
+    model = CostModel(recorded_reports(history_path,
+                                       environment=environment))
+    return Plan(counts, written_by(rows, stages), stages, model,
+                bridge_rows, settings, ram_mb, size=sum(rows.values()))
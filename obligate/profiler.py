@@ -0,0 +1,198 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Profiling a migration without touching its code.
+
+SqlProfiler times statements from engine events, no sqlalchemy.log
+needed. Statements are grouped by shape (literals and IN lists
+collapsed) and by the stage running them. A shape run once per row shows
+up with a huge count and tiny latencies: that's an N+1.
+
+profile_call and trace_call wrap one stage in cProfile or tracemalloc.
+cProfile only sees the thread it runs in, so the writer threads (most of
+the commit stage) are not in its stats; --profile-sql times their
+statements.
+"""
+import cProfile
+import logging
+import random
+import re
+import threading
+import time
+
+from sqlalchemy import event
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2 needs pytracemalloc (and a patched interpreter) for it
+    tracemalloc = None
+
+plog = logging.getLogger('obligate.profiler')
+
+# latencies kept per shape for the percentiles
+reservoir_size = 1000
+
+_literals = re.compile(r"'(?:[^'\\]|\\.)*'|\b\d+(?:\.\d+)?\b")
+_in_lists = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_spaces = re.compile(r"\s+")
+
+
+def normalize(statement):
+    """
+    The shape of a statement: literals become ?, lists of them one (?).
+
+    >>> normalize("SELECT a FROM t WHERE id IN ('x', 'y',  %s) AND n = 5")
+    'SELECT a FROM t WHERE id IN (?) AND n = ?'
+    >>> normalize("INSERT INTO t (a, b) VALUES (%s, %s)")
+    'INSERT INTO t (a, b) VALUES (?)'
+    """
+    shape = statement.replace('%s', '?')
+    shape = _literals.sub('?', shape)
+    shape = _spaces.sub(' ', shape).strip()
+    return _in_lists.sub('(?)', shape)
+
+
+def percentile(ordered, fraction):
+    """
+    Nearest rank percentile of a sorted list.
+
+    >>> values = range(1, 101)
+    >>> percentile(values, 0.5), percentile(values, 0.95), \
+percentile(values, 0.99)
+    (50, 95, 99)
+    >>> percentile([], 0.5)
+    0.0
+    """
+    if not ordered:
+        return 0.0
+    rank = max(int(round(fraction * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class StatementStats(object):
+    __slots__ = ('count', 'seconds', 'rows', 'latencies')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.latencies = list()
+
+    def add(self, seconds, rows):
+        self.count += 1
+        self.seconds += seconds
+        self.rows += max(rows, 0)
+        if len(self.latencies) < reservoir_size:
+            self.latencies.append(seconds)
+        else:
+            # reservoir sampling keeps every run equally likely
+            i = random.randrange(self.count)
+            if i < reservoir_size:
+                self.latencies[i] = seconds
+
+
+class SqlProfiler(object):
+    """Aggregates every statement the watched engines run.
+
+    Set `stage` to attribute what follows to a stage, the writer threads
+    share it with the thread that set it.
+    """
+    def __init__(self):
+        self.stage = None
+        self.stats = dict()
+        # stages in the order they ran statements
+        self.stages = list()
+        self.lock = threading.Lock()
+
+    def watch(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        conn.info.setdefault('obligate_started', []).append(time.time())
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        seconds = time.time() - conn.info['obligate_started'].pop()
+        key = (self.stage, normalize(statement))
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = StatementStats()
+                if self.stage not in self.stages:
+                    self.stages.append(self.stage)
+            stats.add(seconds, cursor.rowcount)
+
+    def top(self, n=20):
+        """(stage, [(shape, stats)]) per stage, in the order stages ran,
+        with the n shapes of each that took longest in total."""
+        by_stage = dict()
+        for (stage, shape), stats in self.stats.iteritems():
+            by_stage.setdefault(stage, list()).append((shape, stats))
+        return [(stage, sorted(by_stage[stage],
+                               key=lambda item: item[1].seconds,
+                               reverse=True)[:n])
+                for stage in self.stages if stage in by_stage]
+
+    def report(self, n=20, width=120):
+        lines = ["{0:>10} {1:>9} {2:>10} {3:>8} {4:>8} {5:>8}  {6}".format(
+            'total s', 'count', 'rows', 'p50 ms', 'p95 ms', 'p99 ms',
+            'statement')]
+        for stage, shapes in self.top(n):
+            lines.append("{0}:".format(stage))
+            for shape, stats in shapes:
+                ordered = sorted(stats.latencies)
+                lines.append(
+                    "{0:>10.2f} {1:>9} {2:>10} {3:>8.2f} {4:>8.2f} "
+                    "{5:>8.2f}  {6}".format(stats.seconds, stats.count,
+                                            stats.rows,
+                                            percentile(ordered, 0.5) * 1000,
+                                            percentile(ordered, 0.95) * 1000,
+                                            percentile(ordered, 0.99) * 1000,
+                                            shape[:width]))
+        return '\n'.join(lines)
+
+
+def profile_call(path, fx, **kwargs):
+    """fx(**kwargs) under cProfile, the pstats are dumped to `path`."""
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(fx, **kwargs)
+    finally:
+        profile.dump_stats(path)
+        plog.info("cProfile stats written to {0}".format(path))
+
+
+def trace_call(path, fx, top=30, **kwargs):
+    """fx(**kwargs) tracing allocations. The `top` source lines that grew
+    the most between the snapshots before and after are written to
+    `path`."""
+    if tracemalloc is None:
+        plog.warning("tracemalloc is not available, not tracing "
+                     "allocations for {0}".format(path))
+        return fx(**kwargs)
+    tracemalloc.start(10)
+    before = tracemalloc.take_snapshot()
+    try:
+        return fx(**kwargs)
+    finally:
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        with open(path, 'w') as fh:
+            for stat in after.compare_to(before, 'lineno')[:top]:
+                fh.write("{0}\n".format(stat))
+        plog.info("Top allocations written to {0}".format(path))
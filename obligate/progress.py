@@ -0,0 +1,163 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Rows done, rows per second and ETA of the running stage.
+
+Row totals per stage are estimated from COUNT queries on melange before
+the first stage. A stage's progress is read from a counter the
+migration keeps anyway; a background thread polls it, so nothing is
+added to the per-row path.
+"""
+import logging
+import sys
+import threading
+import time
+
+from sqlalchemy import func
+
+from models import melange
+
+plog = logging.getLogger('obligate.progress')
+
+
+def melange_counts(session, scope):
+    """Rows of each kind in melange, within scope."""
+    def count(column, *criteria):
+        return session.query(func.count(column)).filter(*criteria).scalar()
+
+    blocks = scope.blocks()
+    in_blocks = [melange.IpBlocks.id == melange.IpAddresses.ip_block_id]
+    counts = {
+        'subnets': count(melange.IpBlocks.id, *blocks),
+        'subnets with policy': count(
+            melange.IpBlocks.id, melange.IpBlocks.policy_id != None,
+            *blocks),
+        'subnets with gateway': count(
+            melange.IpBlocks.id, melange.IpBlocks.gateway != None,
+            *blocks),
+        'networks': count(melange.IpBlocks.network_id.distinct(), *blocks),
+        'policies': count(melange.IpBlocks.policy_id.distinct(), *blocks),
+        'ips': count(melange.IpAddresses.id, *(in_blocks + blocks)),
+        'owned ips': count(melange.IpAddresses.id,
+                           melange.IpAddresses.interface_id != None,
+                           *(in_blocks + blocks)),
+        'routes': count(
+            melange.IpRoutes.id,
+            melange.IpBlocks.id == melange.IpRoutes.source_block_id,
+            *blocks),
+        'interfaces': count(melange.Interfaces.id,
+                            *scope.interfaces(session)),
+        'mac ranges': count(melange.MacAddressRanges.id),
+        'macs': count(melange.MacAddresses.id, *scope.macs(session)),
+        'octets': count(melange.IpOctets.id, *scope.octets(session)),
+        'ranges': count(melange.IpRanges.id, *scope.ranges(session)),
+    }
+    session.rollback()
+    return counts
+
+
+def expected_rows(counts):
+    """Rows each stage is expected to buffer, by stage name.
+
+    Upper bounds mostly: interfaces nova knows, macs without a port and
+    default policy rules are left out later.
+    """
+    return {
+        # subnet, two nameservers and a default route per block
+        'networks': counts['networks'] + 4 * counts['subnets'] +
+        counts['ips'] + counts['routes'],
+        # port and nvp switch and switch port
+        'interfaces': 3 * counts['interfaces'],
+        'associations': counts['owned ips'],
+        # the mac and its port association
+        'macs': counts['mac ranges'] + 2 * counts['macs'],
+        # policy and network and subnet links per block, plus the rules
+        'policies': 3 * counts['subnets'] + counts['octets'] +
+        counts['ranges'],
+    }
+
+
+def format_seconds(seconds):
+    """
+    >>> format_seconds(3725.2), format_seconds(59)
+    ('1:02:05', '0:00:59')
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{0}:{1:02d}:{2:02d}".format(hours, minutes, seconds)
+
+
+def progress_line(label, done, total, seconds):
+    """
+    >>> progress_line('migrate ports', 1500, 6000, 30.0)
+    'migrate ports: 1500/6000 rows (25%), 50/s, ETA 0:01:30'
+    >>> progress_line('validate ips', 1500, None, 30.0)
+    'validate ips: 1500 rows, 50/s'
+    """
+    rate = done / seconds if seconds > 0 else 0.0
+    if not total:
+        return "{0}: {1} rows, {2:.0f}/s".format(label, done, rate)
+    # totals are estimates, never show more than all of it done
+    left = max(total - done, 0)
+    eta = format_seconds(left / rate) if rate else '?'
+    return "{0}: {1}/{2} rows ({3:.0%}), {4:.0f}/s, ETA {5}".format(
+        label, done, total, min(float(done) / total, 1.0), rate, eta)
+
+
+class ProgressReporter(object):
+    """Logs the running stage's progress every `interval` seconds.
+
+    `counter` is a callable returning rows done so far, it is called from
+    the reporter's thread. With `console` the same line is redrawn on
+    stdout every second.
+    """
+    def __init__(self, interval=30, console=False):
+        self.interval = interval
+        self.console = console
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self, label, counter, total=None):
+        self.stop()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._report,
+            args=(label, counter, total, counter(), time.time()))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def _report(self, label, counter, total, first, started):
+        tick = 1 if self.console else self.interval
+        logged = started
+        while not self.stopped.wait(tick):
+            now = time.time()
+            line = progress_line(label, counter() - first, total,
+                                 now - started)
+            if self.console:
+                sys.stdout.write('\r' + line[:119].ljust(119))
+                sys.stdout.flush()
+            # waits may end a little early
+            if now - logged >= self.interval - tick / 2.0:
+                plog.info(line)
+                logged = now
+        if self.console:
+            sys.stdout.write('\n')
+            sys.stdout.flush()
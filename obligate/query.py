@@ -1,15 +1,55 @@
+import time
+
 import requests
 from requests.auth import HTTPBasicAuth
 
+from profiler import normalize
+
+
+# ids per query when asking for a list of them
+ids_per_query = 500
+
+
+def quoted(ids):
+    """
+    Ids as a list of mysql string literals.
+
+    >>> print quoted(['a', 'b"c'])
+    "a","b\\"c"
+    """
+    return ','.join('"{0}"'.format(i.replace('\\', '\\\\').
+                                   replace('"', '\\"')) for i in ids)
+
 
 class MysqlJsonBridgeEndpoint(object):
+    # a throttle.Throttle pacing the calls, if any
+    throttle = None
+
+    def run_query_in(self, sql, ids):
+        """sql with {0} replaced by chunks of quoted ids, the results of
+        every chunk together."""
+        ids = sorted(ids)
+        result = list()
+        for i in range(0, len(ids), ids_per_query):
+            result.extend(self.run_query(
+                sql.format(quoted(ids[i:i + ids_per_query]))) or [])
+        return result
+
     def run_query(self, sql):
         data = {'sql': sql}
+        if self.throttle:
+            self.throttle.before_query()
+        started = time.time()
         r = self.session.post(self.url, data=data,
                               verify=False, auth=self.auth)
         self.calls += 1
         r.raise_for_status()
-        return r.json()['result']
+        result = r.json()['result']
+        if self.throttle:
+            self.throttle.query_done(time.time() - started,
+                                     normalize(sql))
+            self.throttle.read(len(result or []))
+        return result
 
     def first_result(self, result):
         try:
@@ -48,6 +88,23 @@ class Melange(MysqlJsonBridgeEndpoint):
         return dict((interface['device_id'], interface)
                     for interface in self.get_interfaces())
 
+    def get_interfaces_by_device_ids(self, device_ids):
+        """Like get_interfaces_hashed_by_device_id, for some devices."""
+        select_list = ['interfaces.id', 'mac_addresses.address as mac',
+                       'device_id',
+                       'group_concat(ip_addresses.address) as ips']
+        sql = ('select %s from interfaces left join mac_addresses '
+               'on interfaces.id=mac_addresses.interface_id left join '
+               'ip_addresses on interfaces.id=ip_addresses.interface_id '
+               'where device_id in ({0}) group by interfaces.id')
+        return dict((interface['device_id'], interface)
+                    for interface in self.run_query_in(
+                        sql % ','.join(select_list), device_ids))
+
+    def get_interface_device_ids(self):
+        sql = 'select distinct device_id from interfaces'
+        return set(row['device_id'] for row in self.run_query(sql))
+
 
 class Nova(MysqlJsonBridgeEndpoint):
     def __init__(self, url, username, password):
@@ -70,3 +127,15 @@ class Nova(MysqlJsonBridgeEndpoint):
     def get_instances_hashed_by_id(self):
         return dict((instance['uuid'], instance)
                     for instance in self.get_instances())
+
+    def get_instances_by_ids(self, ids):
+        """Like get_instances_hashed_by_id, for some uuids."""
+        select_list = ['uuid', 'vm_state', 'terminated_at', 'cell_name']
+        sql = 'select %s from instances where uuid in ({0}) and deleted=0'
+        return dict((instance['uuid'], instance)
+                    for instance in self.run_query_in(
+                        sql % ','.join(select_list), ids))
+
+    def get_instance_ids(self):
+        sql = 'select uuid from instances where deleted=0'
+        return set(row['uuid'] for row in self.run_query(sql))
@@ -0,0 +1,151 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Read-only melange rows.
+
+Obligate never writes to melange and only needs a handful of columns per
+table, so rows are read as plain column tuples and kept in small slotted
+records instead of mapped melange instances: no identity map, no instance
+state, no attribute instrumentation. The record's __slots__ double as the
+list of columns that are selected.
+"""
+from metrics import count_read
+from models import melange
+from throttle import active
+from utils import trim_br
+
+read_chunk_size = 10000
+
+
+class MelangeRecord(object):
+    __slots__ = ()
+    model = None
+
+    def __init__(self, row):
+        for name, value in zip(self.__slots__, row):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "<{0} {1}>".format(self.__class__.__name__,
+                                  getattr(self, self.__slots__[0]))
+
+    @classmethod
+    def query(cls, session):
+        return session.query(*[getattr(cls.model, column)
+                               for column in cls.__slots__])
+
+    @classmethod
+    def iterate(cls, query, chunk_size=None):
+        """Stream records out of a query built from `cls.query`."""
+        rows = 0
+        throttle = active()
+        if throttle is not None:
+            chunks = cls._chunks(query, throttle)
+        else:
+            chunks = [query.yield_per(chunk_size or read_chunk_size)]
+        try:
+            for chunk in chunks:
+                for row in chunk:
+                    rows += 1
+                    yield cls(row)
+        finally:
+            count_read(cls.model.__tablename__, rows)
+
+    @classmethod
+    def _chunks(cls, query, throttle):
+        """The query's rows as separate statements of throttle.chunk_rows
+        rows, by id, so no statement scans a whole table and the throttle
+        can pause in between."""
+        query = query.add_columns(cls.model.id).order_by(cls.model.id)
+        last = None
+        while True:
+            page = query
+            if last is not None:
+                page = page.filter(cls.model.id > last)
+            chunk = page.limit(throttle.chunk_rows).all()
+            throttle.read(len(chunk))
+            if chunk:
+                yield chunk
+            if len(chunk) < throttle.chunk_rows:
+                break
+            # the id was added as the last column
+            last = chunk[-1][-1]
+
+    @classmethod
+    def all(cls, session, *criterion):
+        return list(cls.iterate(cls.query(session).filter(*criterion)))
+
+    @classmethod
+    def first(cls, session, *criterion):
+        row = cls.query(session).filter(*criterion).first()
+        if row is None:
+            return None
+        return cls(row)
+
+
+class Block(MelangeRecord):
+    """An ip_block, network_id has its "br-" prefix trimmed already."""
+    __slots__ = ('id', 'network_id', 'tenant_id', 'network_name',
+                 'max_allocation', 'created_at', 'cidr', 'omg_do_not_use',
+                 'dns1', 'dns2', 'gateway', 'policy_id')
+    model = melange.IpBlocks
+
+    def __init__(self, row):
+        super(Block, self).__init__(row)
+        self.network_id = trim_br(self.network_id)
+
+
+class Address(MelangeRecord):
+    __slots__ = ('id', 'ip_block_id', 'interface_id', 'address',
+                 'used_by_tenant_id', 'created_at', 'marked_for_deallocation',
+                 'deallocated_at')
+    model = melange.IpAddresses
+
+
+class Route(MelangeRecord):
+    __slots__ = ('id', 'source_block_id', 'netmask', 'destination',
+                 'gateway')
+    model = melange.IpRoutes
+
+
+class Interface(MelangeRecord):
+    __slots__ = ('id', 'device_id', 'tenant_id', 'created_at',
+                 'vif_id_on_device')
+    model = melange.Interfaces
+
+
+class MacRange(MelangeRecord):
+    __slots__ = ('id', 'cidr', 'created_at')
+    model = melange.MacAddressRanges
+
+
+class Mac(MelangeRecord):
+    __slots__ = ('address', 'interface_id', 'created_at')
+    model = melange.MacAddresses
+
+
+class Octet(MelangeRecord):
+    __slots__ = ('policy_id', 'octet', 'created_at')
+    model = melange.IpOctets
+
+
+class IpRange(MelangeRecord):
+    __slots__ = ('policy_id', 'offset', 'length', 'created_at')
+    model = melange.IpRanges
+
+
+class Policy(MelangeRecord):
+    __slots__ = ('id', 'description')
+    model = melange.Policies
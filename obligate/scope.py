@@ -0,0 +1,137 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from models import melange
+from quark.db import models as quarkmodels
+from utils import trim_br
+
+
+def parse_ids(values):
+    """
+    Flatten repeated and comma separated command line ids.
+
+    >>> parse_ids(['a,b', ' c ', ''])
+    ['a', 'b', 'c']
+    >>> parse_ids(None)
+    []
+    """
+    ids = list()
+    for value in values or []:
+        ids.extend(i.strip() for i in value.split(',') if i.strip())
+    return ids
+
+
+class MigrationScope(object):
+    """Restricts a run to some tenants and/or networks.
+
+    An empty scope is the whole region. Otherwise every stage only reads
+    the melange rows that belong to the selected ip_blocks (blocks of one
+    of the tenants and, when networks are given too, in one of the
+    networks): their ips and
+    routes, the interfaces and macs holding those ips and the policies of
+    those blocks. Each method returns filter criteria, empty when there
+    is nothing to restrict, so callers can always unpack them into
+    filter().
+    """
+    def __init__(self, tenant_ids=None, network_ids=None):
+        self.tenant_ids = list(tenant_ids or [])
+        self.network_ids = list(network_ids or [])
+
+    def __nonzero__(self):
+        return bool(self.tenant_ids or self.network_ids)
+
+    def __str__(self):
+        if not self:
+            return "whole region"
+        return "{0} tenants, {1} networks".format(len(self.tenant_ids),
+                                                  len(self.network_ids))
+
+    def melange_network_ids(self):
+        # melange keeps some network ids with a "br-" prefix
+        ids = set()
+        for network_id in self.network_ids:
+            ids.add(trim_br(network_id))
+            ids.add("br-" + trim_br(network_id))
+        return sorted(ids)
+
+    def blocks(self):
+        criteria = list()
+        if self.tenant_ids:
+            criteria.append(melange.IpBlocks.tenant_id.in_(self.tenant_ids))
+        if self.network_ids:
+            criteria.append(melange.IpBlocks.network_id.in_(
+                self.melange_network_ids()))
+        return criteria
+
+    def _interface_ids(self, session):
+        return session.query(melange.IpAddresses.interface_id).\
+            join(melange.IpBlocks,
+                 melange.IpBlocks.id == melange.IpAddresses.ip_block_id).\
+            filter(*self.blocks()).subquery()
+
+    def interfaces(self, session):
+        if not self:
+            return []
+        return [melange.Interfaces.id.in_(self._interface_ids(session))]
+
+    def device_ids(self, session):
+        """Devices of the interfaces in scope, for the bridges; None when
+        the scope is the whole region."""
+        if not self:
+            return None
+        rows = session.query(melange.Interfaces.device_id).\
+            filter(*self.interfaces(session)).distinct()
+        return set(device_id for device_id, in rows if device_id)
+
+    def macs(self, session):
+        if not self:
+            return []
+        return [melange.MacAddresses.interface_id.in_(
+            self._interface_ids(session))]
+
+    def _policy_ids(self, session):
+        return session.query(melange.IpBlocks.policy_id).\
+            filter(*self.blocks()).subquery()
+
+    def policies(self, session):
+        if not self:
+            return []
+        return [melange.Policies.id.in_(self._policy_ids(session))]
+
+    def octets(self, session):
+        if not self:
+            return []
+        return [melange.IpOctets.policy_id.in_(self._policy_ids(session))]
+
+    def ranges(self, session):
+        if not self:
+            return []
+        return [melange.IpRanges.policy_id.in_(self._policy_ids(session))]
+
+    def quark_subnets(self):
+        criteria = list()
+        if self.tenant_ids:
+            criteria.append(quarkmodels.Subnet.tenant_id.in_(
+                self.tenant_ids))
+        if self.network_ids:
+            criteria.append(quarkmodels.Subnet.network_id.in_(
+                [trim_br(n) for n in self.network_ids]))
+        return criteria
+
+    def quark_ips(self, session):
+        if not self:
+            return []
+        subnet_ids = session.query(quarkmodels.Subnet.id).\
+            filter(*self.quark_subnets()).subquery()
+        return [quarkmodels.IPAddress.subnet_id.in_(subnet_ids)]
@@ -0,0 +1,117 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+The stages of a migration and what they depend on.
+
+A stage writes some ledger tables, needs some in-memory caches and
+provides others. `after` lists the stages whose rewrite invalidates this
+stage's rows (quark rows referencing theirs), so rerunning one of those
+reruns this one too.
+"""
+
+
+class Stage(object):
+    def __init__(self, name, label, method, tables=(), needs=(),
+                 provides=(), after=()):
+        self.name = name
+        self.label = label
+        self.method = method
+        self.tables = tables
+        self.needs = needs
+        self.provides = provides
+        self.after = after
+
+    def __repr__(self):
+        return "<Stage {0}>".format(self.name)
+
+
+STAGES = [
+    Stage('networks', "migrate networks, subnets, routes, and ips",
+          'migrate_networks',
+          tables=('networks', 'subnets', 'routes', 'ips'),
+          provides=('interface networks', 'policy index')),
+    Stage('interfaces', "migrate ports", 'migrate_interfaces',
+          tables=('interfaces',),
+          needs=('interface networks',),
+          provides=('ports',),
+          after=('networks',)),
+    Stage('associations', "associating ips with ports",
+          'associate_ips_with_ports',
+          needs=('interface networks', 'ports'),
+          after=('networks', 'interfaces')),
+    Stage('macs', "migrate macs and ranges", 'migrate_macs',
+          tables=('mac_ranges', 'macs'),
+          needs=('interface networks', 'ports'),
+          after=('interfaces',)),
+    Stage('policies', "migrate policies", 'migrate_policies',
+          tables=('policies', 'policy_rules'),
+          needs=('policy index',),
+          after=('networks',)),
+    Stage('commit', "commit changes", 'migrate_commit',
+          after=('networks', 'interfaces', 'associations', 'macs',
+                 'policies')),
+    Stage('validate', "validate ips", 'validate_ips',
+          after=('networks',)),
+]
+
+
+def select_stages(names, stages=STAGES):
+    """
+    The stages to run for a list of stage or ledger table names, in run
+    order. Stages invalidated by a selected one are added.
+
+    >>> select_stages(['macs'])
+    [<Stage macs>, <Stage commit>]
+    >>> select_stages(['policy_rules', 'interfaces'])
+    [<Stage interfaces>, <Stage associations>, <Stage macs>, \
+<Stage policies>, <Stage commit>]
+    >>> len(select_stages(['networks'])) == len(STAGES)
+    True
+    >>> select_stages(['bogus'])
+    Traceback (most recent call last):
+        ...
+    ValueError: Unknown stage or table: bogus
+    """
+    selected = set()
+    for name in names:
+        matches = [s.name for s in stages
+                   if s.name == name or name in s.tables]
+        if not matches:
+            raise ValueError("Unknown stage or table: {0}".format(name))
+        selected.update(matches)
+    # stages are listed in run order, so one pass closes over `after`
+    for stage in stages:
+        if selected.intersection(stage.after):
+            selected.add(stage.name)
+    return [s for s in stages if s.name in selected]
+
+
+def caches_to_rebuild(selected):
+    """
+    Caches the selected stages need that none of them provides.
+
+    >>> caches_to_rebuild(select_stages(['macs']))
+    ['interface networks', 'ports']
+    >>> caches_to_rebuild(select_stages(['networks']))
+    []
+    """
+    provided = set()
+    missing = list()
+    for stage in selected:
+        for cache in stage.needs:
+            if cache not in provided and cache not in missing:
+                missing.append(cache)
+        provided.update(stage.provides)
+    return missing
@@ -0,0 +1,246 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A made up melange, as big as asked for.
+
+The shape follows production: tenants own a few networks of a few /24
+blocks, most addresses belong to an interface (two per interface),
+some are deallocated, some interfaces have no address at all, every
+interface has a mac out of one mac range and every tenant a policy of
+octets and ranges. The same parameters and seed always give the same
+rows, see DatasetSpec.fingerprint().
+"""
+import datetime
+import hashlib
+import json
+import random
+import uuid
+
+from models import melange
+
+insert_chunk_size = 10000
+
+
+class DatasetSpec(object):
+    """How big and what shape the generated melange is."""
+    def __init__(self, ips=10000, ips_per_block=200, blocks_per_network=2,
+                 networks_per_tenant=3, ips_per_interface=2,
+                 deallocated_fraction=0.05, orphan_fraction=0.02,
+                 octets_per_policy=2, ranges_per_policy=2,
+                 routes_per_block=1, seed=1):
+        self.ips = ips
+        self.ips_per_block = ips_per_block
+        self.blocks_per_network = blocks_per_network
+        self.networks_per_tenant = networks_per_tenant
+        self.ips_per_interface = ips_per_interface
+        self.deallocated_fraction = deallocated_fraction
+        self.orphan_fraction = orphan_fraction
+        self.octets_per_policy = octets_per_policy
+        self.ranges_per_policy = ranges_per_policy
+        self.routes_per_block = routes_per_block
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def fingerprint(self):
+        """
+        Identifies the dataset, whatever database it was loaded into.
+
+        >>> DatasetSpec(ips=10).fingerprint() == \
+DatasetSpec(ips=10).fingerprint()
+        True
+        >>> DatasetSpec(ips=10).fingerprint() == \
+DatasetSpec(ips=20).fingerprint()
+        False
+        """
+        return hashlib.sha1(json.dumps(self.as_dict(),
+                                       sort_keys=True)).hexdigest()[:12]
+
+
+def block_cidr(n):
+    """
+    The n-th /24 from 10.0.0.0 on.
+
+    >>> block_cidr(0), block_cidr(257)
+    ('10.0.0.0/24', '10.1.1.0/24')
+    """
+    base = (10 << 24) + (n << 8)
+    return "{0}.{1}.{2}.0/24".format(base >> 24, (base >> 16) & 255,
+                                     (base >> 8) & 255)
+
+
+class Generator(object):
+    """Writes a DatasetSpec into the melange tables of `engine`."""
+    def __init__(self, spec, engine):
+        self.spec = spec
+        self.engine = engine
+        self.random = random.Random(spec.seed)
+        self.created_at = datetime.datetime(2013, 1, 1)
+        self.counts = dict()
+        self.buffers = dict()
+
+    def uuid(self):
+        return str(uuid.UUID(int=self.random.getrandbits(128)))
+
+    def add(self, model, **row):
+        rows = self.buffers.setdefault(model, list())
+        rows.append(row)
+        if len(rows) >= insert_chunk_size:
+            self.flush(model)
+
+    def flush(self, model):
+        rows = self.buffers.pop(model, None)
+        if rows:
+            self.engine.execute(model.__table__.insert(), rows)
+            name = model.__tablename__
+            self.counts[name] = self.counts.get(name, 0) + len(rows)
+
+    def generate(self):
+        """Create the melange tables and fill them, returns row counts."""
+        spec = self.spec
+        melange.Base.metadata.drop_all(self.engine)
+        melange.Base.metadata.create_all(self.engine)
+        self.engine.execute(melange.MigrationVersion.__table__.insert(),
+                            repository_id='melange', version=6)
+        self.add_macs_range()
+        blocks = -(-spec.ips // spec.ips_per_block)
+        networks = -(-blocks // spec.blocks_per_network)
+        tenant = policy = network = None
+        for n in xrange(blocks):
+            if n % spec.blocks_per_network == 0:
+                if (n // spec.blocks_per_network) % \
+                        spec.networks_per_tenant == 0:
+                    tenant = "tenant-{0}".format(n)
+                    policy = self.add_policy(tenant)
+                network = self.uuid()
+                # melange kept some network ids with a bridge prefix
+                if self.random.random() < 0.1:
+                    network = "br-" + network
+            ips = min(spec.ips_per_block, spec.ips - n * spec.ips_per_block)
+            self.add_block(n, network, tenant, policy, ips)
+        for model in list(self.buffers):
+            self.flush(model)
+        self.counts['networks'] = networks
+        return self.counts
+
+    def add_macs_range(self):
+        self.mac_range = self.uuid()
+        self.next_mac = 0xAABBCC000000
+        self.add(melange.MacAddressRanges, id=self.mac_range,
+                 cidr="AA:BB:CC/24", created_at=self.created_at)
+
+    def add_policy(self, tenant):
+        policy = self.uuid()
+        self.add(melange.Policies, id=policy, description=tenant,
+                 created_at=self.created_at)
+        for octet in self.random.sample(range(256),
+                                        self.spec.octets_per_policy):
+            self.add(melange.IpOctets, id=self.uuid(), policy_id=policy,
+                     octet=octet, created_at=self.created_at)
+        for i in xrange(self.spec.ranges_per_policy):
+            self.add(melange.IpRanges, id=self.uuid(), policy_id=policy,
+                     offset=self.random.randrange(-2, 250),
+                     length=self.random.randrange(1, 8),
+                     created_at=self.created_at)
+        return policy
+
+    def add_interface(self, tenant):
+        interface = self.uuid()
+        self.add(melange.Interfaces, id=interface, tenant_id=tenant,
+                 device_id=self.uuid(), vif_id_on_device=self.uuid(),
+                 created_at=self.created_at)
+        self.add(melange.MacAddresses, id=self.uuid(),
+                 address=self.next_mac, interface_id=interface,
+                 created_at=self.created_at)
+        self.next_mac += 1
+        return interface
+
+    def add_block(self, n, network, tenant, policy, ips):
+        spec = self.spec
+        block = self.uuid()
+        cidr = block_cidr(n)
+        prefix = cidr.rsplit('.', 1)[0]
+        self.add(melange.IpBlocks, id=block, network_id=network,
+                 network_name="network {0}".format(n), cidr=cidr,
+                 tenant_id=tenant, gateway=prefix + ".1",
+                 dns1="8.8.8.8", dns2="8.8.4.4", policy_id=policy,
+                 max_allocation=spec.ips_per_block, omg_do_not_use=False,
+                 created_at=self.created_at)
+        for i in xrange(spec.routes_per_block):
+            self.add(melange.IpRoutes, id=self.uuid(),
+                     source_block_id=block, gateway=prefix + ".1",
+                     destination="192.168.{0}.0".format(i),
+                     netmask="255.255.255.0", created_at=self.created_at)
+        interface = None
+        for i in xrange(ips):
+            deallocated = self.random.random() < spec.deallocated_fraction
+            if deallocated:
+                interface_id = None
+            else:
+                if interface is None or \
+                        i % spec.ips_per_interface == 0:
+                    interface = self.add_interface(tenant)
+                interface_id = interface
+            self.add(melange.IpAddresses, id=self.uuid(),
+                     ip_block_id=block, address="{0}.{1}".format(prefix,
+                                                                 i + 2),
+                     interface_id=interface_id, used_by_tenant_id=tenant,
+                     marked_for_deallocation=deallocated,
+                     deallocated_at=self.created_at if deallocated
+                     else None,
+                     created_at=self.created_at)
+            if self.random.random() < spec.orphan_fraction:
+                # an interface without addresses, so without a network
+                self.add_interface(tenant)
+
+
+class SyntheticBridges(object):
+    """Stands in for the nova and melange mysql json bridges.
+
+    Nova knows `instance_fraction` of the devices, migrate_interfaces
+    skips those like it does in production.
+    """
+    def __init__(self, melange_session, instance_fraction=0.01, seed=1):
+        rows = melange_session.query(melange.Interfaces.id,
+                                     melange.Interfaces.device_id)
+        self.interfaces = dict((device_id, {'id': interface_id,
+                                            'device_id': device_id})
+                               for interface_id, device_id in rows)
+        melange_session.rollback()
+        chooser = random.Random(seed)
+        self.instances = dict((device_id, {'uuid': device_id})
+                              for device_id in sorted(self.interfaces)
+                              if chooser.random() < instance_fraction)
+
+    def get_instances_hashed_by_id(self):
+        return self.instances
+
+    def get_interfaces_hashed_by_device_id(self):
+        return self.interfaces
+
+    def get_instances_by_ids(self, ids):
+        return dict((i, self.instances[i]) for i in ids
+                    if i in self.instances)
+
+    def get_interfaces_by_device_ids(self, device_ids):
+        return dict((i, self.interfaces[i]) for i in device_ids
+                    if i in self.interfaces)
+
+    def get_instance_ids(self):
+        return set(self.instances)
+
+    def get_interface_device_ids(self):
+        return set(self.interfaces)
@@ -22,12 +22,18 @@ import json
 import logging
 from obligate.models import melange, neutron
 from obligate import obligate
-from obligate.utils import loadSession
-from obligate.utils import make_offset_lengths, migrate_tables
+from obligate.synthetic import DatasetSpec, Generator
+from obligate.utils import deterministic_id
+from obligate.utils import get_settings, init_id, loadSession
+from obligate.utils import make_offset_lengths
 from obligate.utils import translate_netmask, trim_br
+from obligate.writer import table_name, WriteScheduler
 import os
 from quark.db import models as quarkmodels
-from sqlalchemy import distinct, func
+import shutil
+from sqlalchemy import create_engine, distinct, func
+import tempfile
+import threading
 import unittest2
 
 
@@ -43,8 +49,8 @@ migrate_version = config.get('system_reqs', 'dbversion', '6')
 
 class TestMigration(unittest2.TestCase):
     def setUp(self):
-        self.melange_session = loadSession(melange.engine)
-        self.neutron_session = loadSession(neutron.engine)
+        self.melange_session = loadSession(melange.get_engine())
+        self.neutron_session = loadSession(neutron.get_engine())
         self.json_data = dict()
         self.log = logging.getLogger('obligate.tests')
 
@@ -98,7 +104,7 @@ class TestMigration(unittest2.TestCase):
         migration = obligate.Obligator(self.melange_session,
                                        self.neutron_session)
         migration.migrate()
-        for table in migrate_tables:
+        for table in get_settings().migrate_tables:
             jfile = self.get_newest_json_file(table)
             self.log.info("newest json file is {0}".format(jfile))
             data = open(jfile)
@@ -249,9 +255,12 @@ class TestMigration(unittest2.TestCase):
             self.assertEqual(_q_mac_address.address, _mac_address.address)
 
     def _validate_policies(self):
-        blocks_count = self.get_scalar(melange.IpBlocks.id,
-                                       self.melange_session,
-                                       filter=[melange.IpBlocks.policy_id != None])  # noqa
+        if get_settings().dedupe_policies:
+            blocks_count = len(self._get_policy_groups())
+        else:
+            blocks_count = self.get_scalar(melange.IpBlocks.id,
+                                           self.melange_session,
+                                           filter=[melange.IpBlocks.policy_id != None])  # noqa
         qpolicies_count = self.get_scalar(quarkmodels.IPPolicy.id,
                                           self.neutron_session)
         err_count = self.count_not_migrated("policies")
@@ -259,24 +268,29 @@ class TestMigration(unittest2.TestCase):
                                       blocks_count - err_count,
                                       "Policies", qpolicies_count)
 
-    def _get_policy_offset_total(self):
-        total_policy_offsets = 0
-        policy_ids = {}
+    def _get_policy_groups(self):
+        """(policy_id, group) -> block ids for every quark policy expected,
+        a group is a tenant with dedupe_policies or a block without."""
+        groups = {}
         blocks = self.melange_session.query(melange.IpBlocks).all()
         for block in blocks:
             if block.policy_id:
-                if block.policy_id not in policy_ids.keys():
-                    policy_ids[block.policy_id] = {}
-                policy_ids[block.policy_id][block.id] = block.network_id
+                group = block.tenant_id if get_settings().dedupe_policies \
+                    else block.id
+                groups.setdefault((block.policy_id, group), []).\
+                    append(block.id)
+        return groups
+
+    def _get_policy_offset_total(self):
+        total_policy_offsets = 0
         octets = self.melange_session.query(melange.IpOctets).all()
         offsets = self.melange_session.query(melange.IpRanges).all()
-        for policy, policy_block_ids in policy_ids.items():
+        for policy, group in self._get_policy_groups().keys():
             policy_octets = [o.octet for o in octets if o.policy_id == policy]
             policy_offsets = [(off.offset, off.length) for off in offsets
                               if off.policy_id == policy]
             policy_offsets = make_offset_lengths(policy_octets, policy_offsets)
-            for block_id in policy_block_ids.keys():
-                total_policy_offsets += len(policy_offsets)
+            total_policy_offsets += len(policy_offsets)
         return total_policy_offsets
 
     def _validate_policy_rules(self):
@@ -323,3 +337,167 @@ class TestMigration(unittest2.TestCase):
                   "not equal the number of Quark {2} ({3})".\
                   format(melange_type, melange_count, quark_type, quark_count)
         self.assertEqual(melange_count, quark_count, message)
+
+
+class RecordingScheduler(WriteScheduler):
+    """Fails the first `deadlocks` commits with a mysql deadlock and
+    records the tables it commits, in order."""
+    def __init__(self, engine, deadlocks=0, **kwargs):
+        WriteScheduler.__init__(self, engine, **kwargs)
+        self.deadlocks = deadlocks
+        self.attempts = 0
+        self.committed_tables = list()
+        self.lock = threading.Lock()
+
+    def _commit(self, session, model, items):
+        with self.lock:
+            self.attempts += 1
+            if self.deadlocks:
+                self.deadlocks -= 1
+                error = Exception("Deadlock found")
+                error.orig = Exception(1213, "Deadlock found")
+                raise error
+        WriteScheduler._commit(self, session, model, items)
+        with self.lock:
+            self.committed_tables.append(table_name(model))
+
+
+def make_network(i):
+    return quarkmodels.Network(id="network-{0}".format(i),
+                               tenant_id="tenant", name="network")
+
+
+class TestWriteScheduler(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = create_engine(
+            'sqlite:///{0}/quark.sqlite'.format(self.tmpdir))
+        quarkmodels.BASEV2.metadata.create_all(self.engine)
+        self.neutron_session = loadSession(self.engine)
+
+    def tearDown(self):
+        self.neutron_session.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_connection_error_fails_flush(self):
+        # no quark tables: every row fails alike, nothing is bisected
+        writer = WriteScheduler(create_engine('sqlite://'), writers=1)
+        for i in range(4):
+            writer.add(make_network(i))
+        self.assertRaises(Exception, writer.flush)
+        self.assertEqual(writer.rejected, [])
+        self.assertEqual(writer.written, {})
+
+    def test_duplicate_row_is_rejected(self):
+        self.neutron_session.add(make_network(3))
+        self.neutron_session.commit()
+        migration = obligate.Obligator(neutron_sess=self.neutron_session)
+        migration.writer.writers = 1
+        for i in range(10):
+            init_id(migration.json_data, 'networks', "network-{0}".format(i))
+            migration.add_to_session(make_network(i), 'networks',
+                                     "network-{0}".format(i))
+        migration.migrate_commit()
+        networks = table_name(quarkmodels.Network)
+        self.assertEqual(migration.writer.written, {networks: 9})
+        self.assertEqual(self.neutron_session.query(
+            func.count(quarkmodels.Network.id)).scalar(), 10)
+        ledger = migration.json_data['networks']
+        rejected = [i for i, entry in ledger['ids'].iteritems()
+                    if not entry['migrated']]
+        self.assertEqual(rejected, ["network-3"])
+        self.assertTrue(ledger['ids']["network-3"]['reason'].
+                        startswith("write failed"))
+        self.assertFalse(migration.error_free)
+
+    def test_parents_are_committed_first(self):
+        writer = RecordingScheduler(self.engine, writers=4)
+        # children added first, the flush still waits for their parents
+        for i in range(3):
+            writer.add(quarkmodels.Route(id="route-{0}".format(i),
+                                         tenant_id="tenant",
+                                         cidr="192.168.{0}.0/24".format(i),
+                                         gateway="10.0.0.1",
+                                         subnet_id="subnet-0"))
+        for i in range(2):
+            writer.add(quarkmodels.Subnet(id="subnet-{0}".format(i),
+                                          network_id="network-0",
+                                          tenant_id="tenant",
+                                          cidr="10.0.{0}.0/24".format(i)))
+        writer.add(make_network(0))
+        writer.add(quarkmodels.MacAddressRange(
+            id="range-0", cidr="AA:BB:CC:00:00:00/24",
+            first_address=0xAABBCC000000, last_address=0xAABBCCFFFFFF,
+            next_auto_assign_mac=0xAABBCC000000))
+        self.assertEqual(writer.flush(), 7)
+        order = writer.committed_tables
+        networks = table_name(quarkmodels.Network)
+        subnets = table_name(quarkmodels.Subnet)
+        routes = table_name(quarkmodels.Route)
+        self.assertLess(order.index(networks), order.index(subnets))
+        self.assertLess(order.index(subnets), order.index(routes))
+        self.assertEqual(writer.written,
+                         {networks: 1, subnets: 2, routes: 3,
+                          table_name(quarkmodels.MacAddressRange): 1})
+        self.assertEqual(writer.commits, 4)
+
+    def test_deadlock_is_retried(self):
+        writer = RecordingScheduler(self.engine, deadlocks=1, writers=1,
+                                    backoff=0)
+        for i in range(3):
+            writer.add(make_network(i))
+        self.assertEqual(writer.flush(), 3)
+        self.assertEqual(writer.attempts, 2)
+        self.assertEqual(writer.rejected, [])
+
+
+class TestPolicies(unittest2.TestCase):
+    """Policies of a network quark does not have (the writer rejected
+    it) are skipped, the others written."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        melange_engine = create_engine(
+            'sqlite:///{0}/melange.sqlite'.format(self.tmpdir))
+        quark_engine = create_engine(
+            'sqlite:///{0}/quark.sqlite'.format(self.tmpdir))
+        # four blocks, each in a network and tenant with a policy of its own
+        Generator(DatasetSpec(ips=40, ips_per_block=10, blocks_per_network=1,
+                              networks_per_tenant=1),
+                  melange_engine).generate()
+        quarkmodels.BASEV2.metadata.create_all(quark_engine)
+        self.melange_session = loadSession(melange_engine)
+        self.neutron_session = loadSession(quark_engine)
+
+    def tearDown(self):
+        self.melange_session.close()
+        self.neutron_session.close()
+        shutil.rmtree(self.tmpdir)
+
+    def migrate_without_a_network(self, dedupe_policies):
+        migration = obligate.Obligator(self.melange_session,
+                                       self.neutron_session,
+                                       dedupe_policies=dedupe_policies)
+        migration.writer.writers = 1
+        migration.migrate_networks()
+        migration.migrate_commit()
+        block = self.melange_session.query(melange.IpBlocks).first()
+        self.neutron_session.query(quarkmodels.Network).\
+            filter(quarkmodels.Network.id == block.network_id).delete()
+        self.neutron_session.commit()
+        migration.migrate_policies()
+        migration.migrate_commit()
+        self.assertEqual(self.get_policy_count(), 3)
+        skipped = migration.json_data['policies']['ids'][
+            deterministic_id('policy', block.policy_id, block.id)]
+        self.assertFalse(skipped['migrated'])
+        self.assertIn('not in quark', skipped['reason'])
+
+    def get_policy_count(self):
+        return self.neutron_session.query(
+            func.count(quarkmodels.IPPolicy.id)).scalar()
+
+    def test_missing_network(self):
+        self.migrate_without_a_network(dedupe_policies=False)
+
+    def test_missing_network_deduped(self):
+        self.migrate_without_a_network(dedupe_policies=True)
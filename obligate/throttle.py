@@ -0,0 +1,181 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Keeping obligate's reads from hurting a live melange.
+
+A Throttle paces the statements sent to one database: at most
+`queries_per_second` of them and `rows_per_second` rows read. Pauses are
+taken before a statement, so a big chunk of rows delays the next query
+rather than the one that read it. Adaptive throttles also watch query
+latency and back off (pausing in proportion to it) while the database
+answers slower than usual, each statement shape (see profiler.normalize)
+compared with the best that shape has done: a big read is not slow
+because a small one was quicker.
+
+Melange statements are seen through engine events, the bridges call
+before_query/query_done themselves, and records read in chunks of
+chunk_rows while the melange throttle is on, see records.iterate.
+"""
+import logging
+import time
+
+from sqlalchemy import event
+
+from profiler import normalize
+from utils import get_option
+
+tlog = logging.getLogger('obligate.throttle')
+
+# the throttle melange reads are paced by, see records.iterate
+_active = None
+
+
+def active():
+    return _active
+
+
+class Throttle(object):
+    """
+    >>> now = [0.0]
+    >>> def sleep(seconds):
+    ...     now[0] += seconds
+    >>> t = Throttle(rows_per_second=100, queries_per_second=10,
+    ...              clock=lambda: now[0], sleep=sleep)
+    >>> t.before_query(); t.read(200); t.before_query(); now[0]
+    2.0
+    >>> t.before_query(); now[0]
+    2.1
+
+    A healthy database answering small and big queries is left alone:
+
+    >>> t = Throttle(adaptive=True, clock=lambda: now[0], sleep=sleep)
+    >>> for i in range(100):
+    ...     t.query_done(0.001, 'SELECT id'); t.query_done(0.05, 'SELECT *')
+    >>> t.scale, t.paused_seconds
+    (1.0, 0.0)
+    >>> for i in range(5):
+    ...     t.query_done(0.5, 'SELECT *')
+    >>> t.scale < 1.0
+    True
+    """
+    def __init__(self, rows_per_second=None, queries_per_second=None,
+                 adaptive=False, latency_factor=2.0, chunk_rows=1000,
+                 clock=time.time, sleep=time.sleep):
+        self.rows_per_second = rows_per_second
+        self.queries_per_second = queries_per_second
+        self.adaptive = adaptive
+        self.latency_factor = latency_factor
+        self.chunk_rows = chunk_rows
+        self.clock = clock
+        self.sleep = sleep
+        # budgets are multiplied by scale, adaptive throttles lower it
+        self.scale = 1.0
+        # statement shape -> [recent latency, best recent latency]
+        self.latencies = dict()
+        self.query_free_at = 0.0
+        self.rows_free_at = 0.0
+        self.paused_seconds = 0.0
+        self.queries = 0
+
+    @classmethod
+    def from_config(cls, environment=None):
+        """The [throttle] (or [throttle:ENV]) of .config."""
+        def number(option):
+            value = get_option('throttle', option, None, environment)
+            return float(value) if value else None
+        return cls(rows_per_second=number('rows_per_second'),
+                   queries_per_second=number('queries_per_second'),
+                   adaptive=(get_option('throttle', 'adaptive', 'false',
+                                        environment).lower()
+                             in ('1', 'true', 'yes', 'on')),
+                   latency_factor=number('latency_factor') or 2.0,
+                   chunk_rows=int(number('chunk_rows') or 1000))
+
+    @property
+    def enabled(self):
+        return bool(self.rows_per_second or self.queries_per_second or
+                    self.adaptive)
+
+    def activate(self):
+        # a throttle that limits nothing leaves reads unchunked
+        global _active
+        _active = self if self.enabled else None
+
+    def watch(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        self.before_query()
+        conn.info['obligate_throttle_started'] = self.clock()
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        started = conn.info.pop('obligate_throttle_started', None)
+        if started is not None:
+            self.query_done(self.clock() - started, normalize(statement))
+
+    def pause(self, seconds):
+        if seconds > 0:
+            self.sleep(seconds)
+            self.paused_seconds += seconds
+
+    def before_query(self):
+        now = self.clock()
+        until = max(self.query_free_at, self.rows_free_at)
+        if until > now:
+            self.pause(until - now)
+            now = until
+        if self.queries_per_second:
+            self.query_free_at = now + 1.0 / (self.queries_per_second *
+                                              self.scale)
+        self.queries += 1
+
+    def read(self, rows):
+        """Count rows read; the next query waits for the time they took
+        out of the rows budget."""
+        if self.rows_per_second:
+            self.rows_free_at = max(self.clock(), self.rows_free_at) + \
+                rows / (self.rows_per_second * self.scale)
+
+    def query_done(self, seconds, shape=None):
+        """Latency of one statement of `shape`, adaptive throttles back
+        off while it is over latency_factor times that shape's best."""
+        if not self.adaptive:
+            return
+        latency = self.latencies.get(shape)
+        if latency is None:
+            latency = self.latencies[shape] = [seconds,
+                                               max(seconds, 0.0005)]
+        else:
+            latency[0] = 0.8 * latency[0] + 0.2 * seconds
+            # the fastest this shape has been answering
+            latency[1] = max(min(latency[1], latency[0]), 0.0005)
+        slow = latency[0] > latency[1] * self.latency_factor
+        if slow and self.scale > 0.05:
+            self.scale = max(self.scale * 0.8, 0.05)
+            tlog.debug("Latency {0:.1f} ms over {1:.1f} ms, backing off to "
+                       "{2:.0%}.".format(latency[0] * 1000,
+                                         latency[1] * 1000, self.scale))
+        elif not slow and self.scale < 1.0:
+            self.scale = min(self.scale + 0.02, 1.0)
+        if self.scale < 1.0:
+            # spend (1 - scale) of the time idle, whatever the budgets
+            self.pause(seconds * (1.0 / self.scale - 1.0))
+
+    def summary(self):
+        return "{0} queries, paused {1:.1f} seconds".format(
+            self.queries, self.paused_seconds)
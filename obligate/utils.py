@@ -1,20 +1,20 @@
-import atexit
 import ConfigParser as cfgp
 import datetime
 import glob
 import json
 import logging
 import math
-from models import melange, neutron
+from models import neutron
+from asynclog import BackgroundHandler
+from governor import SpillDict
+from intervals import IntervalSet
 import netaddr
 import os
-from quark.db import models as quarkmodels
 from sqlalchemy.orm import sessionmaker
 import subprocess
-import keyring
-import os
 import re
 import socket
+import uuid
 
 
 def get_config_from_file():
@@ -31,6 +31,7 @@ def check_keyring(value):
     if value.startswith('USE_KEYRING'):
         identifier = re.match("USE_KEYRING\['(.*)'\]", value).group(1)
         username = '%s:%s' % ('global', identifier)
+        import keyring
         return keyring.get_password('supernova', username)
     return value
 
@@ -75,6 +76,25 @@ def get_connection_creds(environment):
             'nova_username': nova_user,
             'nova_password': nova_pass}
 
+
+def connect_bridges(environment=None, nova_throttle=None,
+                    melange_throttle=None):
+    """(nova, melange) mysql json bridges of the environment, their calls
+    paced by the throttles given."""
+    # the bridges need requests, only import them when asked for
+    import query
+    env = environment or get_settings().migration_environment
+    creds = get_connection_creds(env)
+    nova = query.Nova(creds['nova_url'], creds['nova_username'],
+                      creds['nova_password'])
+    melanged = query.Melange(creds['melange_url'],
+                             creds['melange_username'],
+                             creds['melange_password'])
+    nova.throttle = nova_throttle
+    melanged.throttle = melange_throttle
+    return nova, melanged
+
+
 def get_basepath():
     basepath = os.path.dirname(os.path.realpath(__file__))
     basepath = os.path.abspath(os.path.join(basepath, os.pardir))
@@ -88,49 +108,148 @@ log_format = "{0} {1} {2} line {3} {4}".format('%(asctime)-25s',
                                                '%(message)-4s')
 log_dateformat = '%m/%d/%Y %I:%M:%S %p'
 file_timeformat = "%A-%d-%B-%Y--%I.%M.%S.%p"
-now = datetime.datetime.now()
 basepath = get_basepath()
-filename_format = '{0}/logs/obligate.{1}.log'\
-    .format(basepath, now.strftime(file_timeformat))
-
-# create the logs directory if it doesn't exist
-if not os.path.exists('{0}/logs'.format(basepath)):
-    os.makedirs('{0}/logs'.format(basepath))
+filename_format = '{0}/obligate.{1}.log'
 
 
-def start_logging(verbose=False):
-    logging.basicConfig(format=log_format,
-                        datefmt=log_dateformat,
-                        filename=filename_format,
-                        filemode='w',
-                        level=logging.DEBUG)
-    root = logging.getLogger()
-    console = logging.StreamHandler()
-    console.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(funcName)s(%(lineno)d): %(message)s')  # noqa
-    console.setFormatter(formatter)
+def get_log_dir(environment=None):
+    """logs/, or logs/<environment>/ for one region of a fleet run."""
+    logdir = '{0}/logs'.format(basepath)
+    if environment:
+        logdir = '{0}/{1}'.format(logdir, environment)
+    # create the logs directory if it doesn't exist
+    if not os.path.exists(logdir):
+        os.makedirs(logdir)
+    return logdir
+
+
+def start_logging(verbose=False, environment=None):
+    """Log to a new file in the log dir (and the console when verbose),
+    through a background thread."""
+    global _log_handler
+    settings = get_settings()
+    now = datetime.datetime.now()
+    logfile = logging.FileHandler(filename_format.format(
+        get_log_dir(environment), now.strftime(file_timeformat)), mode='w')
+    logfile.setLevel(settings.log_file_level)
+    logfile.setFormatter(logging.Formatter(log_format, log_dateformat))
+    handlers = [logfile]
     if verbose:
-        root.addHandler(console)
+        console = logging.StreamHandler()
+        console.setLevel(settings.log_console_level)
+        formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(funcName)s(%(lineno)d): %(message)s')  # noqa
+        console.setFormatter(formatter)
+        handlers.append(console)
+    _log_handler = BackgroundHandler(handlers)
+    root = logging.getLogger()
+    # messages no handler wants are not even formatted
+    root.setLevel(min(handler.level for handler in handlers))
+    root.addHandler(_log_handler)
+
+
+def stop_logging():
+    """Write out what is still queued and close the log file."""
+    global _log_handler
+    if _log_handler is not None:
+        logging.getLogger().removeHandler(_log_handler)
+        _log_handler.close()
+        _log_handler = None
+
+
+def log_level(name):
+    """
+    >>> log_level('info'), log_level('DEBUG')
+    (20, 10)
+    """
+    return getattr(logging, name.upper())
 
 ulog = logging.getLogger('obligate.utils')
-basepath = os.path.dirname(os.path.realpath(__file__))
-basepath = os.path.abspath(os.path.join(basepath, os.pardir))
 
-config = cfgp.ConfigParser()
 config_file_path = "{0}/.config".format(basepath)
-config.read(config_file_path)
-min_ram_mb = config.get('system_reqs', 'min_ram_mb', '4000')
-migrate_tables = config.get('migration', 'tables', ('',
-                                                    'networks',
-                                                    'subnets',
-                                                    'routes',
-                                                    'ips',
-                                                    'interfaces',
-                                                    'mac_ranges',
-                                                    'macs',
-                                                    'policies',
-                                                    'policy_rules'))
-migrate_tables = migrate_tables.splitlines()[1:]
+_config = None
+_settings = None
+_log_handler = None
+
+
+def get_config():
+    """.config, read the first time it is needed."""
+    global _config
+    if _config is None:
+        _config = cfgp.ConfigParser()
+        _config.read(config_file_path)
+    return _config
+
+
+def get_option(section, option, default=None, environment=None):
+    """Read an option from .config, falling back to `default`. With an
+    environment [section:environment] is tried first."""
+    config = get_config()
+    if environment:
+        env_section = '{0}:{1}'.format(section, environment)
+        if config.has_option(env_section, option):
+            return config.get(env_section, option)
+    if config.has_option(section, option):
+        return config.get(section, option)
+    return default
+
+
+class Settings(object):
+    """The [system_reqs] and [migration] values of .config."""
+    def __init__(self):
+        self.min_ram_mb = int(get_option('system_reqs', 'min_ram_mb',
+                                         4000))
+        self.memory_budget_mb = int(get_option('system_reqs',
+                                               'memory_budget_mb',
+                                               self.min_ram_mb))
+        self.writer_count = int(get_option('migration', 'writers', 4))
+        self.commit_target_seconds = float(get_option(
+            'migration', 'commit_target_seconds', 10))
+        self.rss_budget_mb = int(get_option('migration', 'rss_budget_mb',
+                                            self.min_ram_mb))
+        self.migration_environment = get_option('migration', 'environment',
+                                                'ordpreprod')
+        self.dedupe_policies = get_option(
+            'migration', 'dedupe_policies',
+            'false').lower() in ('1', 'true', 'yes', 'on')
+        # replace: quark is emptied before writing, upsert: rows are
+        # written with INSERT ... ON DUPLICATE KEY UPDATE over what is
+        # already there
+        self.write_mode = get_option('migration', 'write_mode', 'replace')
+        self.write_retries = int(get_option('migration', 'write_retries',
+                                            5))
+        self.retry_backoff_seconds = float(get_option(
+            'migration', 'retry_backoff_seconds', 0.5))
+        # written after every run as well when set
+        self.prometheus_textfile = get_option('metrics',
+                                              'prometheus_textfile')
+        self.log_file_level = log_level(get_option('logging', 'file_level',
+                                                   'DEBUG'))
+        self.log_console_level = log_level(get_option(
+            'logging', 'console_level', 'DEBUG'))
+        # per-row debug messages are logged for one row in this many
+        self.log_sample_every = int(get_option('logging', 'sample_every',
+                                               1000))
+        # how often the running stage logs its progress
+        self.progress_interval_seconds = float(get_option(
+            'progress', 'interval_seconds', 30))
+        # every run's metrics are appended here, see history.py
+        self.history_path = get_option(
+            'history', 'path', '{0}/logs/history.sqlite'.format(basepath))
+        self.regression_threshold = float(get_option(
+            'history', 'regression_threshold', 0.1))
+        self.migrate_tables = get_option('migration', 'tables', '').split()
+        if not self.migrate_tables:
+            self.migrate_tables = ['networks', 'subnets', 'routes', 'ips',
+                                   'interfaces', 'mac_ranges', 'macs',
+                                   'policies', 'policy_rules']
+
+
+def get_settings():
+    """The Settings, made the first time they are needed."""
+    global _settings
+    if _settings is None:
+        _settings = Settings()
+    return _settings
 
 
 def clear_logs():
@@ -144,9 +263,11 @@ def clear_logs():
             ulog.info("{0} deleted.".format(f.split('/')[-1]))
 
 
-def flush_db():
-    quarkmodels.BASEV2.metadata.drop_all(neutron.engine)
-    quarkmodels.BASEV2.metadata.create_all(neutron.engine)
+def flush_db(engine=None):
+    from quark.db import models as quarkmodels
+    engine = engine or neutron.get_engine()
+    quarkmodels.BASEV2.metadata.drop_all(engine)
+    quarkmodels.BASEV2.metadata.create_all(engine)
     ulog.debug("flush_db() complete.")
 
 
@@ -181,28 +302,57 @@ def init_id(json_data, tablename, id, num_exp=1):
 
 def set_reason(json_data, tablename, id, reason):
     try:
-        json_data[tablename]['ids'][id]['reason'] = reason
+        ids = json_data[tablename]['ids']
+        entry = ids[id]
+        entry['reason'] = reason
+        ids[id] = entry
     except Exception:
         ulog.error("Key {0} not in {1}"
                    " (tried reason {2})".format(id, tablename, reason))
 
 
-def build_json_structure(tables=migrate_tables):
+def build_json_structure(tables=None):
+    if tables is None:
+        tables = get_settings().migrate_tables
     json_data = dict()
     for table in tables:
         json_data[table] = {'num migrated': 0,
                             'new': 0,
-                            'ids': dict()}
+                            'ids': SpillDict()}
     return json_data
 
 
-def dump_json(data):
+def dump_json(data, environment=None):
     file_timeformat = "%A-%d-%B-%Y--%I.%M.%S.%p"
     now = datetime.datetime.now()
-    filename = 'logs/obligate.{0}'.format(now.strftime(file_timeformat))
-    for tablename in migrate_tables:
+    filename = '{0}/obligate.{1}'.format(get_log_dir(environment),
+                                         now.strftime(file_timeformat))
+    for tablename in data:
         with open('{0}.{1}.json'.format(filename, tablename), 'wb') as fh:
-            json.dump(data[tablename], fh)
+            write_ledger(data[tablename], fh)
+
+
+def write_ledger(table, fh):
+    """
+    json.dump one ledger table, streaming its ids (which may be on disk).
+
+    >>> import StringIO
+    >>> fh = StringIO.StringIO()
+    >>> ids = SpillDict()
+    >>> ids['a'] = {'migrated': True}
+    >>> write_ledger({'num migrated': 1, 'new': 0, 'ids': ids}, fh)
+    >>> json.loads(fh.getvalue()) == {'num migrated': 1, 'new': 0,
+    ...                               'ids': {'a': {'migrated': True}}}
+    True
+    """
+    fh.write('{{"num migrated": {0}, "new": {1}, "ids": {{'
+             .format(json.dumps(table['num migrated']),
+                     json.dumps(table['new'])))
+    for n, (id, entry) in enumerate(table['ids'].iteritems()):
+        if n:
+            fh.write(', ')
+        fh.write('{0}: {1}'.format(json.dumps(str(id)), json.dumps(entry)))
+    fh.write('}}')
 
 
 def incr_num(json_data, tablename):
@@ -212,14 +362,33 @@ def incr_num(json_data, tablename):
 
 def migrate_id(json_data, tablename, id):
     try:
-        json_data[tablename]['ids'][id]['migrated'] = True
-        json_data[tablename]['ids'][id]['migration count'] -= 1
+        ids = json_data[tablename]['ids']
+        entry = ids[id]
+        entry['migrated'] = True
+        entry['migration count'] -= 1
+        ids[id] = entry
         json_data = incr_num(json_data, tablename)
     except Exception:
         ulog.error("Key {0} not in {1}".format(id, tablename))
     return json_data
 
 
+def reject_id(json_data, tablename, id, reason):
+    """Undo migrate_id for a row that could not be written after all."""
+    try:
+        ids = json_data[tablename]['ids']
+        entry = ids[id]
+        if entry['migrated']:
+            entry['migrated'] = False
+            entry['migration count'] += 1
+            json_data[tablename]['num migrated'] -= 1
+        entry['reason'] = reason
+        ids[id] = entry
+    except Exception:
+        ulog.error("Key {0} not in {1}"
+                   " (tried reason {2})".format(id, tablename, reason))
+
+
 def translate_netmask(netmask, destination):
     """
     In [64]: a = netaddr.IPAddress("255.240.0.0") # <- netmask
@@ -242,17 +411,53 @@ def translate_netmask(netmask, destination):
                       format(netmask, destination))
 
 
+def cidr_to_range(cidr):
+    """
+    (first, last + 1) of a cidr as ipv6 integers. IPv4 is mapped into
+    ::ffff:0:0/96, the way quark stores addresses.
+
+    >>> cidr_to_range('10.0.0.0/30')
+    (281470849515520L, 281470849515524L)
+    """
+    network = netaddr.IPNetwork(cidr).ipv6()
+    return network.first, network.last + 1
+
+
+# every id obligate makes up is a uuid5 in this namespace
+id_namespace = uuid.UUID('5a1f0e2c-9d4b-5c61-8f3e-0b6e0c1d7a42')
+
+
+def deterministic_id(kind, *keys):
+    """
+    The id of a quark row melange has no id for, derived from the melange
+    keys it comes from, so every run gives the same row the same id.
+
+    >>> policy_id = deterministic_id('policy', 'p1', 'b1')
+    >>> policy_id == deterministic_id('policy', 'p1', 'b1')
+    True
+    >>> policy_id == deterministic_id('policy', 'p1', 'b2')
+    False
+    >>> len(deterministic_id('dns', 'b1', 1))
+    36
+    """
+    name = ':'.join([kind] + [unicode(key) for key in keys])
+    return str(uuid.uuid5(id_namespace, name.encode('utf-8')))
+
+
 def trim_br(network_id):
     if network_id[:3] == "br-":
         return network_id[3:]
     return network_id
 
 
-def has_enough_ram():
+def total_ram_mb():
     free = subprocess.Popen(['free', '-m'],
                             stdout=subprocess.PIPE).communicate()[0].splitlines()  # noqa
-    totes_ram = int(free[1].strip().split()[1])
-    if totes_ram >= int(min_ram_mb):
+    return int(free[1].strip().split()[1])
+
+
+def has_enough_ram():
+    if total_ram_mb() >= get_settings().min_ram_mb:
         return True
     return False
 
@@ -301,18 +506,15 @@ def make_offset_lengths(octets, offsets):
     >>> o = [255, 3]
     >>> make_offset_lengths(o, r)
     [(3, 1), (5, 26), (255, 1)]
+
+    Wide ranges cost no more than narrow ones:
+    >>> make_offset_lengths([], [(0, 2 ** 64), (2 ** 64, 2 ** 64)])
+    [(0, 36893488147419103232L)]
     """
-    tmp_ranges = list()
-    tmp_or = list()
-    if offsets:
-        for o in offsets:
-            tmp_ranges.append(offset_to_range(o))
+    policy = IntervalSet.from_offset_lengths(offsets or [])
     if octets:
-        tmp_or = list_to_ranges(octets)
-        for r in tmp_or:
-            tmp_ranges.append(r)
-    tmp_all = consolidate_ranges(tmp_ranges)
-    return ranges_to_offset_lengths(tmp_all)
+        policy = policy | IntervalSet.from_points(octets)
+    return policy.offset_lengths()
 
 
 def list_to_ranges(the_list=None):
@@ -332,24 +534,7 @@ def list_to_ranges(the_list=None):
     [(1, 2)]
 
     """
-    retvals = list()
-    all_items = list()
-    stack = list()
-    for o in the_list:
-        all_items.append(o)
-    all_items.sort()
-    if len(all_items) == 1:
-        return [(all_items[0], all_items[0] + 1)]
-    stack.append(all_items[0])
-    for c, i in enumerate(all_items[1:], start=1):
-        if i - 1 == stack[-1]:
-            stack.append(i)
-        else:
-            retvals.append((stack[0], stack[-1] + 1))
-            stack = list()
-            stack.append(i)
-    retvals.append((stack[0], stack[-1] + 1))
-    return retvals
+    return IntervalSet.from_points(the_list or []).ranges()
 
 
 def consolidate_ranges(the_ranges):
@@ -370,23 +555,7 @@ def consolidate_ranges(the_ranges):
     [(1, 13), (16, 25)]
 
     """
-    if not the_ranges:
-        return []
-    if the_ranges[0] == 255:
-        the_ranges[0] = -1
-    if len(the_ranges) < 2:
-        return the_ranges
-    the_ranges = sorted(the_ranges, key=lambda ran: ran[0])
-    retvals = list()
-    for r in the_ranges:
-        if r[1] - r[0] == 1:
-            retvals.append(r[0])
-        else:
-            for n in range(r[0], r[1]):
-                retvals.append(n)
-    retvals = set(retvals)
-    retvals = list_to_ranges(retvals)
-    return retvals
+    return IntervalSet(the_ranges or []).ranges()
 
 
 def ranges_to_offset_lengths(ranges):
@@ -403,10 +572,7 @@ def ranges_to_offset_lengths(ranges):
     >>> ranges_to_offset_lengths([(6, 7), (10, 100)])
     [(6, 1), (10, 90)]
     """
-    retvals = list()
-    for r in ranges:
-        retvals.append((r[0], r[1] - r[0]))
-    return retvals
+    return IntervalSet(ranges).offset_lengths()
 
 
 def to_mac_range(val):
@@ -470,11 +636,24 @@ def to_mac_range(val):
     return cidr, prefix_int, prefix_int + mask_size
 
 
+def mac_to_int(mac):
+    """
+    The integer value of a mac address, melange stores most as integers.
+
+    >>> mac_to_int(187649973288960)
+    187649973288960
+    >>> mac_to_int("AA:AA:AA:00:00:00"), mac_to_int("aa-aa-aa-00-00-01")
+    (187649973288960, 187649973288961)
+    """
+    if isinstance(mac, (int, long)):
+        return mac
+    return int(mac.replace(':', '').replace('-', ''), 16)
+
+
 def done():
     ulog.info('Done, exiting.')
     ulog.info('-' * 20)
-
-atexit.register(done)
+    stop_logging()
 
 if __name__ == "__main__":
     import doctest
@@ -0,0 +1,89 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from intervals import IntervalIndex
+
+
+class IpIntegrity(object):
+    """
+    Checks migrated addresses against the subnets they claim to be in.
+
+    Subnets are added as (first, end) integer ranges, end exclusive, in
+    the same ipv6 space quark stores addresses in. check() is one pass
+    over the addresses and keeps O(1) state, which is why it needs them
+    ordered by network and then by address: duplicates are only ever
+    compared with their neighbour.
+
+    >>> v = IpIntegrity()
+    >>> v.add_subnet('s1', 'n1', (10, 20))
+    >>> v.add_subnet('s2', 'n1', (15, 30))
+    >>> v.add_subnet('s3', 'n2', (10, 20))
+    >>> v.overlapping_subnets()
+    [('n1', 's1', 's2')]
+    >>> ips = [('a', 'n1', 's1', 12), ('b', 'n1', 's1', 12),
+    ...        ('c', 'n1', 's1', 25), ('d', 'n2', 's3', 12),
+    ...        ('e', 'n2', 's9', 13), ('f', 'n1', 's3', 14)]
+    >>> for problem in v.check(ips):
+    ...     print problem
+    ('b', 'duplicate address 12 in network n1, first seen on a')
+    ('c', 'address 25 outside subnet s1')
+    ('e', 'unknown subnet s9')
+    ('f', 'subnet s3 belongs to network n2, not n1')
+    >>> v.checked
+    6
+    """
+    def __init__(self):
+        self.subnets = dict()
+        self.checked = 0
+
+    def add_subnet(self, subnet_id, network_id, subnet_range):
+        self.subnets[subnet_id] = (network_id,
+                                   subnet_range[0], subnet_range[1])
+
+    def overlapping_subnets(self):
+        """(network id, subnet id, subnet id) for overlapping subnets of
+        one network."""
+        by_network = dict()
+        for subnet_id, (network_id, first, end) in self.subnets.iteritems():
+            by_network.setdefault(network_id, list()).append(
+                (first, end, subnet_id))
+        overlaps = list()
+        for network_id in sorted(by_network):
+            index = IntervalIndex(by_network[network_id])
+            for a, b in index.overlaps():
+                overlaps.append((network_id, a[2], b[2]))
+        return overlaps
+
+    def check(self, ips):
+        """Yield (ip id, problem) for (id, network id, subnet id, address)
+        rows, ordered by network id and address."""
+        previous = (None, None, None)
+        for ip_id, network_id, subnet_id, address in ips:
+            self.checked += 1
+            address = int(address)
+            if (network_id, address) == previous[:2]:
+                yield ip_id, ("duplicate address {0} in network {1}, first "
+                              "seen on {2}".format(address, network_id,
+                                                   previous[2]))
+                continue
+            previous = (network_id, address, ip_id)
+            subnet = self.subnets.get(subnet_id)
+            if subnet is None:
+                yield ip_id, "unknown subnet {0}".format(subnet_id)
+            elif subnet[0] != network_id:
+                yield ip_id, ("subnet {0} belongs to network {1}, not {2}"
+                              .format(subnet_id, subnet[0], network_id))
+            elif not subnet[1] <= address < subnet[2]:
+                yield ip_id, ("address {0} outside subnet {1}"
+                              .format(address, subnet_id))
@@ -0,0 +1,418 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import Queue
+import threading
+import time
+
+from quark.db import models as quarkmodels
+from quark.drivers import optimized_nvp_driver as optdriver
+from sqlalchemy import bindparam
+from sqlalchemy import exc
+from sqlalchemy import text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import object_mapper
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.expression import Insert
+
+wlog = logging.getLogger('obligate.writer')
+
+# mysql errors worth retrying as they are: lock wait timeout, deadlock
+TRANSIENT_ERRORS = (1205, 1213)
+
+
+def is_transient(error):
+    """
+    True for a DBAPI error that goes away when the transaction is retried.
+
+    >>> class OperationalError(Exception):
+    ...     pass
+    >>> deadlock = OperationalError()
+    >>> deadlock.orig = OperationalError(1213, 'Deadlock found')
+    >>> is_transient(deadlock), is_transient(ValueError('bad dns2'))
+    (True, False)
+    """
+    args = getattr(getattr(error, 'orig', None), 'args', ())
+    return bool(args) and args[0] in TRANSIENT_ERRORS
+
+
+def is_row_error(error):
+    """True for an error some rows of a batch cause (a duplicate key, a
+    value the column can't hold), which writing fewer rows can avoid.
+    Anything else (a lost connection, a missing table or column) fails
+    every row alike."""
+    return isinstance(error, (exc.IntegrityError, exc.DataError))
+
+
+class Upsert(Insert):
+    """INSERT ... ON DUPLICATE KEY UPDATE (mysql only).
+
+    `update_columns` are overwritten when the row exists, with none the
+    first primary key column is assigned to itself so existing rows are
+    left alone. MySQL skips rows whose values did not change.
+    """
+    update_columns = ()
+
+
+@compiles(Upsert, 'mysql')
+def compile_upsert(upsert, compiler, **kw):
+    columns = list(upsert.update_columns) or \
+        [c.name for c in upsert.table.primary_key][:1]
+    quote = compiler.preparer.quote_identifier
+    return "{0} ON DUPLICATE KEY UPDATE {1}".format(
+        compiler.visit_insert(upsert, **kw),
+        ", ".join("{0} = VALUES({0})".format(quote(c)) for c in columns))
+
+
+@compiles(Upsert)
+def compile_upsert_elsewhere(upsert, compiler, **kw):
+    # a plain INSERT would fail (or duplicate rows) on a rerun
+    raise Exception("Upserts need mysql, not {0}."
+                    .format(compiler.dialect.name))
+
+
+def upsert(table, columns):
+    """An Upsert of `columns` into `table`. Primary keys and created_at
+    are never overwritten."""
+    statement = Upsert(table)
+    statement.update_columns = [c for c in sorted(columns)
+                                if c != 'created_at' and
+                                not table.c[c].primary_key]
+    if not statement.update_columns and not len(table.primary_key):
+        raise Exception("Nothing to upsert {0} on, it has no primary key."
+                        .format(table.name))
+    return statement
+
+
+def insert_missing(table, columns):
+    """
+    An insert of `columns` into a table without keys that skips rows
+    already there, all columns compared.
+
+    >>> from sqlalchemy import Column, Integer, MetaData, Table
+    >>> t = Table('t', MetaData(), Column('a', Integer), Column('b', Integer))
+    >>> print insert_missing(t, ['a', 'b'])
+    INSERT INTO t (a, b) SELECT :a, :b FROM DUAL WHERE NOT EXISTS (SELECT 1 \
+FROM t WHERE a = :a AND b = :b)
+    """
+    return text("INSERT INTO {0} ({1}) SELECT {2} FROM DUAL WHERE NOT "
+                "EXISTS (SELECT 1 FROM {0} WHERE {3})".format(
+                    table.name, ", ".join(columns),
+                    ", ".join(":" + c for c in columns),
+                    " AND ".join("{0} = :{0}".format(c) for c in columns)))
+
+
+def row_values(item):
+    """Column name -> value for every column of a mapped object. None is
+    a value, so upserts clear columns melange cleared; only unset columns
+    with a default are left out, for the default to apply."""
+    mapper = object_mapper(item)
+    values = dict()
+    for column in mapper.local_table.columns:
+        value = getattr(item, mapper.get_property_by_column(column).key)
+        if value is None and (column.default is not None or
+                              column.server_default is not None):
+            continue
+        values[column.name] = value
+    return values
+
+
+class Statement(object):
+    """A core statement run once per buffered parameter set.
+
+    Used for rows obligate writes without building mapped objects. It is
+    scheduled like a model, under its own name. `upsert_statement`
+    replaces an insert that could hit existing rows in upsert mode.
+    """
+    def __init__(self, name, statement, upsert_statement=None):
+        self.__tablename__ = name
+        self.statement = statement
+        self.upsert_statement = upsert_statement or statement
+
+    def __repr__(self):
+        return "<Statement {0}>".format(self.__tablename__)
+
+
+ports_table = quarkmodels.Port.__table__
+port_ip_associations = Statement(
+    quarkmodels.port_ip_association.name,
+    quarkmodels.port_ip_association.insert(),
+    insert_missing(quarkmodels.port_ip_association,
+                   ['port_id', 'ip_address_id']))
+port_macs = Statement(
+    "{0}.mac_address".format(ports_table.name),
+    ports_table.update().
+    where(ports_table.c.id == bindparam('b_port_id')).
+    values(mac_address=bindparam('b_mac_address')))
+
+
+def policy_link(model):
+    """Point a network or subnet (b_id) at its policy (b_ip_policy_id)."""
+    table = model.__table__
+    return Statement("{0}.ip_policy_id".format(table.name),
+                     table.update().
+                     where(table.c.id == bindparam('b_id')).
+                     values(ip_policy_id=bindparam('b_ip_policy_id')))
+
+network_policies = policy_link(quarkmodels.Network)
+subnet_policies = policy_link(quarkmodels.Subnet)
+
+# Every quark model (or statement) obligate writes, mapped to the models
+# its rows reference. Policies update network and subnet rows.
+TABLE_PARENTS = {
+    quarkmodels.Network: (),
+    quarkmodels.Subnet: (quarkmodels.Network,),
+    quarkmodels.DNSNameserver: (quarkmodels.Subnet,),
+    quarkmodels.Route: (quarkmodels.Subnet,),
+    quarkmodels.IPAddress: (quarkmodels.Network, quarkmodels.Subnet),
+    quarkmodels.Port: (quarkmodels.Network,),
+    port_ip_associations: (quarkmodels.Port, quarkmodels.IPAddress),
+    port_macs: (quarkmodels.Port,),
+    optdriver.LSwitch: (quarkmodels.Network,),
+    optdriver.LSwitchPort: (optdriver.LSwitch,),
+    quarkmodels.MacAddressRange: (),
+    quarkmodels.MacAddress: (quarkmodels.MacAddressRange,),
+    quarkmodels.IPPolicy: (),
+    quarkmodels.IPPolicyRange: (quarkmodels.IPPolicy,),
+    network_policies: (quarkmodels.IPPolicy, quarkmodels.Network),
+    subnet_policies: (quarkmodels.IPPolicy, quarkmodels.Subnet),
+}
+
+
+def table_name(model):
+    return model.__tablename__
+
+
+def descendants(model, models):
+    """All models in `models` that directly or indirectly wait on `model`."""
+    found = set()
+    stack = [model]
+    while stack:
+        parent = stack.pop()
+        for child in models:
+            if child not in found and parent in TABLE_PARENTS[child]:
+                found.add(child)
+                stack.append(child)
+    return found
+
+
+class WriteScheduler(object):
+    """Buffers quark rows per table and writes them on a pool of sessions.
+
+    Each writer thread owns one session (and so one connection) and commits
+    each table it writes in its own transaction. During a flush a table is
+    only handed to a writer once every parent table in the same flush has
+    been committed; tables with no relationship run side by side.
+
+    Sessions never expire on commit and are emptied after every table, so
+    rows written in one flush can be referenced (and updated) from any
+    writer in the next one.
+
+    With `upsert` mapped objects are written as Upserts instead of through
+    the session, so rows from an earlier run are updated in place. Their
+    relationships are not written, use ids and Statements instead.
+
+    Deadlocks and lock wait timeouts are retried up to `retries` times,
+    waiting `backoff` seconds and twice as long after every attempt. A
+    row level error (IntegrityError, DataError) splits the batch in halves
+    until the rows failing on their own are found; those are left out and
+    collected in `rejected` as (model, row, error), everything else is
+    written. Any other error fails the table.
+    """
+    def __init__(self, engine, writers=4, upsert=False, retries=5,
+                 backoff=0.5):
+        self.Session = sessionmaker(bind=engine, expire_on_commit=False)
+        self.writers = max(1, int(writers))
+        self.upsert = upsert
+        self.retries = retries
+        self.backoff = backoff
+        self.pending = dict()
+        self.pending_count = 0
+        self.rejected = list()
+        # running totals: rows written per table, tables committed
+        self.written = dict()
+        self.commits = 0
+
+    def add(self, item):
+        model = type(item)
+        if model not in TABLE_PARENTS:
+            raise Exception("No write dependencies known for {0}"
+                            .format(model.__name__))
+        self.pending.setdefault(model, list()).append(item)
+        self.pending_count += 1
+
+    def execute(self, statement, params):
+        """Buffer one parameter set for a Statement."""
+        self.pending.setdefault(statement, list()).append(params)
+        self.pending_count += 1
+
+    def flush(self):
+        """Write every pending row, returns the number of rows written.
+
+        Raises when a table could not be written at all, rows rejected one
+        by one are only added to `rejected`.
+        """
+        batches = self.pending
+        self.pending = dict()
+        self.pending_count = 0
+        if not batches:
+            return 0
+        waiting = dict((model, set(p for p in TABLE_PARENTS[model]
+                                   if p in batches))
+                       for model in batches)
+        ready = Queue.Queue()
+        done = Queue.Queue()
+        workers = list()
+        for i in range(min(self.writers, len(batches))):
+            worker = threading.Thread(target=self._write,
+                                      name="obligate-writer-{0}".format(i),
+                                      args=(batches, ready, done))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for model in [m for m, parents in waiting.items() if not parents]:
+            del waiting[model]
+            ready.put(model)
+        outstanding = len(batches)
+        written = 0
+        failed = list()
+        while outstanding:
+            model, rows, error, rejected = done.get()
+            outstanding -= 1
+            self.rejected.extend((model, item, e) for item, e in rejected)
+            if error:
+                failed.append(table_name(model))
+                skipped = descendants(model, waiting.keys())
+                for child in skipped:
+                    del waiting[child]
+                    wlog.error("Skipping {0} {1} rows, parent {2} failed."
+                               .format(len(batches[child]),
+                                       table_name(child),
+                                       table_name(model)))
+                    failed.append(table_name(child))
+                outstanding -= len(skipped)
+                continue
+            written += rows
+            self.written[table_name(model)] = \
+                self.written.get(table_name(model), 0) + rows
+            self.commits += 1
+            for child, parents in waiting.items():
+                parents.discard(model)
+                if not parents:
+                    del waiting[child]
+                    ready.put(child)
+        for worker in workers:
+            ready.put(None)
+        for worker in workers:
+            worker.join()
+        if failed:
+            raise Exception("Writing {0} failed.".format(", ".join(failed)))
+        return written
+
+    def _write(self, batches, ready, done):
+        session = self.Session()
+        try:
+            while True:
+                model = ready.get()
+                if model is None:
+                    break
+                items = batches[model]
+                start_time = time.time()
+                error = None
+                written, rejected = 0, []
+                try:
+                    written, rejected = self._isolate(session, model, items)
+                except Exception as e:
+                    error = e
+                    wlog.critical("Writing {0} rows to {1} failed: {2}"
+                                  .format(len(items), table_name(model),
+                                          e), exc_info=True)
+                if not error:
+                    wlog.debug("Wrote {0} {1} rows in {2:.2f} seconds, "
+                               "{3} rejected."
+                               .format(written, table_name(model),
+                                       time.time() - start_time,
+                                       len(rejected)))
+                done.put((model, written, error, rejected))
+        finally:
+            session.close()
+
+    def _isolate(self, session, model, items):
+        """Write `items`, bisecting a failing batch down to the rows that
+        fail on their own. Returns (rows written, [(row, error)])."""
+        try:
+            self._retry(session, model, items)
+            return len(items), []
+        except Exception as e:
+            if not is_row_error(e):
+                # out of retries on a lock, or the connection or schema
+                # is at fault: halves would fail the same way
+                raise
+            if len(items) == 1:
+                wlog.error("Rejected a {0} row: {1}"
+                           .format(table_name(model), e))
+                return 0, [(items[0], e)]
+            wlog.warning("Writing {0} {1} rows failed, bisecting: {2}"
+                         .format(len(items), table_name(model), e))
+        middle = len(items) // 2
+        first = self._isolate(session, model, items[:middle])
+        second = self._isolate(session, model, items[middle:])
+        return first[0] + second[0], first[1] + second[1]
+
+    def _retry(self, session, model, items):
+        attempt = 0
+        while True:
+            try:
+                return self._commit(session, model, items)
+            except Exception as e:
+                if not is_transient(e) or attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                attempt += 1
+                wlog.warning("Retrying {0} {1} rows in {2:.1f} seconds: {3}"
+                             .format(len(items), table_name(model), delay,
+                                     e))
+                time.sleep(delay)
+
+    def _commit(self, session, model, items):
+        # one transaction, the session is emptied whatever happens
+        try:
+            if isinstance(model, Statement):
+                session.execute(model.upsert_statement if self.upsert
+                                else model.statement, items)
+            elif self.upsert:
+                self._upsert(session, model, items)
+            else:
+                session.add_all(items)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.expunge_all()
+
+    def _upsert(self, session, model, items):
+        # one executemany per set of columns, the rest take their defaults
+        by_columns = dict()
+        for item in items:
+            values = row_values(item)
+            by_columns.setdefault(frozenset(values), list()).append(values)
+        affected = 0
+        for columns, rows in by_columns.iteritems():
+            result = session.execute(upsert(model.__table__, columns), rows)
+            affected += max(result.rowcount, 0)
+        # mysql counts 1 per insert, 2 per update and 0 per unchanged row
+        wlog.debug("Upserted {0} {1} rows, {2} affected."
+                   .format(len(items), table_name(model), affected))